@@ -1,11 +1,21 @@
-from fastapi import APIRouter, HTTPException, Depends
+from fastapi import APIRouter, HTTPException, Depends, Query, Request
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from sse_starlette.sse import EventSourceResponse
 from pydantic import BaseModel
 from typing import List, Optional
 from datetime import datetime
+import json
+import logging
 import time
+from app.core.metrics import ANOMALIES, REGISTRY, REQUEST_LATENCY, RESULTS, STAGE_LATENCY
+from app.core.model_client import call_limiter, call_trace
 from app.core.monitor import DialogueMonitor
-from app.core.security import SecurityManager
+from app.core.pipeline import MonitorPipeline
+from app.core.result_store import RISK_LEVELS, ResultQuery, ResultWriter, result_record
+from app.config import settings
 import asyncio
+
+logger = logging.getLogger(__name__)
 router = APIRouter()
 
 class Message(BaseModel):
@@ -29,70 +39,129 @@ class MonitoringResult(BaseModel):
     risk_level: str
     suggestions: List[str] = []
     security_status: Optional[dict] = None 
+    triage: Optional[dict] = None # 本地分诊的判定和依据
+    skipped_detectors: List[dict] = [] # 未运行的检测器及原因
+    reused_verdicts: List[dict] = [] # 复用了近似重复对话结论的检测器及相似度
+
+class BatchDialogueInput(BaseModel):
+    items: List[DialogueInput]
+    max_concurrency: Optional[int] = None # 不超过 BATCH_MAX_CONCURRENCY
+
+class BatchItemResult(BaseModel):
+    index: int
+    session_id: str
+    result: Optional[MonitoringResult] = None
+    error: Optional[str] = None
+
+class BatchMonitoringResult(BaseModel):
+    results: List[BatchItemResult]
+
+class LatestVerdictQuery(BaseModel):
+    session_ids: List[str]
+
+async def get_pipeline(request: Request) -> MonitorPipeline:
+    # 复用lifespan中创建的实例（共享LLM连接池）
+    return request.app.state.pipeline
+
+async def get_result_writer(request: Request) -> Optional[ResultWriter]:
+    return getattr(request.app.state, "result_writer", None)
 
-async def get_security_manager():
-    return SecurityManager()
+async def get_result_query(request: Request) -> ResultQuery:
+    query = getattr(request.app.state, "result_query", None)
+    if query is None:
+        raise HTTPException(status_code=503, detail={"message": "未开启结果落库(RESULT_STORE_ENABLED)"})
+    return query
 
-async def get_dialogue_monitor():
-    return DialogueMonitor()
+def _timestamp(value: Optional[datetime]) -> Optional[float]:
+    return value.timestamp() if value is not None else None
+
+async def persist_result(
+    writer: Optional[ResultWriter],
+    endpoint: str,
+    session_id: str,
+    result: MonitoringResult,
+    monitor_result: dict,
+    total_latency: float,
+    trace: Optional[list] = None,
+    turns: Optional[int] = None
+):
+    """把结果放进落库队列（不等待写入）"""
+    if writer is None:
+        return
+    await writer.submit(result_record(
+        endpoint,
+        session_id,
+        result,
+        monitor_result.get("stage_latencies", {}),
+        total_latency,
+        trace,
+        turns
+    ))
+
+def merge_results(security_check: dict, monitor_result: dict) -> MonitoringResult:
+    """合并安全检查和对话监控的结果"""
+    with STAGE_LATENCY.time(stage="merge"):
+        result = _merge_results(security_check, monitor_result)
+    RESULTS.inc(status=result.status, risk_level=result.risk_level)
+    for anomaly in result.anomalies:
+        ANOMALIES.inc(type=anomaly.type, severity=anomaly.severity)
+    return result
+
+def _merge_results(security_check: dict, monitor_result: dict) -> MonitoringResult:
+    if security_check.get("severity") == "high":
+        return MonitoringResult(
+            status="alert",
+            anomalies=[{
+                "type": "security",
+                "severity": "high",
+                "description": security_check.get("description", "检测到严重的安全问题"),
+            }],
+            risk_level="high",
+            security_status=security_check,
+            triage=monitor_result.get("triage"),
+            skipped_detectors=monitor_result.get("skipped_detectors", []),
+            reused_verdicts=monitor_result.get("reused_verdicts", [])
+        )
+
+    if security_check.get("has_issues"):
+        monitor_result["anomalies"].append({
+            "type": "security",
+            "severity": security_check["severity"],
+            "description": security_check["description"],
+        })
+        
+        if security_check["severity"] == "medium" and monitor_result["risk_level"] != "high":
+            monitor_result["risk_level"] = "medium"
+            
+    monitor_result["security_status"] = security_check
+    return MonitoringResult(**monitor_result)
 
 @router.post("/monitor", response_model=MonitoringResult)
 async def monitor_dialogue(
     dialogue: DialogueInput,
-    security_manager: SecurityManager = Depends(get_security_manager),
-    dialogue_monitor: DialogueMonitor = Depends(get_dialogue_monitor)
+    pipeline: MonitorPipeline = Depends(get_pipeline),
+    writer: Optional[ResultWriter] = Depends(get_result_writer)
 ):
-    start_time = time.time()
+    start_time = time.perf_counter()
+    trace = []
+    call_trace.set(trace)
     try:
-        # 记录各个阶段的时间
-        security_start = time.time()
-        security_check, monitor_result = await asyncio.gather(
-            security_manager.check_dialogue_safety(
-                dialogue.conversation_history,
-                dialogue.session_id
-            ),
-            dialogue_monitor.analyze(dialogue.conversation_history)
+        security_check, monitor_result = await pipeline.run(
+            dialogue.conversation_history,
+            dialogue.session_id
         )
-        security_end = time.time()
-        
-        processing_start = time.time()
-        if security_check.get("severity") == "high":
-            result = MonitoringResult(
-                status="alert",
-                anomalies=[{
-                    "type": "security",
-                    "severity": "high",
-                    "description": security_check.get("description", "检测到严重的安全问题"),
-                }],
-                risk_level="high",
-                security_status=security_check
-            )
-        else:
-            if security_check.get("has_issues"):
-                monitor_result["anomalies"].append({
-                    "type": "security",
-                    "severity": security_check["severity"],
-                    "description": security_check["description"],
-                })
-                
-                if security_check["severity"] == "medium" and monitor_result["risk_level"] != "high":
-                    monitor_result["risk_level"] = "medium"
-                    
-            monitor_result["security_status"] = security_check
-            result = MonitoringResult(**monitor_result)
-        
-        # 计算各阶段耗时
-        end_time = time.time()
-        performance_metrics = {
-            "total_latency": round(end_time - start_time, 2),
-            "security_check_latency": round(security_end - security_start, 2),
-            "processing_latency": round(end_time - processing_start, 2),
-            "timestamp": datetime.now().isoformat()
-        }
+        result = merge_results(security_check, monitor_result)
 
-        print(f"性能指标: {performance_metrics}")
-        
-        return MonitoringResult(**monitor_result)
+        # 各阶段耗时见 /metrics，这里只在debug日志里保留单个请求的上游调用明细
+        total_latency = time.perf_counter() - start_time
+        REQUEST_LATENCY.observe(total_latency, endpoint="monitor")
+        logger.debug("session=%s total_latency=%.3f upstream_calls=%s", dialogue.session_id, total_latency, trace)
+        await persist_result(
+            writer, "monitor", dialogue.session_id, result, monitor_result, total_latency, trace,
+            len(dialogue.conversation_history)
+        )
+
+        return result
         
     except Exception as e:
         raise HTTPException(
@@ -104,6 +173,200 @@ async def monitor_dialogue(
             }
         )
 
+def partial_result(detector: str, payload, dialogue_monitor: DialogueMonitor) -> dict:
+    """单个检测器完成时推送给客户端的部分结果"""
+    if detector == "security":
+        return {
+            "detector": detector,
+            "risk_level": payload.get("severity", "low") if payload.get("has_issues") else "low",
+            "security_status": payload,
+        }
+    return {
+        "detector": detector,
+        "risk_level": dialogue_monitor._determine_risk_level(payload) if payload else "low",
+        "anomalies": [AnomalyDetail(**issue).model_dump() for issue in payload],
+    }
+
+@router.post("/monitor/stream")
+async def monitor_dialogue_stream(
+    dialogue: DialogueInput,
+    format: str = "sse",
+    pipeline: MonitorPipeline = Depends(get_pipeline),
+    writer: Optional[ResultWriter] = Depends(get_result_writer)
+):
+    """
+    流式监控：每个检测器完成后立即推送其结果(event=检测器名称)，
+    最后推送合并后的MonitoringResult(event=result)。format=ndjson 时每行一个JSON。
+    """
+    async def events():
+        start_time = time.perf_counter()
+        try:
+            async for event, payload in pipeline.stream(dialogue.conversation_history, dialogue.session_id):
+                if event == "final":
+                    result = merge_results(*payload)
+                    total_latency = time.perf_counter() - start_time
+                    REQUEST_LATENCY.observe(total_latency, endpoint="stream")
+                    yield "result", result.model_dump()
+                    await persist_result(
+                        writer, "stream", dialogue.session_id, result, payload[1], total_latency,
+                        turns=len(dialogue.conversation_history)
+                    )
+                else:
+                    yield event, partial_result(event, payload, pipeline.dialogue_monitor)
+        except Exception as e:
+            yield "error", {"error": str(e), "message": "监控过程中出现错误", "session_id": dialogue.session_id}
+
+    if format == "ndjson":
+        async def ndjson():
+            async for event, data in events():
+                yield json.dumps({"event": event, "data": data}, ensure_ascii=False, default=str) + "\n"
+        return StreamingResponse(ndjson(), media_type="application/x-ndjson")
+
+    async def sse():
+        async for event, data in events():
+            yield {"event": event, "data": json.dumps(data, ensure_ascii=False, default=str)}
+    return EventSourceResponse(sse())
+
+async def _run_batch(batch: BatchDialogueInput, pipeline: MonitorPipeline, writer: Optional[ResultWriter] = None):
+    """按完成顺序产出每条对话的结果；单条失败不影响其它条目"""
+    concurrency = min(batch.max_concurrency or settings.BATCH_MAX_CONCURRENCY, settings.BATCH_MAX_CONCURRENCY)
+    # 所有条目的检测器请求共享同一个并发上限（ContextVar会被下面创建的task继承）
+    call_limiter.set(asyncio.Semaphore(max(concurrency, 1)))
+
+    async def run_item(index: int, dialogue: DialogueInput) -> BatchItemResult:
+        start_time = time.perf_counter()
+        try:
+            security_check, monitor_result = await pipeline.run(
+                dialogue.conversation_history,
+                dialogue.session_id
+            )
+            result = merge_results(security_check, monitor_result)
+            total_latency = time.perf_counter() - start_time
+            REQUEST_LATENCY.observe(total_latency, endpoint="batch_item")
+            await persist_result(
+                writer, "batch", dialogue.session_id, result, monitor_result, total_latency,
+                turns=len(dialogue.conversation_history)
+            )
+            return BatchItemResult(index=index, session_id=dialogue.session_id, result=result)
+        except Exception as e:
+            return BatchItemResult(index=index, session_id=dialogue.session_id, error=str(e))
+
+    tasks = [asyncio.create_task(run_item(i, item)) for i, item in enumerate(batch.items)]
+    try:
+        for future in asyncio.as_completed(tasks):
+            yield await future
+    finally:
+        # 客户端断开流式响应时取消剩余的条目
+        for task in tasks:
+            task.cancel()
+
+@router.post("/monitor/batch", response_model=BatchMonitoringResult)
+async def monitor_batch(
+    batch: BatchDialogueInput,
+    stream: bool = False,
+    pipeline: MonitorPipeline = Depends(get_pipeline),
+    writer: Optional[ResultWriter] = Depends(get_result_writer)
+):
+    """批量监控；stream=true 时按完成顺序以NDJSON逐条返回"""
+    if len(batch.items) > settings.BATCH_MAX_ITEMS:
+        raise HTTPException(
+            status_code=413,
+            detail={"message": f"单次最多提交{settings.BATCH_MAX_ITEMS}条对话", "items": len(batch.items)}
+        )
+
+    if stream:
+        async def ndjson():
+            async for item in _run_batch(batch, pipeline, writer):
+                yield item.model_dump_json() + "\n"
+        return StreamingResponse(ndjson(), media_type="application/x-ndjson")
+
+    results = [item async for item in _run_batch(batch, pipeline, writer)]
+    results.sort(key=lambda item: item.index)
+    return BatchMonitoringResult(results=results)
+
+@router.get("/results")
+async def list_results(
+    session_id: Optional[str] = None,
+    risk_level: Optional[str] = None,
+    anomaly_type: Optional[str] = None,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    limit: int = Query(100, ge=1, le=1000),
+    cursor: Optional[str] = None,
+    query: ResultQuery = Depends(get_result_query)
+):
+    """
+    查询已落库的监控结果，按时间倒序；session_id给出单个会话的风险时间线。
+    返回的next_cursor作为下一页的cursor参数，为null时没有更多结果。
+    """
+    try:
+        return await query.results(
+            session_id=session_id,
+            risk_level=risk_level,
+            anomaly_type=anomaly_type,
+            since=_timestamp(since),
+            until=_timestamp(until),
+            limit=limit,
+            cursor=cursor
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail={"message": str(e)})
+
+@router.get("/results/escalations")
+async def list_escalations(
+    to_level: str = "high",
+    from_level: Optional[List[str]] = Query(None),
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    limit: int = Query(100, ge=1, le=1000),
+    cursor: Optional[str] = None,
+    query: ResultQuery = Depends(get_result_query)
+):
+    """风险等级升级的结果（与同一会话的上一条结论相比），如 from_level=low&to_level=high&since=..."""
+    levels = [to_level] + (from_level or [])
+    if any(level not in RISK_LEVELS for level in levels):
+        raise HTTPException(status_code=400, detail={"message": f"风险等级应为 {RISK_LEVELS}"})
+    try:
+        return await query.escalations(
+            to_level=to_level,
+            from_levels=from_level,
+            since=_timestamp(since),
+            until=_timestamp(until),
+            limit=limit,
+            cursor=cursor
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail={"message": str(e)})
+
+@router.post("/results/latest")
+async def latest_results(body: LatestVerdictQuery, query: ResultQuery = Depends(get_result_query)):
+    """批量查询每个session最新的一条结论"""
+    if len(body.session_ids) > settings.RESULT_LATEST_MAX_IDS:
+        raise HTTPException(
+            status_code=413,
+            detail={"message": f"单次最多查询{settings.RESULT_LATEST_MAX_IDS}个session", "items": len(body.session_ids)}
+        )
+    found = await query.latest(body.session_ids)
+    return {
+        "results": found,
+        "missing": [session_id for session_id in dict.fromkeys(body.session_ids) if session_id not in found],
+    }
+
+@router.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    """Prometheus文本格式的指标；多个worker时为所有worker合并后的值"""
+    if settings.METRICS_MULTIPROC_DIR:
+        return PlainTextResponse(
+            REGISTRY.render_multiprocess(settings.METRICS_MULTIPROC_DIR), media_type="text/plain; version=0.0.4"
+        )
+    return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4")
+
+@router.get("/upstreams")
+async def upstreams(request: Request):
+    """各上游端点的熔断状态、在途请求数和EWMA延迟"""
+    upstream_router = getattr(request.app.state.llm_client, "router", None)
+    return {"endpoints": upstream_router.status() if upstream_router is not None else []}
+
 @router.get("/health")
 async def health_check():
     return {"status": "healthy"}
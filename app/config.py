@@ -1,3 +1,4 @@
+from typing import Dict, List, Optional
 from pydantic_settings import BaseSettings
 
 class Settings(BaseSettings):
@@ -13,6 +14,150 @@ class Settings(BaseSettings):
     TEMPERATURE: float = 0.1 # default temperature
 
     MODEL_NAME: str = "deepseek-chat" # default model, choose from [chatglm2-6B, deepseek-chat, ...]
+    LLM_BACKEND: str = "openai" # choose from [openai, local]; local在进程内加载模型，不经过HTTP
+    ANALYSIS_MODE: str = "split" # choose from [split, fused]; fused把四个检测合并为一次LLM请求
+    # 提前结束策略，"异常类型:严重程度"：命中后取消其余还在进行的检测器，如 ["security:high", "risk:high"]
+    EARLY_STOP_RULES: List[str] = ["security:high"]
+    # 各检测器的截止时间(秒)，超时的检测器被取消并在skipped_detectors中记为timed_out，0为不限制
+    DETECTOR_DEADLINES: Dict[str, float] = {"security": 20.0, "emotional": 20.0, "behavioral": 30.0, "quality": 30.0, "fused": 40.0}
+    DETECTOR_DEFAULT_DEADLINE: float = 30.0 # 未单独配置的检测器的截止时间(秒)
+    BATCH_MAX_ITEMS: int = 1000 # /monitor/batch 单次最多的对话数
+    BATCH_MAX_CONCURRENCY: int = 32 # /monitor/batch 同时进行的上游LLM请求数上限
+    # 约束解码，choose from [auto, json_schema, guided_json, json_object, none]
+    # auto: OpenAI用json_schema，本地vLLM用guided_json，其它用json_object
+    STRUCTURED_OUTPUT: str = "auto"
+    # 各检测器的输出token上限（配合紧凑的输出schema），约为schema允许的最长输出(output_token_budget)的1.25倍
+    OUTPUT_MAX_TOKENS: Dict[str, int] = {
+        "security": 550, "emotional": 480, "behavioral": 950, "quality": 950, "fused": 2850
+    }
+
+    ############################################################
+    # 多个上游端点（为空时按 BASE_URL/DEEPSEEK_API_KEY/OPENAI_API_KEY 只用一个端点）
+    # 每项: {"name", "base_url", "api_key", "model", "provider", "weight", "priority", "max_inflight"}，只有base_url或provider是必需的
+    # 如 [{"name": "vllm-1", "base_url": "http://10.0.0.1:8000/v1", "weight": 2},
+    #     {"name": "vllm-2", "base_url": "http://10.0.0.2:8000/v1", "weight": 2},
+    #     {"name": "deepseek", "provider": "deepseek", "model": "deepseek-chat", "priority": 1}]
+    # priority大的端点只在前面的端点熔断或在途请求打满时使用
+    LLM_ENDPOINTS: List[Dict] = []
+    ROUTER_STRATEGY: str = "least_outstanding" # choose from [least_outstanding, ewma]
+    ROUTER_EWMA_ALPHA: float = 0.3 # EWMA延迟的平滑系数
+    ROUTER_ENDPOINT_RETRIES: int = 1 # 单个端点上的重试次数，超过后切换到下一个端点
+    ROUTER_FAILURE_THRESHOLD: int = 3 # 连续失败多少次后熔断
+    ROUTER_OPEN_SECONDS: float = 30.0 # 熔断后多久进入半开状态(秒)
+    ROUTER_HEALTH_INTERVAL: float = 10.0 # 健康检查间隔(秒)，0为不检查
+    ROUTER_HEALTH_TIMEOUT: float = 5.0 # 健康检查超时(秒)
+    # 对冲请求：某个检测器的请求超过其近期延迟的分位数仍未返回时，向另一个端点再发一份，取先返回的结果（需要至少两个端点）
+    HEDGE_ENABLED: bool = False
+    HEDGE_QUANTILE: float = 0.95 # 发出对冲请求的延迟分位数
+    HEDGE_BUDGET: float = 0.05 # 对冲请求最多占总请求数的比例
+    HEDGE_MIN_SAMPLES: int = 20 # 延迟样本数少于该值时不对冲
+    HEDGE_WINDOW: int = 200 # 每个检测器保留的最近延迟样本数
+
+    ############################################################
+    # 进程内推理后端 (LLM_BACKEND=local)
+    LOCAL_MODEL_PATH: str = "" # transformers模型名称或路径
+    LOCAL_DEVICE: str = "cpu" # cpu / cuda
+    LOCAL_DTYPE: str = "auto" # choose from [auto, fp32, bf16, fp16]
+    LOCAL_QUANTIZE: str = "none" # choose from [none, int8]; int8只支持CPU
+    LOCAL_THREADS: int = 0 # torch线程数，0为默认
+    LOCAL_MAX_BATCH_SIZE: int = 8 # 每次批量生成最多合并的prompt数
+    LOCAL_BATCH_WAIT_MS: float = 10.0 # 收集一批prompt的时间窗口(毫秒)
+
+    ############################################################
+    # 上游HTTP连接池（整个应用共享一个client）
+    HTTP_MAX_CONNECTIONS: int = 100 # 连接池最大连接数
+    HTTP_MAX_KEEPALIVE_CONNECTIONS: int = 20 # 保持空闲的长连接数
+    HTTP_KEEPALIVE_EXPIRY: float = 60.0 # 空闲长连接保留时间(秒)
+    HTTP_HTTP2: bool = False # 是否启用HTTP/2 (需要安装h2)
+    HTTP_TIMEOUT: float = 60.0 # 单次请求超时(秒)
+    HTTP_CONNECT_TIMEOUT: float = 10.0 # 建立连接超时(秒)
+
+    ############################################################
+    # 上游准入控制，不设置时按服务商(openai/deepseek/local)使用默认值
+    UPSTREAM_RPS: Optional[float] = None # 每秒请求数，0为不限制
+    UPSTREAM_TPM: Optional[int] = None # 每分钟token数，0为不限制
+    UPSTREAM_MAX_INFLIGHT: Optional[int] = None # 最大在途请求数
+    UPSTREAM_MAX_RETRIES: int = 3 # 429/5xx/连接错误的最大重试次数
+    UPSTREAM_BACKOFF_BASE: float = 0.5 # 指数退避的初始间隔(秒)
+    UPSTREAM_BACKOFF_MAX: float = 20.0 # 单次退避的上限(秒)
+    UPSTREAM_COMPLETION_TOKENS: int = 512 # 估算token配额时每次请求预留的输出token数
+    RATE_LIMIT_SQLITE_PATH: str = "" # 非空时令牌桶保存在该sqlite文件中，同一台机器上的多个worker共享上游配额
+
+    ############################################################
+    # 生产环境多进程部署(serve.py)
+    SERVE_HOST: str = "0.0.0.0"
+    SERVE_PORT: int = 8000
+    SERVE_WORKERS: int = 0 # worker进程数，0为CPU核数
+    SERVE_GRACEFUL_TIMEOUT: float = 30 # 退出时等待在途请求完成的最长时间(秒)
+    SERVE_STATE_DIR: str = "." # 多个worker共享的sqlite文件（结论缓存、令牌桶、会话状态）未配置时放在这个目录
+    METRICS_MULTIPROC_DIR: str = "" # 非空时各worker定期把指标写到该目录，/metrics 返回所有worker合并后的值；serve.py多worker时自动设置
+    METRICS_FLUSH_INTERVAL: float = 5.0 # 写入间隔(秒)，其他worker的指标最多滞后这么久
+
+    ############################################################
+    # 会话增量分析：同一session_id只分析新增的对话轮次
+    INCREMENTAL_ANALYSIS: bool = True
+    SESSION_STORE_BACKEND: str = "memory" # choose from [memory, sqlite]
+    SESSION_DB_PATH: str = "sessions.db" # sqlite后端的数据库文件
+    SESSION_TTL: float = 86400 # 会话状态过期时间(秒)
+    SESSION_MAX_SESSIONS: int = 10000 # 内存后端最多保存的会话数
+    SESSION_SUMMARY_MAX_CHARS: int = 1500 # 滚动摘要的最大字符数
+
+    ############################################################
+    # 监控结果落库（审计记录）：请求只入队，后台批量写入sqlite
+    RESULT_STORE_ENABLED: bool = True
+    RESULT_DB_PATH: str = "monitoring_results.db"
+    RESULT_QUEUE_SIZE: int = 10000 # 内存中等待落库的最大记录数
+    RESULT_BATCH_SIZE: int = 200 # 每个事务最多写入的记录数
+    RESULT_FLUSH_INTERVAL: float = 0.5 # 攒一批的最长等待时间(秒)
+    RESULT_QUEUE_PUT_TIMEOUT: float = 0.5 # 队列满时请求最多等待的时间(秒)，超时后丢弃该条记录；0为直接丢弃
+    RESULT_CLOSE_TIMEOUT: float = 5.0 # 关闭时等待写完队列的最长时间(秒)，超时后丢弃剩余记录
+    RESULT_LATEST_MAX_IDS: int = 10000 # /results/latest 单次最多查询的session数
+
+    ############################################################
+    # 检测器结论缓存：相同的对话（重试、重复提交）不再请求上游
+    CACHE_ENABLED: bool = True
+    CACHE_MAX_ENTRIES: int = 10000
+    CACHE_MAX_BYTES: int = 64 * 1024 * 1024
+    CACHE_TTL: float = 3600 # 缓存过期时间(秒)
+    CACHE_SQLITE_PATH: str = "" # 非空时启用sqlite持久层，如 "verdict_cache.db"
+    CACHE_SQLITE_PURGE_INTERVAL: float = 600 # 写入时删除sqlite中过期行的最小间隔(秒)
+
+    ############################################################
+    # 近似重复对话复用结论：模板化的开场、同一段话粘贴到新会话时，精确缓存无法命中
+    NEAR_DUP_ENABLED: bool = False
+    NEAR_DUP_THRESHOLD: float = 0.9 # 估计的Jaccard相似度不低于该值时复用此前的结论
+    NEAR_DUP_DETECTORS: List[str] = ["emotional", "behavioral", "quality"] # 允许复用结论的检测器；安全检查和融合检测默认不复用
+    NEAR_DUP_NUM_PERM: int = 64 # MinHash签名维数
+    NEAR_DUP_BANDS: int = 8 # LSH分桶数，需整除NUM_PERM；每桶行数越多候选越少
+    NEAR_DUP_SHINGLE: int = 4 # 字符shingle长度
+    NEAR_DUP_MAX_ENTRIES: int = 20000
+    NEAR_DUP_TTL: float = 3600 # 索引条目过期时间(秒)
+
+    ############################################################
+    # 本地敏感信息预检（在安全检查的LLM请求之前运行）
+    PII_PRESCREEN_ENABLED: bool = True
+    PII_SHORT_CIRCUIT_TYPES: List[str] = ["id_card", "bank_card"] # 命中这些类型直接判定为high，不再请求LLM
+    PII_LEXICON_PATH: str = "" # 自定义敏感词表JSON: {"类别": ["关键词", ...]}
+
+    ############################################################
+    # 本地分诊：低风险的闲聊跳过情绪/行为/质量三个LLM检测
+    TRIAGE_ENABLED: bool = False
+    TRIAGE_MODEL_PATH: str = "" # n-gram打分器权重(.npz)，用 python -m app.core.triage 训练
+    TRIAGE_SCORE_THRESHOLD: float = 0.3 # 打分器分数不低于该值时走完整分析
+    TRIAGE_NEGATIVE_HITS: int = 2 # 负面情绪词命中次数阈值
+    TRIAGE_MAX_USER_CHARS: int = 200 # 用户消息总长度超过该值时走完整分析
+    TRIAGE_REPETITION_RATIO: float = 0.5 # 用户重复消息占比阈值
+
+    ############################################################
+    # 上下文窗口：按token预算裁剪发给各检测器的对话（vLLM部署时 --max-model-len 16384）
+    CONTEXT_WINDOW_ENABLED: bool = True
+    CONTEXT_TOKENIZER: str = "" # 本地tokenizer(transformers)名称或路径，为空时按字符估算
+    CONTEXT_DEFAULT_BUDGET: int = 12000 # 未单独配置的检测器的对话token预算
+    # 各检测器的对话token预算；行为检测主要看最近的交互，预算较小
+    CONTEXT_BUDGETS: Dict[str, int] = {"behavioral": 4000}
+    CONTEXT_SUMMARY_TOKENS: int = 800 # 较早轮次压缩摘要的token上限
+    CONTEXT_MIN_RECENT_TURNS: int = 2 # 至少原样保留的最近轮次数
+    CONTEXT_SUMMARY_CACHE_SIZE: int = 1024 # 摘要缓存的条目数
 
     ############################################################
     
@@ -0,0 +1,149 @@
+import asyncio
+import hashlib
+import json
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional
+from app.config import settings
+
+
+class VerdictCache:
+    """
+    检测器结论缓存，key为(detector, system prompt, 对话文本, model, temperature)的内容哈希。
+    内存层按条数和字节数限制，LRU + TTL淘汰；可选一个sqlite持久层（aiosqlite），
+    写入时每隔purge_interval秒删除一次过期的行，避免数据库文件无限增长。
+    """
+
+    def __init__(
+        self,
+        max_entries: int = 10000,
+        max_bytes: int = 64 * 1024 * 1024,
+        ttl: float = 3600,
+        sqlite_path: str = "",
+        purge_interval: float = 600
+    ):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.sqlite_path = sqlite_path
+        self.purge_interval = purge_interval
+        # key -> (过期时间, 序列化后的结论)，保存字符串可以避免调用方修改缓存里的对象
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._bytes = 0
+        self._db = None
+        # 并发的第一次访问只建立一个连接
+        self._connect_lock = asyncio.Lock()
+        self._last_purge = time.time()
+        self.hits = 0
+        self.misses = 0
+        self.persistent_hits = 0
+        self.evictions = 0
+        self.purged = 0
+
+    @classmethod
+    def from_settings(cls) -> "VerdictCache":
+        return cls(
+            max_entries=settings.CACHE_MAX_ENTRIES,
+            max_bytes=settings.CACHE_MAX_BYTES,
+            ttl=settings.CACHE_TTL,
+            sqlite_path=settings.CACHE_SQLITE_PATH,
+            purge_interval=settings.CACHE_SQLITE_PURGE_INTERVAL
+        )
+
+    @staticmethod
+    def make_key(detector: str, messages: List[Dict], model: str, temperature: float) -> str:
+        payload = json.dumps(
+            [detector, [(m["role"], m["content"]) for m in messages], model, temperature],
+            ensure_ascii=False
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    async def get(self, key: str) -> Optional[Dict]:
+        entry = self._entries.get(key)
+        if entry is not None:
+            expires_at, value = entry
+            if expires_at > time.time():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return json.loads(value)
+            self._remove(key)
+
+        if self.sqlite_path:
+            db = await self._connect()
+            async with db.execute(
+                "SELECT value, expires_at FROM verdict_cache WHERE key = ? AND expires_at > ?",
+                (key, time.time())
+            ) as cursor:
+                row = await cursor.fetchone()
+            if row:
+                self._put(key, row[0], row[1])
+                self.hits += 1
+                self.persistent_hits += 1
+                return json.loads(row[0])
+
+        self.misses += 1
+        return None
+
+    async def set(self, key: str, value: Dict):
+        serialized = json.dumps(value, ensure_ascii=False)
+        expires_at = time.time() + self.ttl
+        self._put(key, serialized, expires_at)
+        if self.sqlite_path:
+            db = await self._connect()
+            await db.execute(
+                "INSERT OR REPLACE INTO verdict_cache (key, value, expires_at) VALUES (?, ?, ?)",
+                (key, serialized, expires_at)
+            )
+            now = time.time()
+            if now - self._last_purge >= self.purge_interval:
+                self._last_purge = now
+                cursor = await db.execute("DELETE FROM verdict_cache WHERE expires_at <= ?", (now,))
+                self.purged += cursor.rowcount
+            await db.commit()
+
+    def stats(self) -> Dict:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "persistent_hits": self.persistent_hits,
+            "evictions": self.evictions,
+            "purged": self.purged,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0,
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+        }
+
+    async def close(self):
+        if self._db is not None:
+            await self._db.close()
+            self._db = None
+
+    def _put(self, key: str, serialized: str, expires_at: float):
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (expires_at, serialized)
+        self._bytes += len(serialized)
+        while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+            self.evictions += 1
+
+    def _remove(self, key: str):
+        _, serialized = self._entries.pop(key)
+        self._bytes -= len(serialized)
+
+    async def _connect(self):
+        async with self._connect_lock:
+            if self._db is None:
+                import aiosqlite
+                db = await aiosqlite.connect(self.sqlite_path)
+                await db.execute("PRAGMA journal_mode=WAL")
+                await db.execute(
+                    "CREATE TABLE IF NOT EXISTS verdict_cache ("
+                    "key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL)"
+                )
+                await db.execute("CREATE INDEX IF NOT EXISTS verdict_cache_expires ON verdict_cache (expires_at)")
+                await db.commit()
+                self._db = db
+        return self._db
@@ -0,0 +1,180 @@
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional
+from app.config import settings
+from app.core.metrics import CONTEXT_TRUNCATIONS
+from app.core.pii import AhoCorasick
+from app.core.rate_limit import estimate_text_tokens
+from app.core.session_store import conversation_fingerprint
+from app.core.triage import CRISIS_LEXICON, NEGATIVE_LEXICON
+
+
+def load_token_counter(name: str = "") -> Callable[[str], int]:
+    """有本地tokenizer时精确计数，否则使用字符估算"""
+    if not name:
+        return estimate_text_tokens
+    from transformers import AutoTokenizer
+    tokenizer = AutoTokenizer.from_pretrained(name)
+    return lambda text: len(tokenizer.encode(text, add_special_tokens=False))
+
+
+def _line(msg) -> str:
+    return f"{msg.role}: {msg.content}\n"
+
+
+class ContextWindow:
+    """
+    按token预算裁剪发给检测器的对话：
+    最近的轮次原样保留，较早的轮次压缩为摘要（按内容缓存），带有风险关键词的用户发言始终原样保留。
+    对话没有超出预算时原样返回。
+    """
+
+    def __init__(
+        self,
+        budgets: Optional[Dict[str, int]] = None,
+        default_budget: int = 12000,
+        summary_tokens: int = 800,
+        min_recent_turns: int = 2,
+        cache_size: int = 1024,
+        count_tokens: Callable[[str], int] = estimate_text_tokens
+    ):
+        self.budgets = budgets or {}
+        self.default_budget = default_budget
+        self.summary_tokens = summary_tokens
+        self.min_recent_turns = min_recent_turns
+        self.cache_size = cache_size
+        self.count_tokens = count_tokens
+        self.risk_keywords = AhoCorasick((w, "risk") for w in CRISIS_LEXICON + NEGATIVE_LEXICON)
+        self._summaries: "OrderedDict[str, str]" = OrderedDict()
+        # 摘要和风险发言的小标题、段落之间的空行也占预算
+        self._header_tokens = count_tokens(
+            "【较早对话摘要】(共99999条，已压缩)\n\n\n【较早的风险相关用户发言(原文)】\n\n【最近对话】\n"
+        )
+        self._omitted_tokens = count_tokens("…(更早的99999条已省略)") + 1
+
+    @classmethod
+    def from_settings(cls) -> "ContextWindow":
+        return cls(
+            budgets=settings.CONTEXT_BUDGETS if settings.CONTEXT_WINDOW_ENABLED else {},
+            default_budget=settings.CONTEXT_DEFAULT_BUDGET if settings.CONTEXT_WINDOW_ENABLED else 0,
+            summary_tokens=settings.CONTEXT_SUMMARY_TOKENS,
+            min_recent_turns=settings.CONTEXT_MIN_RECENT_TURNS,
+            cache_size=settings.CONTEXT_SUMMARY_CACHE_SIZE,
+            count_tokens=load_token_counter(settings.CONTEXT_TOKENIZER)
+        )
+
+    def budget(self, detector: str) -> int:
+        return self.budgets.get(detector, self.default_budget)
+
+    def render(self, detector: str, messages: List, reserved: int = 0) -> str:
+        """
+        生成检测器的对话文本；reserved为同一prompt中其它内容（如增量模式的摘要和此前结论）已占用的token数。
+        预算<=0表示不限制。
+        """
+        lines = [_line(msg) for msg in messages]
+        budget = self.budget(detector)
+        if budget <= 0:
+            return "".join(lines)
+        budget = max(budget - reserved, 0)
+        costs = [self.count_tokens(line) for line in lines]
+        if sum(costs) <= budget:
+            return "".join(lines)
+
+        CONTEXT_TRUNCATIONS.inc(detector=detector)
+        budget = max(budget - self._header_tokens, 0)
+        verbatim_budget = max(budget - self.summary_tokens, 0)
+
+        # 1. 先为带风险关键词的用户发言预留预算（从新到旧，最多占一半）
+        risky: Dict[int, str] = {}
+        used = 0
+        risky_indices = [i for i, msg in enumerate(messages) if msg.role == "user" and self.is_risky(msg.content)]
+        for i in reversed(risky_indices):
+            if used + costs[i] <= verbatim_budget // 2:
+                risky[i] = lines[i]
+                used += costs[i]
+
+        # 2. 从最新的轮次往前原样保留；最少保留min_recent_turns轮，单条过长时截断
+        recent: Dict[int, str] = {}
+        split = len(lines)
+        for i in reversed(range(len(lines))):
+            if i in risky:
+                recent[i] = risky.pop(i)
+            elif used + costs[i] > verbatim_budget:
+                if len(recent) >= self.min_recent_turns:
+                    break
+                remaining = max(verbatim_budget - used, 0) // max(self.min_recent_turns - len(recent), 1)
+                recent[i] = self._truncate(messages[i], remaining)
+                used += remaining
+            else:
+                recent[i] = lines[i]
+                used += costs[i]
+            split = i
+
+        # 剩余预算再留给更早的风险发言
+        for i in reversed(risky_indices):
+            if i < split and i not in risky and used + costs[i] <= verbatim_budget:
+                risky[i] = lines[i]
+                used += costs[i]
+
+        # 3. 其余较早的轮次压缩为摘要
+        dropped = [messages[i] for i in range(split) if i not in risky]
+        summary = self.summarize(dropped, max(budget - used, 0))
+
+        parts = []
+        if summary:
+            parts.append(f"【较早对话摘要】(共{len(dropped)}条，已压缩)\n{summary}\n")
+        if risky:
+            parts.append("【较早的风险相关用户发言(原文)】\n" + "".join(risky[i] for i in sorted(risky)))
+        parts.append("【最近对话】\n" + "".join(recent[i] for i in sorted(recent)))
+        return "\n".join(parts)
+
+    def transcript(self, detector: str, conversation: List, session=None) -> str:
+        """检测器prompt中的对话部分；有会话上下文时由SessionContext决定全量还是增量"""
+        if session is not None:
+            return session.render(detector, window=self)
+        return self.render(detector, conversation)
+
+    def is_risky(self, text: str) -> bool:
+        return bool(self.risk_keywords.search(text))
+
+    def summarize(self, messages: List, max_tokens: int) -> str:
+        """抽取式摘要：每条消息只保留开头，超出预算时保留较新的部分；结果按内容缓存"""
+        if not messages or max_tokens <= 0:
+            return ""
+        key = f"{conversation_fingerprint(messages)}:{max_tokens}"
+        summary = self._summaries.get(key)
+        if summary is not None:
+            self._summaries.move_to_end(key)
+            return summary
+
+        lines = []
+        costs = []
+        used = 0
+        for msg in reversed(messages):
+            content = msg.content.replace("\n", " ")
+            if len(content) > 60:
+                content = content[:60] + "…"
+            line = f"{msg.role}: {content}"
+            cost = self.count_tokens(line) + 1
+            if used + cost > max_tokens:
+                # 省略提示也要放进预算，放不下时再让出较早的几行
+                while lines and used + self._omitted_tokens > max_tokens:
+                    lines.pop()
+                    used -= costs.pop()
+                if used + self._omitted_tokens <= max_tokens:
+                    lines.append(f"…(更早的{len(messages) - len(lines)}条已省略)")
+                break
+            lines.append(line)
+            costs.append(cost)
+            used += cost
+        summary = "\n".join(reversed(lines))
+
+        self._summaries[key] = summary
+        while len(self._summaries) > self.cache_size:
+            self._summaries.popitem(last=False)
+        return summary
+
+    def _truncate(self, msg, tokens: int) -> str:
+        """按token比例截断单条过长的消息，保留结尾（最新的内容）；tokens包含角色前缀和省略号"""
+        content_tokens = max(tokens - self.count_tokens(f"{msg.role}: …\n"), 0)
+        keep = int(len(msg.content) * content_tokens / max(self.count_tokens(msg.content), 1))
+        return f"{msg.role}: …{msg.content[-keep:] if keep else ''}\n"
@@ -0,0 +1,150 @@
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+from app.core.monitor import DialogueMonitor
+from app.core.security import SecurityManager
+from app.core.session_store import SessionContext
+
+
+FUSED_SYSTEM_PROMPT = """
+            你是一个心理健康对话的综合监督助手，监督用户和心理健康AI机器人的对话。请一次性完成以下分析：
+            1. 用户的情绪状态、自我伤害风险(比如自杀、自残等)和心理危机信号
+            2. 用户的行为模式（重复提问、攻击性言论、不合理请求、对AI的不信任）以及交互质量
+            3. AI回复的质量（是否符合用户期待、准确完整、表达得当、连贯合理）和内容安全
+            4. 对话的安全合规性（敏感个人信息、违法违规、色情歧视骚扰、数据安全、政治敏感）
+
+            请以JSON格式返回分析结果（按下面的字段顺序输出）：
+            {
+                "security": {
+                    "has_issues": bool,
+                    "requires_immediate_action": bool,
+                    "severity": "low|medium|high",
+                    "risk_types": [检测到的风险类型],
+                    "description": "详细描述",
+                    "recommendations": [建议措施]
+                },
+                "risk_assessment": {
+                    "has_risk": bool,
+                    "severity": "low|medium|high",
+                    "risk_types": [风险类型],
+                    "description": "描述",
+                    "suggestions": [建议心理健康AI机器人跟用户聊天时应该注意的事项, 30字以内]
+                },
+                "behavioral_issues": {
+                    "has_issues": bool,
+                    "severity": "low|medium|high",
+                    "patterns": [检测到的行为模式],
+                    "description": "描述",
+                    "suggestions": [建议, 30字以内]
+                },
+                "interaction_quality": {
+                    "is_problematic": bool,
+                    "severity": "low|medium|high",
+                    "issues": [交互问题],
+                    "description": "描述",
+                    "suggestions": [建议, 30字以内]
+                },
+                "response_quality": {
+                    "has_issues": bool,
+                    "severity": "low|medium|high",
+                    "issues": [质量问题],
+                    "description": "描述",
+                    "suggestions": [建议, 30字以内]
+                },
+                "content_safety": {
+                    "has_issues": bool,
+                    "severity": "low|medium|high",
+                    "issues": [安全问题],
+                    "description": "描述",
+                    "suggestions": [建议, 30字以内]
+                }
+            }
+            用户和AI的对话内容如下：
+            """
+
+
+class FusedAnalyzer:
+    """
+    融合模式：把情绪、行为、响应质量和安全四个检测合并成一次LLM请求，
+    再拆分回DialogueMonitor/SecurityManager原来的结果格式。
+    """
+
+    def __init__(self, dialogue_monitor: DialogueMonitor, security_manager: SecurityManager):
+        self.monitor = dialogue_monitor
+        self.security = security_manager
+        self.client = dialogue_monitor.client
+
+    async def analyze(
+        self,
+        conversation: List[Dict],
+        session_id: str,
+        session: Optional[SessionContext] = None
+    ) -> Tuple[Dict, Dict]:
+        """返回 (security_check, monitor_result)，格式与非融合模式一致"""
+        if session is not None and session.unchanged and session.previous("security"):
+            # 对话没有新增内容，直接复用上次的结论
+            security_check = dict(session.previous("security"))
+            security_check["timestamp"] = datetime.now().isoformat()
+            monitor_result = self.monitor.build_result(
+                session.previous("emotional") or [],
+                session.previous("behavioral") or [],
+                session.previous("quality") or []
+            )
+            return security_check, monitor_result
+
+        decision = self.monitor.triage_decision(conversation, session)
+        if decision is not None and decision["tier"] == "skip":
+            # 低风险对话只做安全检查
+            security_check = await self.security.check_dialogue_safety(conversation, session_id, session)
+            return security_check, self.monitor.skipped_result(decision, session)
+
+        findings = self.security.prescreen(conversation, session)
+        cont = self.monitor.window.transcript("fused", conversation, session)
+        if findings:
+            cont += "\n" + self.security.scanner.to_hint(findings)
+        messages = [
+            {"role": "system", "content": FUSED_SYSTEM_PROMPT},
+            {"role": "user", "content": cont}
+        ]
+
+        try:
+            analysis = await self.client.generate_json(
+                messages=messages,
+                detector="fused",
+                temperature=0.1
+            )
+            emotional_issues = self.monitor._emotional_issues(analysis)
+            behavioral_issues = self.monitor._behavioral_issues(analysis)
+            quality_issues = self.monitor._quality_issues(analysis)
+            if findings and self.security.scanner.is_decisive(findings):
+                # 本地预检的决定性结论优先于LLM的安全判断
+                security_check = self.security.scanner.to_verdict(findings, session_id)
+            else:
+                security_check = self.security.finalize(analysis["security"], session_id)
+                if findings:
+                    security_check["local_findings"] = findings
+        except Exception as e:
+            if session is not None:
+                session.failed = True
+            error = {
+                "type": "system",
+                "severity": "low",
+                "description": f"融合分析过程中出现错误: {str(e)}"
+            }
+            return self.security.error_result(e, session_id), self.monitor.build_result([error], [], [])
+
+        if session is not None:
+            session.record("emotional", emotional_issues)
+            session.record("behavioral", behavioral_issues)
+            session.record("quality", quality_issues)
+            session.record("security", security_check)
+            session.record("fused", {
+                "emotional": emotional_issues,
+                "behavioral": behavioral_issues,
+                "quality": quality_issues,
+                "security": {k: security_check.get(k) for k in ("has_issues", "severity", "risk_types", "description")}
+            })
+
+        monitor_result = self.monitor.build_result(emotional_issues, behavioral_issues, quality_issues)
+        if decision is not None:
+            monitor_result["triage"] = decision
+        return security_check, monitor_result
@@ -0,0 +1,312 @@
+import json
+import re
+from typing import Dict, Optional, Tuple
+from app.config import settings
+
+
+_JSON_FENCE = re.compile(r"```(?:json)?\s*(.*?)```", re.DOTALL)
+_FENCE_OPEN = re.compile(r"^```(?:json)?\s*")
+_decoder = json.JSONDecoder()
+
+# 模型有时会用中文或大写给出严重程度
+_SEVERITY_ALIASES = {"高": "high", "严重": "high", "中": "medium", "中等": "medium", "低": "low", "轻微": "low"}
+_TRUE = {"true", "yes", "是", "1"}
+_FALSE = {"false", "no", "否", "0", "none", "null", ""}
+
+
+############################################################
+# 紧凑的输出schema：限制列表条数和字符串长度，减少模型输出的token数
+
+def _object(properties: Dict) -> Dict:
+    return {"type": "object", "properties": properties, "required": list(properties), "additionalProperties": False}
+
+
+def _string(max_length: int) -> Dict:
+    return {"type": "string", "maxLength": max_length}
+
+
+def _strings(max_items: int, max_length: int) -> Dict:
+    return {"type": "array", "items": _string(max_length), "maxItems": max_items}
+
+
+BOOLEAN = {"type": "boolean"}
+SEVERITY = {"type": "string", "enum": ["low", "medium", "high"]}
+
+
+def _section(flag: str, list_field: str) -> Dict:
+    return _object({
+        flag: BOOLEAN,
+        "severity": SEVERITY,
+        list_field: _strings(5, 20),
+        "description": _string(100),
+        "suggestions": _strings(3, 30),
+    })
+
+
+# 布尔字段放在最前面：输出被max_tokens截断时，丢掉的是描述和建议而不是结论本身
+SECURITY_SCHEMA = _object({
+    "has_issues": BOOLEAN,
+    "requires_immediate_action": BOOLEAN,
+    "severity": SEVERITY,
+    "risk_types": _strings(5, 20),
+    "description": _string(150),
+    "recommendations": _strings(3, 30),
+})
+
+DETECTOR_SCHEMAS = {
+    "security": SECURITY_SCHEMA,
+    "emotional": _object({
+        "risk_assessment": _section("has_risk", "risk_types"),
+    }),
+    "behavioral": _object({
+        "behavioral_issues": _section("has_issues", "patterns"),
+        "interaction_quality": _section("is_problematic", "issues"),
+    }),
+    "quality": _object({
+        "response_quality": _section("has_issues", "issues"),
+        "content_safety": _section("has_issues", "issues"),
+    }),
+}
+DETECTOR_SCHEMAS["fused"] = _object({
+    "security": SECURITY_SCHEMA,
+    **DETECTOR_SCHEMAS["emotional"]["properties"],
+    **DETECTOR_SCHEMAS["behavioral"]["properties"],
+    **DETECTOR_SCHEMAS["quality"]["properties"],
+})
+
+
+def output_token_budget(schema: Dict) -> int:
+    """按schema估计最长输出的token数：字符串按每个字1个token，另加键名、引号和标点的开销"""
+    kind = schema.get("type")
+    if kind == "object":
+        return 2 + sum(len(name) // 3 + 3 + output_token_budget(sub) for name, sub in schema["properties"].items())
+    if kind == "array":
+        return 2 + schema.get("maxItems", 5) * (output_token_budget(schema["items"]) + 1)
+    if kind == "string":
+        return 3 if "enum" in schema else schema.get("maxLength", 50) + 2
+    return 2
+
+# OpenAI的strict模式不支持的关键字，发送前去掉（解析时仍然按完整schema校验）
+_OPENAI_UNSUPPORTED = ("maxLength", "maxItems")
+
+
+def _strip_keywords(schema, keywords):
+    if isinstance(schema, dict):
+        return {k: _strip_keywords(v, keywords) for k, v in schema.items() if k not in keywords}
+    if isinstance(schema, list):
+        return [_strip_keywords(v, keywords) for v in schema]
+    return schema
+
+
+def structured_output_params(detector: str, provider: str, mode: str = "auto") -> Dict:
+    """
+    生成约束解码的请求参数：
+    json_schema -> OpenAI的response_format json_schema；guided_json -> vLLM的extra_body guided_json；
+    json_object -> 只要求输出JSON；none -> 不加约束。auto按服务商选择。
+    """
+    schema = DETECTOR_SCHEMAS.get(detector)
+    if mode == "auto":
+        mode = {"openai": "json_schema", "local": "guided_json"}.get(provider, "json_object")
+    if schema is None and mode in ("json_schema", "guided_json"):
+        mode = "json_object"
+
+    if mode == "json_schema":
+        return {"response_format": {
+            "type": "json_schema",
+            "json_schema": {"name": detector, "strict": True, "schema": _strip_keywords(schema, _OPENAI_UNSUPPORTED)},
+        }}
+    if mode == "guided_json":
+        return {"extra_body": {"guided_json": schema}}
+    if mode == "json_object":
+        return {"response_format": {"type": "json_object"}}
+    return {}
+
+
+############################################################
+# 容错解析
+
+def _close_brackets(text: str) -> str:
+    """补全被截断的JSON：闭合未结束的字符串、去掉结尾的逗号、补齐括号"""
+    stack = []
+    in_string = False
+    escaped = False
+    for ch in text:
+        if in_string:
+            if escaped:
+                escaped = False
+            elif ch == "\\":
+                escaped = True
+            elif ch == '"':
+                in_string = False
+        elif ch == '"':
+            in_string = True
+        elif ch in "{[":
+            stack.append("}" if ch == "{" else "]")
+        elif ch in "}]" and stack:
+            stack.pop()
+    if in_string:
+        text += '"'
+    text = text.rstrip().rstrip(",")
+    if text.endswith(":"):
+        text += " null"
+    return text + "".join(reversed(stack))
+
+
+def _strip_trailing_commas(text: str) -> str:
+    """去掉 } 和 ] 之前多余的逗号；字符串里的内容原样保留"""
+    out = []
+    in_string = False
+    escaped = False
+    for i, ch in enumerate(text):
+        if in_string:
+            if escaped:
+                escaped = False
+            elif ch == "\\":
+                escaped = True
+            elif ch == '"':
+                in_string = False
+        elif ch == '"':
+            in_string = True
+        elif ch == ",":
+            rest = text[i + 1:].lstrip()
+            if rest[:1] in ("}", "]"):
+                continue
+        out.append(ch)
+    return "".join(out)
+
+
+def repair_json(text: str):
+    """解析LLM输出的JSON，依次尝试：直接解析、去掉```代码块、截取第一个对象、去掉多余逗号、补全截断"""
+    return _repair(text)[0]
+
+
+def _repair(text: str) -> Tuple[object, bool]:
+    """返回 (解析结果, 是否按截断补全过)"""
+    try:
+        return json.loads(text), False
+    except json.JSONDecodeError:
+        pass
+
+    text = text.strip()
+    if "```" in text:
+        match = _JSON_FENCE.search(text)
+        # 没有结尾```说明输出被截断
+        text = match.group(1).strip() if match else _FENCE_OPEN.sub("", text)
+    start = text.find("{")
+    if start < 0:
+        raise ValueError(f"模型输出中没有JSON对象: {text[:100]}")
+    text = _strip_trailing_commas(text[start:])
+    try:
+        # raw_decode忽略对象之后多余的文字
+        return _decoder.raw_decode(text)[0], False
+    except json.JSONDecodeError:
+        pass
+
+    # 输出被max_tokens截断：从末尾逐步回退到上一个逗号（或左括号之后），直到补全后可以解析
+    for _ in range(16):
+        try:
+            return json.loads(_close_brackets(text)), True
+        except json.JSONDecodeError:
+            cut = max(text.rfind(","), text.rfind("{") + 1, text.rfind("[") + 1)
+            if cut <= 0 or cut >= len(text):
+                break
+            text = text[:cut]
+    raise ValueError(f"无法修复模型输出的JSON: {text[:100]}")
+
+
+class JSONOutputParser:
+    """
+    按schema校验并规整LLM输出：布尔值/严重程度的常见写法会被转换，缺失的列表、描述和严重程度补默认值。
+    输出被截断时，缺失的布尔字段按"有问题"、缺失的严重程度按最高一档处理，结果中带 truncated: true，提示结论不完整需要复核。
+    """
+
+    def __init__(self, schema: Optional[Dict] = None):
+        self.schema = schema
+
+    def parse(self, text: str) -> Dict:
+        data, truncated = _repair(text)
+        if self.schema is None:
+            return data
+        result = self._coerce(self.schema, data, "$", truncated)
+        if truncated:
+            result["truncated"] = True
+        return result
+
+    def _coerce(self, schema: Dict, value, path: str, truncated: bool = False):
+        kind = schema.get("type")
+        if kind == "object":
+            if not isinstance(value, dict):
+                raise ValueError(f"{path} 应为对象")
+            result = dict(value)
+            for name, sub_schema in schema["properties"].items():
+                if name in value and value[name] is not None:
+                    result[name] = self._coerce(sub_schema, value[name], f"{path}.{name}", truncated)
+                else:
+                    result[name] = self._default(sub_schema, f"{path}.{name}", truncated)
+            return result
+        if kind == "array":
+            if isinstance(value, str):
+                value = [value] if value else []
+            if not isinstance(value, list):
+                raise ValueError(f"{path} 应为列表")
+            return [self._coerce(schema["items"], item, path, truncated) for item in value]
+        if kind == "boolean":
+            if isinstance(value, bool):
+                return value
+            text = str(value).strip().lower()
+            if text in _TRUE:
+                return True
+            if text in _FALSE:
+                return False
+            raise ValueError(f"{path} 应为布尔值: {value}")
+        if kind == "string":
+            if "enum" in schema:
+                text = str(value).strip()
+                text = _SEVERITY_ALIASES.get(text, text.lower())
+                if text not in schema["enum"]:
+                    # 截断在取值中间（如 "lo"）时按缺失处理
+                    if truncated:
+                        return self._default(schema, path, truncated)
+                    raise ValueError(f"{path} 取值应为 {schema['enum']}: {value}")
+                return text
+            return value if isinstance(value, str) else json.dumps(value, ensure_ascii=False)
+        return value
+
+    def _default(self, schema: Dict, path: str, truncated: bool = False):
+        kind = schema.get("type")
+        if kind == "array":
+            return []
+        if kind == "string":
+            # 没有给出严重程度时取最低一档（是否有问题由布尔字段决定）；
+            # 截断时按最高一档处理，避免把被截掉的结论当作低风险（enum按从低到高排列）
+            if "enum" in schema:
+                return schema["enum"][-1] if truncated else schema["enum"][0]
+            return "模型输出被截断，结论不完整，需要人工复核" if truncated else ""
+        if truncated and kind == "boolean":
+            # 截断丢掉了结论本身，不能当作没有问题
+            return True
+        if truncated and kind == "object":
+            return {
+                name: self._default(sub_schema, f"{path}.{name}", truncated)
+                for name, sub_schema in schema["properties"].items()
+            }
+        raise ValueError(f"模型输出缺少字段 {path}")
+
+
+PARSERS = {detector: JSONOutputParser(schema) for detector, schema in DETECTOR_SCHEMAS.items()}
+
+
+def get_parser(detector: Optional[str]) -> JSONOutputParser:
+    return PARSERS.get(detector) or JSONOutputParser()
+
+
+def output_params(detector: str) -> Dict:
+    """
+    某个检测器的输出token上限和约束解码的schema名称(structured_output)；
+    约束解码的具体参数和上游服务商有关，由客户端在选定端点后用structured_output_params生成
+    """
+    params = {"structured_output": detector}
+    max_tokens = settings.OUTPUT_MAX_TOKENS.get(detector)
+    if max_tokens:
+        params["max_tokens"] = max_tokens
+    return params
@@ -0,0 +1,388 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncIterator, Dict, Iterator, List, Optional, Tuple, Union
+
+
+def configure_cpu_threads(threads: int = 0, interop_threads: int = 0):
+    """设置torch的算子内/算子间线程数，0表示使用默认值；必须在加载模型、开始推理之前调用"""
+    import torch
+
+    if threads > 0:
+        torch.set_num_threads(threads)
+    if interop_threads > 0:
+        torch.set_num_interop_threads(interop_threads)
+
+
+def load_causal_lm(model_path: str, device: str = "cpu", dtype: str = "auto", quantize: str = "none"):
+    """
+    加载HF因果语言模型和tokenizer（ChatGLM等需要trust_remote_code）。
+    dtype: auto(GPU用fp16, CPU用fp32) / fp32 / bf16 / fp16；
+    quantize=int8 时对CPU上的Linear层做动态int8量化（需要fp32权重）。
+    """
+    import torch
+    from transformers import AutoModelForCausalLM, AutoTokenizer
+
+    on_cpu = not device.startswith("cuda")
+    if quantize == "int8" and not on_cpu:
+        raise ValueError("动态int8量化只支持CPU")
+    if dtype == "auto":
+        dtype = "fp32" if on_cpu else "fp16"
+    if quantize == "int8":
+        dtype = "fp32"
+    torch_dtype = {"fp32": torch.float32, "bf16": torch.bfloat16, "fp16": torch.float16}[dtype]
+
+    tokenizer = AutoTokenizer.from_pretrained(model_path, trust_remote_code=True)
+    model = AutoModelForCausalLM.from_pretrained(model_path, trust_remote_code=True, torch_dtype=torch_dtype)
+    model = model.to(device)
+    model.eval()
+    if quantize == "int8":
+        model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    return model, tokenizer
+
+
+class HFBatchGenerator:
+    """
+    对HF因果语言模型做批量生成：多个prompt左侧padding后一起调用generate，
+    每个解码步只做一次批量前向计算。
+    """
+
+    def __init__(self, model, tokenizer):
+        self.model = model
+        self.tokenizer = tokenizer
+        # 批量生成需要左侧padding，保证每条序列的最后一个token对齐
+        self.tokenizer.padding_side = "left"
+        if self.tokenizer.pad_token is None:
+            self.tokenizer.pad_token = self.tokenizer.eos_token
+        # 流式生成的解码步数，用于统计吞吐
+        self.stream_tokens = 0
+
+    @property
+    def device(self):
+        return next(self.model.parameters()).device
+
+    def warmup(self, max_new_tokens: int = 16, batch_size: int = 1) -> float:
+        """启动时先生成一次，触发权重加载、内存分配和算子初始化，返回耗时(秒)"""
+        start = time.monotonic()
+        self.generate([self.build_prompt("你好")] * batch_size, max_new_tokens)
+        return time.monotonic() - start
+
+    def build_prompt(self, query: str, history: Optional[List[List[str]]] = None, system: str = "") -> str:
+        """优先使用tokenizer自带的build_prompt(ChatGLM)或chat template，都没有时按简单的问答格式拼接"""
+        history = history or []
+        if hasattr(self.tokenizer, "build_prompt"):
+            return self.tokenizer.build_prompt(system + query, history)
+        if getattr(self.tokenizer, "chat_template", None):
+            messages = [{"role": "system", "content": system}] if system else []
+            for old_query, response in history:
+                messages.append({"role": "user", "content": old_query})
+                messages.append({"role": "assistant", "content": response})
+            messages.append({"role": "user", "content": query})
+            return self.tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+        prompt = system
+        for i, (old_query, response) in enumerate(history):
+            prompt += f"[Round {i + 1}]\n\n问：{old_query}\n\n答：{response}\n\n"
+        return prompt + f"[Round {len(history) + 1}]\n\n问：{query}\n\n答："
+
+    def build_chat_prompt(self, messages: List[Dict]) -> str:
+        """把OpenAI格式的messages转换成prompt：有chat template时直接使用，否则按(问, 答)历史拼接"""
+        if getattr(self.tokenizer, "chat_template", None) and not hasattr(self.tokenizer, "build_prompt"):
+            return self.tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+        system = "".join(m["content"] for m in messages if m["role"] == "system")
+        turns = [m for m in messages if m["role"] != "system"]
+        history = []
+        for i in range(0, len(turns) - 1, 2):
+            if turns[i]["role"] == "user" and turns[i + 1]["role"] == "assistant":
+                history.append([turns[i]["content"], turns[i + 1]["content"]])
+        query = turns[-1]["content"] if turns else ""
+        return self.build_prompt(query, history, system)
+
+    def generate(
+        self,
+        prompts: List[str],
+        max_new_tokens: Union[int, List[int]] = 512,
+        temperature: float = 0.0,
+        top_p: float = 1.0
+    ) -> List[Tuple[str, str, int]]:
+        """
+        同步批量生成，返回 [(文本, finish_reason, 生成的token数)]。
+        max_new_tokens可以按prompt分别指定，整批按最大值生成后各自截断。
+        """
+        import torch
+
+        limits = max_new_tokens if isinstance(max_new_tokens, list) else [max_new_tokens] * len(prompts)
+        inputs = self.tokenizer(prompts, return_tensors="pt", padding=True).to(self.device)
+        kwargs = {"max_new_tokens": max(limits), "pad_token_id": self.tokenizer.pad_token_id}
+        if temperature and temperature > 0:
+            kwargs.update(do_sample=True, temperature=temperature, top_p=top_p)
+        else:
+            kwargs.update(do_sample=False)
+        with torch.inference_mode():
+            outputs = self.model.generate(**inputs, **kwargs)
+
+        prompt_length = inputs["input_ids"].shape[1]
+        results = []
+        for row, limit in zip(outputs[:, prompt_length:].tolist(), limits):
+            # 去掉提前结束的序列后面补的pad
+            tokens = []
+            finish_reason = "length"
+            for token in row[:limit]:
+                if token == self.tokenizer.eos_token_id:
+                    finish_reason = "stop"
+                    break
+                if token == self.tokenizer.pad_token_id and self.tokenizer.pad_token_id != self.tokenizer.eos_token_id:
+                    finish_reason = "stop"
+                    break
+                tokens.append(token)
+            text = self.tokenizer.decode(tokens, skip_special_tokens=True)
+            results.append((text.strip(), finish_reason, len(tokens)))
+        return results
+
+
+    def stream(
+        self,
+        query: str,
+        history: Optional[List[List[str]]] = None,
+        max_new_tokens: int = 512,
+        temperature: float = 0.0,
+        top_p: float = 1.0,
+        stop_event: Optional[threading.Event] = None
+    ) -> Iterator[str]:
+        """同步流式生成，逐段产出新增的文本；stop_event被设置后在下一个解码步结束生成"""
+        stop_event = stop_event or threading.Event()
+        if hasattr(self.model, "stream_chat"):
+            # ChatGLM自带的流式接口，每次产出完整的回复，这里转换成增量
+            current_length = 0
+            kwargs = {}
+            if temperature:
+                kwargs.update(temperature=temperature, top_p=top_p)
+            for response, _ in self.model.stream_chat(self.tokenizer, query, history or [], **kwargs):
+                if stop_event.is_set():
+                    break
+                self.stream_tokens += 1
+                if len(response) > current_length:
+                    yield response[current_length:]
+                    current_length = len(response)
+            return
+
+        from transformers import StoppingCriteria, StoppingCriteriaList, TextIteratorStreamer
+
+        generator = self
+
+        class _Stop(StoppingCriteria):
+            # 每个解码步调用一次
+            def __call__(self, input_ids, scores, **kwargs):
+                generator.stream_tokens += 1
+                return stop_event.is_set()
+
+        inputs = self.tokenizer([self.build_prompt(query, history)], return_tensors="pt").to(self.device)
+        streamer = TextIteratorStreamer(self.tokenizer, skip_prompt=True, skip_special_tokens=True)
+        kwargs = {
+            "max_new_tokens": max_new_tokens,
+            "pad_token_id": self.tokenizer.pad_token_id,
+            "streamer": streamer,
+            "stopping_criteria": StoppingCriteriaList([_Stop()]),
+        }
+        if temperature and temperature > 0:
+            kwargs.update(do_sample=True, temperature=temperature, top_p=top_p)
+        else:
+            kwargs.update(do_sample=False)
+
+        errors = []
+
+        def run():
+            import torch
+            try:
+                with torch.inference_mode():
+                    self.model.generate(**inputs, **kwargs)
+            except Exception as e:
+                errors.append(e)
+                # 生成出错时streamer不会收到结束信号，这里手动结束，避免读取方一直等待
+                streamer.end()
+
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        try:
+            for text in streamer:
+                if text:
+                    yield text
+        finally:
+            stop_event.set()
+            thread.join()
+        if errors:
+            raise errors[0]
+
+
+class _Request:
+    __slots__ = ("prompt", "max_new_tokens", "temperature", "top_p", "future", "enqueued_at")
+
+    def __init__(self, prompt: str, max_new_tokens: int, temperature: float, top_p: float, future: asyncio.Future):
+        self.prompt = prompt
+        self.max_new_tokens = max_new_tokens
+        self.temperature = temperature
+        self.top_p = top_p
+        self.future = future
+        self.enqueued_at = time.monotonic()
+
+
+class BatchScheduler:
+    """
+    动态微批调度：在batch_wait_ms的时间窗口内收集并发请求（最多max_batch_size条），
+    在单独的线程里做一次批量生成，再把结果分发给各个等待的请求，不阻塞事件循环。
+    采样参数不同的请求分组生成。
+    """
+
+    def __init__(
+        self,
+        generator: HFBatchGenerator,
+        max_batch_size: int = 8,
+        batch_wait_ms: float = 10.0,
+        max_streams: int = 4
+    ):
+        self.generator = generator
+        self.max_batch_size = max_batch_size
+        self.batch_wait = batch_wait_ms / 1000
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker: Optional[asyncio.Task] = None
+        # 模型只在这一个线程里运行
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="batch-generate")
+        # 流式请求各占一个线程，和批量生成并行
+        self._stream_executor = ThreadPoolExecutor(max_workers=max_streams, thread_name_prefix="stream-generate")
+        self.stats = {
+            "batches": 0, "requests": 0, "generated_tokens": 0, "generate_seconds": 0.0, "queue_seconds": 0.0,
+            "streams": 0, "stream_seconds": 0.0,
+        }
+
+    async def start(self):
+        if self._worker is None:
+            self._queue = asyncio.Queue()
+            self._worker = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._worker is not None:
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+            self._worker = None
+        self._executor.shutdown(wait=True)
+        self._stream_executor.shutdown(wait=True)
+
+    async def submit(
+        self,
+        prompt: str,
+        max_new_tokens: int = 512,
+        temperature: float = 0.0,
+        top_p: float = 1.0
+    ) -> Tuple[str, str, int]:
+        """提交一条生成请求，返回 (文本, finish_reason, 生成的token数)"""
+        if self._worker is None:
+            await self.start()
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put(_Request(prompt, max_new_tokens, temperature or 0.0, top_p or 1.0, future))
+        return await future
+
+    async def stream(
+        self,
+        query: str,
+        history: Optional[List[List[str]]] = None,
+        max_new_tokens: int = 512,
+        temperature: float = 0.0,
+        top_p: float = 1.0
+    ) -> AsyncIterator[str]:
+        """
+        在工作线程里流式生成，通过asyncio队列把文本交给调用方，不阻塞事件循环。
+        调用方停止迭代（如客户端断开）时通知工作线程尽快结束生成。
+        """
+        loop = asyncio.get_running_loop()
+        queue: asyncio.Queue = asyncio.Queue()
+        stop_event = threading.Event()
+        done = object()
+
+        def produce():
+            try:
+                for text in self.generator.stream(query, history, max_new_tokens, temperature, top_p, stop_event):
+                    if stop_event.is_set():
+                        break
+                    loop.call_soon_threadsafe(queue.put_nowait, text)
+                loop.call_soon_threadsafe(queue.put_nowait, done)
+            except Exception as e:
+                loop.call_soon_threadsafe(queue.put_nowait, e)
+
+        producer = loop.run_in_executor(self._stream_executor, produce)
+        start = time.monotonic()
+        self.stats["streams"] += 1
+        try:
+            while True:
+                item = await queue.get()
+                if item is done:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            self.stats["stream_seconds"] += time.monotonic() - start
+            stop_event.set()
+            # 不等待生成线程结束，它会在下一个解码步检查stop_event后退出
+            producer.add_done_callback(lambda f: f.exception())
+
+    def summary(self) -> Dict:
+        """吞吐统计：批量生成按生成时间计算tokens/s，流式按每个流的平均速度计算"""
+        stats = dict(self.stats)
+        stats["stream_tokens"] = self.generator.stream_tokens
+        stats["avg_batch_size"] = round(stats["requests"] / stats["batches"], 2) if stats["batches"] else 0.0
+        stats["batch_tokens_per_second"] = round(
+            stats["generated_tokens"] / stats["generate_seconds"], 2
+        ) if stats["generate_seconds"] else 0.0
+        stats["stream_tokens_per_second"] = round(
+            stats["stream_tokens"] / stats["stream_seconds"], 2
+        ) if stats["stream_seconds"] else 0.0
+        return stats
+
+    async def _collect(self) -> List[_Request]:
+        batch = [await self._queue.get()]
+        deadline = time.monotonic() + self.batch_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        # 客户端已经断开的请求不再生成
+        return [request for request in batch if not request.future.done()]
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._collect()
+            groups: Dict[Tuple, List[_Request]] = {}
+            for request in batch:
+                groups.setdefault((request.temperature, request.top_p), []).append(request)
+            for (temperature, top_p), requests in groups.items():
+                start = time.monotonic()
+                try:
+                    results = await loop.run_in_executor(
+                        self._executor,
+                        self.generator.generate,
+                        [request.prompt for request in requests],
+                        [request.max_new_tokens for request in requests],
+                        temperature,
+                        top_p
+                    )
+                except Exception as e:
+                    for request in requests:
+                        if not request.future.done():
+                            request.future.set_exception(e)
+                    continue
+                self.stats["batches"] += 1
+                self.stats["requests"] += len(requests)
+                self.stats["generate_seconds"] += time.monotonic() - start
+                self.stats["queue_seconds"] += sum(start - request.enqueued_at for request in requests)
+                for request, result in zip(requests, results):
+                    self.stats["generated_tokens"] += result[2]
+                    if not request.future.done():
+                        request.future.set_result(result)
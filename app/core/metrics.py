@@ -0,0 +1,288 @@
+import asyncio
+import glob
+import json
+import os
+import time
+from bisect import bisect_left
+from typing import Dict, List, Optional, Sequence, Tuple
+
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names: Sequence[str], values: Tuple) -> str:
+    if not names:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in zip(names, values)) + "}"
+
+
+class Counter:
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[Tuple, float] = {}
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = tuple(labels.get(name, "") for name in self.labelnames)
+        self._values[key] = self._values.get(key, 0.0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(tuple(labels.get(name, "") for name in self.labelnames), 0.0)
+
+    @staticmethod
+    def merge(values: Dict[Tuple, float], key: Tuple, value: float):
+        values[key] = values.get(key, 0.0) + value
+
+    def render(self, values: Optional[Dict[Tuple, float]] = None) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        for key, value in (self._values if values is None else values).items():
+            lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {value}")
+        return lines
+
+
+class Gauge:
+    """多进程汇总时按multiprocess_mode合并各worker的值：sum（如在途请求数）或max（如熔断状态）"""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (), multiprocess_mode: str = "sum"):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.multiprocess_mode = multiprocess_mode
+        self._values: Dict[Tuple, float] = {}
+
+    def set(self, value: float, **labels):
+        self._values[tuple(labels.get(name, "") for name in self.labelnames)] = value
+
+    def value(self, **labels) -> float:
+        return self._values.get(tuple(labels.get(name, "") for name in self.labelnames), 0.0)
+
+    def merge(self, values: Dict[Tuple, float], key: Tuple, value: float):
+        if key not in values:
+            values[key] = value
+        elif self.multiprocess_mode == "max":
+            values[key] = max(values[key], value)
+        else:
+            values[key] += value
+
+    def render(self, values: Optional[Dict[Tuple, float]] = None) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} gauge"]
+        for key, value in (self._values if values is None else values).items():
+            lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS
+    ):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        # key -> [各桶计数(不累积), 总和, 总数]
+        self._values: Dict[Tuple, list] = {}
+
+    def observe(self, value: float, **labels):
+        key = tuple(labels.get(name, "") for name in self.labelnames)
+        entry = self._values.get(key)
+        if entry is None:
+            entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        entry[0][bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+        entry[2] += 1
+
+    def time(self, **labels) -> "_Timer":
+        return _Timer(self, labels)
+
+    @staticmethod
+    def merge(values: Dict[Tuple, list], key: Tuple, value: list):
+        entry = values.get(key)
+        if entry is None:
+            values[key] = [list(value[0]), value[1], value[2]]
+            return
+        entry[0] = [a + b for a, b in zip(entry[0], value[0])]
+        entry[1] += value[1]
+        entry[2] += value[2]
+
+    def render(self, values: Optional[Dict[Tuple, list]] = None) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        for key, (counts, total, count) in (self._values if values is None else values).items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                labels = _format_labels(self.labelnames + ("le",), key + (le,))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {total}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+class _Timer:
+    def __init__(self, histogram: Histogram, labels: Dict):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+        return False
+
+
+def _alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class Registry:
+    """
+    指标注册表。多个worker进程时每个进程各有一份：各worker定期把自己的值写到共享目录下的 <pid>.json，
+    render_multiprocess读取所有worker的文件合并后输出（计数器和直方图相加，gauge按multiprocess_mode合并）。
+    其他worker的值最多滞后一个写入间隔；已退出的worker的计数保留，gauge不再计入。
+    """
+
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self) -> Dict[str, List]:
+        return {metric.name: [[list(key), value] for key, value in metric._values.items()] for metric in self._metrics}
+
+    def dump(self, directory: str):
+        """把当前进程的指标写入 directory/<pid>.json（先写临时文件再替换，读取方不会读到一半）"""
+        path = os.path.join(directory, f"{os.getpid()}.json")
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.snapshot(), f)
+        os.replace(tmp_path, path)
+
+    def render_multiprocess(self, directory: str) -> str:
+        """合并共享目录中所有worker的指标；当前进程使用内存中的最新值"""
+        snapshots = [(self.snapshot(), True)]
+        for path in glob.glob(os.path.join(directory, "*.json")):
+            name = os.path.basename(path)[:-len(".json")]
+            # 目录里可能有其它JSON文件，只读取以pid命名的
+            if not name.isdigit():
+                continue
+            pid = int(name)
+            if pid == os.getpid():
+                continue
+            try:
+                with open(path) as f:
+                    snapshots.append((json.load(f), _alive(pid)))
+            except (OSError, ValueError):
+                continue
+        lines = []
+        for metric in self._metrics:
+            values: Dict[Tuple, object] = {}
+            for data, alive in snapshots:
+                if isinstance(metric, Gauge) and not alive:
+                    continue
+                for key, value in data.get(metric.name, []):
+                    metric.merge(values, tuple(key), value)
+            lines.extend(metric.render(values))
+        return "\n".join(lines) + "\n"
+
+    async def dump_periodically(self, directory: str, interval: float):
+        """后台任务：每interval秒写一次当前进程的指标，取消时再写最后一次"""
+        try:
+            while True:
+                self.dump(directory)
+                await asyncio.sleep(interval)
+        finally:
+            self.dump(directory)
+
+
+REGISTRY = Registry()
+
+REQUEST_LATENCY = REGISTRY.register(Histogram(
+    "pscyagent_request_seconds", "端到端监控耗时", ["endpoint"]
+))
+STAGE_LATENCY = REGISTRY.register(Histogram(
+    "pscyagent_stage_seconds", "监控流程各阶段耗时", ["stage"]
+))
+DETECTOR_LATENCY = REGISTRY.register(Histogram(
+    "pscyagent_detector_seconds", "单个检测器耗时（含缓存命中）", ["detector"]
+))
+UPSTREAM_LATENCY = REGISTRY.register(Histogram(
+    "pscyagent_upstream_seconds", "上游LLM请求的网络耗时", ["provider", "detector"]
+))
+UPSTREAM_QUEUE_WAIT = REGISTRY.register(Histogram(
+    "pscyagent_upstream_queue_wait_seconds", "上游请求在准入控制中的排队时间", ["provider"]
+))
+JSON_PARSE_LATENCY = REGISTRY.register(Histogram(
+    "pscyagent_json_parse_seconds", "LLM输出的JSON解析耗时", ["detector"],
+    buckets=(0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05)
+))
+UPSTREAM_RETRIES = REGISTRY.register(Counter(
+    "pscyagent_upstream_retries_total", "上游请求重试次数", ["provider"]
+))
+DETECTOR_ERRORS = REGISTRY.register(Counter(
+    "pscyagent_detector_errors_total", "检测器出错次数（结果中出现system异常）", ["detector"]
+))
+SECURITY_FALLBACKS = REGISTRY.register(Counter(
+    "pscyagent_security_fallbacks_total", "安全检查失败后使用保守结论的次数"
+))
+DETECTOR_SKIPPED = REGISTRY.register(Counter(
+    "pscyagent_detector_skipped_total", "未运行的检测器次数", ["detector", "reason"]
+))
+CACHE_REQUESTS = REGISTRY.register(Counter(
+    "pscyagent_cache_requests_total", "结论缓存查询次数", ["result"]
+))
+NEAR_DUPLICATE_REQUESTS = REGISTRY.register(Counter(
+    "pscyagent_near_duplicate_requests_total", "近似重复对话索引查询次数", ["detector", "result"]
+))
+ANOMALIES = REGISTRY.register(Counter(
+    "pscyagent_anomalies_total", "检测到的异常数", ["type", "severity"]
+))
+RESULTS = REGISTRY.register(Counter(
+    "pscyagent_results_total", "监控结果数", ["status", "risk_level"]
+))
+CONTEXT_TRUNCATIONS = REGISTRY.register(Counter(
+    "pscyagent_context_truncations_total", "对话超出token预算被压缩的次数", ["detector"]
+))
+ENDPOINT_REQUESTS = REGISTRY.register(Counter(
+    "pscyagent_endpoint_requests_total", "各上游端点的请求结果(ok/failover/error)", ["endpoint", "result"]
+))
+ENDPOINT_OUTSTANDING = REGISTRY.register(Gauge(
+    "pscyagent_endpoint_outstanding", "各上游端点的在途请求数", ["endpoint"]
+))
+CIRCUIT_STATE = REGISTRY.register(Gauge(
+    "pscyagent_circuit_state", "各上游端点的熔断状态(0关闭/1半开/2打开)", ["endpoint"], multiprocess_mode="max"
+))
+HEDGED_REQUESTS = REGISTRY.register(Counter(
+    "pscyagent_hedged_requests_total", "发出了对冲请求的调用数，按先返回的一方统计", ["detector", "winner"]
+))
+RESULT_WRITES = REGISTRY.register(Counter(
+    "pscyagent_result_writes_total", "监控结果落库的条数(written/dropped/failed)", ["outcome"]
+))
+RESULT_QUEUE_SIZE = REGISTRY.register(Gauge(
+    "pscyagent_result_queue_size", "等待落库的监控结果数"
+))
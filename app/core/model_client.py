@@ -1,35 +1,265 @@
+from contextlib import nullcontext
+from contextvars import ContextVar
+import asyncio
+import logging
+import time
+import httpx
 from openai import AsyncOpenAI
-from typing import List, Dict
+from typing import List, Dict, Optional, Tuple
 from app.config import settings
-class OpenAIClient():
-    def __init__(self):
-        if settings.BASE_URL=="" and settings.DEEPSEEK_API_KEY == "":
-            print("====Using OpenAI API====")
-            self.client = AsyncOpenAI(api_key=settings.OPENAI_API_KEY)
-        elif settings.DEEPSEEK_API_KEY != "":
-            self.client = AsyncOpenAI(
-                base_url="https://api.deepseek.com/v1",
-                api_key=settings.DEEPSEEK_API_KEY
+from app.core.cache import VerdictCache
+from app.core.json_output import get_parser, output_params, structured_output_params
+from app.core.metrics import CACHE_REQUESTS, JSON_PARSE_LATENCY, NEAR_DUPLICATE_REQUESTS, UPSTREAM_LATENCY, UPSTREAM_QUEUE_WAIT, UPSTREAM_RETRIES
+from app.core.near_duplicate import NearDuplicateIndex
+from app.core.rate_limit import estimate_tokens
+from app.core.router import Endpoint, EndpointRouter
+
+logger = logging.getLogger(__name__)
+
+# 批量请求时设置一个共享的Semaphore，限制该批次所有检测器的上游并发数
+call_limiter: ContextVar[Optional[asyncio.Semaphore]] = ContextVar("call_limiter", default=None)
+# 每个请求设置一个列表，记录该请求内每次上游调用的排队时间、重试次数和耗时
+call_trace: ContextVar[Optional[List[Dict]]] = ContextVar("call_trace", default=None)
+# 每个请求设置一个列表，记录复用了近似重复对话结论的检测器及相似度
+reused_verdicts: ContextVar[Optional[List[Dict]]] = ContextVar("reused_verdicts", default=None)
+
+# generate 透传给上游的参数
+_PASSTHROUGH = ("max_tokens", "response_format", "extra_body", "stop", "top_p", "seed")
+
+
+def create_http_client() -> httpx.AsyncClient:
+    """创建带连接池的httpx client，供所有上游请求复用（keep-alive, 可选HTTP/2）"""
+    return httpx.AsyncClient(
+        http2=settings.HTTP_HTTP2,
+        limits=httpx.Limits(
+            max_connections=settings.HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=settings.HTTP_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=settings.HTTP_KEEPALIVE_EXPIRY,
+        ),
+        timeout=httpx.Timeout(settings.HTTP_TIMEOUT, connect=settings.HTTP_CONNECT_TIMEOUT),
+    )
+
+
+class BaseModelClient:
+    """模型客户端的公共部分：结论缓存、约束解码参数、JSON解析和调用记录；子类实现generate"""
+
+    provider = ""
+    model_name = ""
+
+    def __init__(self, cache: Optional[VerdictCache] = None, near_duplicates: Optional[NearDuplicateIndex] = None):
+        self.cache = cache
+        self.near_duplicates = near_duplicates
+
+    async def generate(self, messages: List[Dict], detector: Optional[str] = None, **kwargs) -> str:
+        raise NotImplementedError
+
+    async def generate_with_model(self, messages: List[Dict], detector: Optional[str] = None, **kwargs) -> Tuple[str, str]:
+        """返回 (模型输出, 实际应答的模型名称)；只有一个模型的后端直接使用model_name"""
+        return await self.generate(messages, detector=detector, **kwargs), self.model_name
+
+    def cache_models(self) -> List[str]:
+        """可能应答请求的模型，查找缓存时按顺序尝试各自的key"""
+        return [self.model_name]
+
+    async def generate_json(self, messages: List[Dict], detector: str, **kwargs) -> Dict:
+        """
+        请求模型并按该检测器的schema解析JSON结果；命中结论缓存时直接返回，不再请求模型。
+        精确缓存未命中时查找近似重复的对话，找到时复用其结论并记入reused_verdicts。
+        结论按实际应答的模型写入缓存，之后只在该模型仍可能应答时复用。
+        默认使用约束解码和紧凑输出的token上限，调用方传入的参数优先。
+        """
+        temperature = kwargs.get("temperature", settings.TEMPERATURE)
+        models = self.cache_models()
+        if self.cache is not None:
+            cached = None
+            for model in models:
+                cached = await self.cache.get(self.cache.make_key(detector, messages, model, temperature))
+                if cached is not None:
+                    break
+            CACHE_REQUESTS.inc(result="hit" if cached is not None else "miss")
+            if cached is not None:
+                return cached
+
+        signature = signals = None
+        if self.near_duplicates is not None and detector in settings.NEAR_DUP_DETECTORS:
+            signals = self.near_duplicates.risk_signals(messages[-1]["content"])
+            if signals is None:
+                # 含危机词或敏感信息，必须由模型重新判断
+                NEAR_DUPLICATE_REQUESTS.inc(detector=detector, result="sensitive")
+            else:
+                signature = self.near_duplicates.signature(messages[-1]["content"])
+                found = None
+                for model in models:
+                    namespace = self.near_duplicates.namespace(detector, messages, model, temperature)
+                    found = self.near_duplicates.lookup(namespace, signature, signals)
+                    if found is not None:
+                        break
+                NEAR_DUPLICATE_REQUESTS.inc(detector=detector, result="hit" if found is not None else "miss")
+                if found is not None:
+                    analysis, similarity = found
+                    reused = reused_verdicts.get()
+                    if reused is not None:
+                        reused.append({"detector": detector, "source": "near_duplicate", "similarity": round(similarity, 3)})
+                    return analysis
+
+        params = output_params(detector)
+        params.update(kwargs)
+        response_content, model = await self.generate_with_model(messages, detector=detector, **params)
+        with JSON_PARSE_LATENCY.time(detector=detector):
+            analysis = get_parser(detector).parse(response_content)
+
+        if analysis.get("truncated"):
+            # 截断的结论是保守补全的，不缓存也不供近似重复复用，下次重新请求模型
+            return analysis
+        if self.cache is not None:
+            await self.cache.set(self.cache.make_key(detector, messages, model, temperature), analysis)
+        if signature is not None:
+            namespace = self.near_duplicates.namespace(detector, messages, model, temperature)
+            self.near_duplicates.add(namespace, signature, analysis, signals)
+        return analysis
+
+    def record_call(self, detector: Optional[str], stats: Dict, latency: float, provider: Optional[str] = None):
+        """记录一次模型调用的指标；stats包含 queue_wait, retry_wait, attempts, network；provider默认为客户端的服务商"""
+        provider = provider or self.provider
+        UPSTREAM_LATENCY.observe(stats["network"], provider=provider, detector=detector or "")
+        UPSTREAM_QUEUE_WAIT.observe(stats["queue_wait"], provider=provider)
+        if stats["attempts"] > 1:
+            UPSTREAM_RETRIES.inc(stats["attempts"] - 1, provider=provider)
+        trace = call_trace.get()
+        if trace is not None:
+            trace.append({
+                "detector": detector,
+                "queue_wait": round(stats["queue_wait"], 3),
+                "retry_wait": round(stats["retry_wait"], 3),
+                "attempts": stats["attempts"],
+                "latency": round(latency, 3),
+                "upstream": provider,
+            })
+
+    async def aclose(self):
+        pass
+
+
+class OpenAIClient(BaseModelClient):
+    """OpenAI兼容的HTTP后端；请求由EndpointRouter在一个或多个上游端点之间分配"""
+
+    def __init__(
+        self,
+        http_client: Optional[httpx.AsyncClient] = None,
+        cache: Optional[VerdictCache] = None,
+        near_duplicates: Optional[NearDuplicateIndex] = None
+    ):
+        super().__init__(cache, near_duplicates)
+        # 没有传入http_client时自己创建一个，并在aclose时负责关闭
+        self._owns_http_client = http_client is None
+        self.http_client = http_client or create_http_client()
+        self.router = EndpointRouter.from_settings(self.http_client)
+        # 指标的服务商标签以第一个端点为准；缓存key按实际应答的端点的模型
+        self.provider = self.router.primary.provider
+        self.model_name = self.router.primary.model
+
+    def cache_models(self) -> List[str]:
+        return list(dict.fromkeys(endpoint.model for endpoint in self.router.endpoints))
+
+    async def generate(self, messages: List[Dict], detector: Optional[str] = None, **kwargs) -> str:
+        return (await self.generate_with_model(messages, detector=detector, **kwargs))[0]
+
+    async def generate_with_model(self, messages: List[Dict], detector: Optional[str] = None, **kwargs) -> Tuple[str, str]:
+        """
+        kwargs中的max_tokens、response_format、extra_body等会原样传给上游；
+        structured_output为schema名称，按选中端点的服务商生成约束解码参数（显式传入的参数优先）
+        """
+        params = {k: v for k, v in kwargs.items() if k in _PASSTHROUGH}
+        schema = kwargs.get("structured_output")
+
+        def request(endpoint: Endpoint):
+            request_params = {}
+            if schema:
+                request_params.update(structured_output_params(schema, endpoint.provider, settings.STRUCTURED_OUTPUT))
+            request_params.update(params)
+            return endpoint.client.chat.completions.create(
+                model=endpoint.model,
+                messages=messages,
+                temperature=kwargs.get("temperature", settings.TEMPERATURE),
+                **request_params
             )
-            print("====Using DeepSeek API====")
-        else:
-            print("====Using Dummy API====")
-            self.client = AsyncOpenAI(
-                base_url=settings.BASE_URL, 
-                api_key=settings.DUMMPY_API_KEY
+
+        limiter = call_limiter.get()
+        async with limiter if limiter is not None else nullcontext():
+            start_time = time.monotonic()
+            response, stats, endpoint = await self.router.call(
+                request,
+                tokens=estimate_tokens(messages) + kwargs.get("max_tokens", settings.UPSTREAM_COMPLETION_TOKENS),
+                key=detector
             )
+            end_time = time.monotonic()
+
+        self.record_call(detector, stats, end_time - start_time, provider=endpoint.name)
+        return response.choices[0].message.content, endpoint.model
+
+    async def aclose(self):
+        """停止健康检查并关闭底层连接池"""
+        await self.router.aclose()
+        if self._owns_http_client:
+            await self.http_client.aclose()
     
-    async def generate(self, messages: List[Dict], **kwargs) -> str:
-        response = await self.client.chat.completions.create(
-            model=settings.MODEL_NAME,
-            messages=messages,
-            temperature=kwargs.get("temperature", settings.TEMPERATURE)
+class LocalModelClient(BaseModelClient):
+    """
+    进程内推理后端：模型只加载一次，在工作线程里生成，不经过HTTP。
+    各检测器并发提交的prompt会被BatchScheduler在时间窗口内合并成一次批量生成。
+    """
+
+    provider = "inprocess"
+
+    def __init__(
+        self,
+        model_path: Optional[str] = None,
+        cache: Optional[VerdictCache] = None,
+        near_duplicates: Optional[NearDuplicateIndex] = None
+    ):
+        from app.core.local_inference import BatchScheduler, HFBatchGenerator, configure_cpu_threads, load_causal_lm
+
+        super().__init__(cache, near_duplicates)
+        self.model_name = model_path or settings.LOCAL_MODEL_PATH
+        logger.info("using in-process model %s", self.model_name)
+        configure_cpu_threads(settings.LOCAL_THREADS)
+        model, tokenizer = load_causal_lm(
+            self.model_name,
+            device=settings.LOCAL_DEVICE,
+            dtype=settings.LOCAL_DTYPE,
+            quantize=settings.LOCAL_QUANTIZE
         )
-        return response.choices[0].message.content
-    
-class LocalModelClient():
-    def __init__(self, model_path: str):
-        self.model = self._load_model(model_path)
-    
-    async def generate(self, messages: List[Dict], **kwargs) -> str:
-        pass
\ No newline at end of file
+        self.generator = HFBatchGenerator(model, tokenizer)
+        self.scheduler = BatchScheduler(
+            self.generator,
+            max_batch_size=settings.LOCAL_MAX_BATCH_SIZE,
+            batch_wait_ms=settings.LOCAL_BATCH_WAIT_MS
+        )
+
+    async def generate(self, messages: List[Dict], detector: Optional[str] = None, **kwargs) -> str:
+        """response_format/extra_body等约束解码参数在本地后端被忽略，由容错解析兜底"""
+        limiter = call_limiter.get()
+        async with limiter if limiter is not None else nullcontext():
+            start_time = time.monotonic()
+            text, _, _ = await self.scheduler.submit(
+                self.generator.build_chat_prompt(messages),
+                max_new_tokens=kwargs.get("max_tokens", settings.UPSTREAM_COMPLETION_TOKENS),
+                temperature=kwargs.get("temperature", settings.TEMPERATURE),
+                top_p=kwargs.get("top_p", 1.0)
+            )
+            latency = time.monotonic() - start_time
+        self.record_call(detector, {"queue_wait": 0.0, "retry_wait": 0.0, "attempts": 1, "network": latency}, latency)
+        return text
+
+    async def aclose(self):
+        await self.scheduler.stop()
+
+
+def create_model_client(
+    cache: Optional[VerdictCache] = None,
+    near_duplicates: Optional[NearDuplicateIndex] = None
+) -> BaseModelClient:
+    """按 LLM_BACKEND 创建模型客户端"""
+    if settings.LLM_BACKEND == "local":
+        return LocalModelClient(cache=cache, near_duplicates=near_duplicates)
+    return OpenAIClient(cache=cache, near_duplicates=near_duplicates)
@@ -1,58 +1,82 @@
-from typing import List, Dict
+from typing import List, Dict, Optional
 from openai import AsyncOpenAI
-import time
 from app.config import settings
-from app.core.model_client import OpenAIClient
+from app.core.context_window import ContextWindow
+from app.core.model_client import BaseModelClient, create_model_client
+from app.core.session_store import SessionContext
+from app.core.triage import Triage
 import asyncio
 
+DETECTORS = ["emotional", "behavioral", "quality"]
+
 class DialogueMonitor:
-    def __init__(self):
-        self.client = OpenAIClient()
+    def __init__(self, client: Optional[BaseModelClient] = None, window: Optional[ContextWindow] = None):
+        # 由应用lifespan传入共享的client，避免每个请求都新建连接池
+        self.client = client or create_model_client()
+        self.window = window or ContextWindow.from_settings()
+        self.triage = Triage.from_settings() if settings.TRIAGE_ENABLED else None
         
-    async def analyze(self, conversation: List[Dict]) -> Dict:
-        result = {
-            "status": "normal",
-            "anomalies": [],
-            "risk_level": "low",
-            "suggestions": []
+    async def analyze(self, conversation: List[Dict], session: Optional[SessionContext] = None) -> Dict:
+        decision = self.triage_decision(conversation, session)
+        if decision is not None and decision["tier"] == "skip":
+            return self.skipped_result(decision, session)
+
+        detectors = self.detectors(conversation, session)
+        issues = await asyncio.gather(*detectors.values())
+        return self.finish(dict(zip(detectors, issues)), decision, session)
+
+    def detectors(self, conversation: List[Dict], session: Optional[SessionContext] = None) -> Dict:
+        """各检测器的协程，key为检测器名称，供调用方自行调度"""
+        return {
+            "emotional": self._check_emotional_state(conversation, session),
+            "behavioral": self._check_behavioral_patterns(conversation, session),
+            "quality": self._check_ai_response_quality(conversation, session),
         }
 
-        start_time = time.time()
-        emotional_issues, behavioral_issues, quality_issues = await asyncio.gather(
-            self._check_emotional_state(conversation),
-            self._check_behavioral_patterns(conversation),
-            self._check_ai_response_quality(conversation)
+    def finish(
+        self,
+        issues: Dict[str, List[Dict]],
+        decision: Optional[Dict] = None,
+        session: Optional[SessionContext] = None
+    ) -> Dict:
+        """合并各检测器的issue；未运行的检测器不会出现在issues里"""
+        if session is not None:
+            for name, detector_issues in issues.items():
+                session.record(name, detector_issues)
+        result = self.build_result(
+            issues.get("emotional", []),
+            issues.get("behavioral", []),
+            issues.get("quality", [])
         )
+        if decision is not None:
+            result["triage"] = decision
+        return result
 
-        emotional_end = time.time()
-        all_issues = emotional_issues + behavioral_issues + quality_issues
-        # 合并所有建议,但是有的emotional_issues可能是[]，这样写会报错
-        # all_suggestions = emotional_issues["suggestions"] + behavioral_issues["suggestions"] + quality_issues["suggestions"]
-        all_suggestions = []
-        count = 0
-        for issue in emotional_issues + behavioral_issues + quality_issues:
-            for suggestion in issue["suggestions"]:
-                all_suggestions.append(f"{count}. {suggestion}")
-                count += 1
-
-        start_all_issues = time.time()
-        if all_issues:
-            result["status"] = "alert"
-            result["anomalies"] = all_issues
-            result["risk_level"] = self._determine_risk_level(all_issues)
-            result["suggestions"] = all_suggestions
-        end_all_issues = time.time()
-        
-        time_metrics = {
-            "total_latency": round(end_all_issues - start_time, 2),
-            "emotional_latency": round(emotional_end - start_time, 2),
-            "suggestions_latency": round(end_all_issues - start_all_issues, 2),
-        }
-        print(f"\n\nMonitor性能指标: {time_metrics}\n\n")
+    def triage_decision(self, conversation: List[Dict], session: Optional[SessionContext] = None) -> Optional[Dict]:
+        """本地分诊；增量模式下只看新增的轮次"""
+        if self.triage is None:
+            return None
+        if session is not None and session.incremental:
+            return self.triage.evaluate(session.delta)
+        return self.triage.evaluate(conversation)
 
+    def skipped_result(self, decision: Dict, session: Optional[SessionContext] = None) -> Dict:
+        """分诊判定为低风险时跳过LLM检测；增量模式下沿用此前的结论"""
+        previous = {}
+        if session is not None and session.incremental:
+            previous = {name: session.previous(name) or [] for name in DETECTORS}
+        result = self.build_result(
+            previous.get("emotional", []),
+            previous.get("behavioral", []),
+            previous.get("quality", [])
+        )
+        result["triage"] = decision
+        result["skipped_detectors"] = [{"detector": name, "reason": "triage"} for name in DETECTORS]
         return result
-    
-    async def _check_emotional_state(self, conversation: List[Dict]) -> List[Dict]:
+
+    async def _check_emotional_state(self, conversation: List[Dict], session: Optional[SessionContext] = None) -> List[Dict]:
+        if session is not None and session.unchanged:
+            return session.previous("emotional") or []
         issues = []
         
         messages = [
@@ -77,36 +101,16 @@ class DialogueMonitor:
             """}
         ]
         
-        cont = ""
-        for msg in conversation:
-            cont += f"{msg.role}: {msg.content}\n"
+        cont = self.window.transcript("emotional", conversation, session)
         messages.append({"role": 'user', "content": cont})
         
         try:
-            response_content = await self.client.generate(
+            analysis = await self.client.generate_json(
                 messages=messages,
-                temperature=0.1,
-                response_format={"type": "json_object"}
+                detector="emotional",
+                temperature=0.1
             )
-            # print("====> check_emotional_state API Response:", response_content)
-
-            import json
-            import re
-            if "```" in response_content:
-                pattern = r"```(?:json)?\n?(.*?)```"
-                match = re.search(pattern, response_content, re.DOTALL)
-                if match:
-                    response_content = match.group(1).strip()
-            
-            analysis = json.loads(response_content)
-            
-            if analysis["risk_assessment"]["has_risk"]:
-                issues.append({
-                    "type": "risk",
-                    "severity": analysis["risk_assessment"]["severity"],
-                    "description": analysis["risk_assessment"]["description"],
-                    "suggestions": analysis["risk_assessment"]["suggestions"]
-                })
+            issues.extend(self._emotional_issues(analysis))
                 
         except Exception as e:
             issues.append({
@@ -117,7 +121,9 @@ class DialogueMonitor:
             
         return issues
     
-    async def _check_behavioral_patterns(self, conversation: List[Dict]) -> List[Dict]:
+    async def _check_behavioral_patterns(self, conversation: List[Dict], session: Optional[SessionContext] = None) -> List[Dict]:
+        if session is not None and session.unchanged:
+            return session.previous("behavioral") or []
         issues = []
         
         messages = [
@@ -149,44 +155,17 @@ class DialogueMonitor:
             """}
         ]
         
-        recent_messages = conversation[-10:]  # TODO
-        cont = ""
-        for msg in recent_messages:
-            cont += f"{msg.role}: {msg.content}\n"
+        # 行为检测的token预算较小(CONTEXT_BUDGETS)，超出时较早的轮次被压缩为摘要
+        cont = self.window.transcript("behavioral", conversation, session)
         messages.append({"role": 'user', "content": cont})
             
         try:
-            response_content = await self.client.generate(
+            analysis = await self.client.generate_json(
                 messages=messages,
-                temperature=0.1,
-                response_format={"type": "json_object"}
+                detector="behavioral",
+                temperature=0.1
             )
-            # print("====> check_behavioral_patterns API Response:", response_content)
-            
-            import json
-            import re
-            if "```" in response_content:
-                pattern = r"```(?:json)?\n?(.*?)```"
-                match = re.search(pattern, response_content, re.DOTALL)
-                if match:
-                    response_content = match.group(1).strip()
-            
-            analysis = json.loads(response_content)
-            if analysis["behavioral_issues"]["has_issues"]:
-                issues.append({
-                    "type": "behavioral",
-                    "severity": analysis["behavioral_issues"]["severity"],
-                    "description": analysis["behavioral_issues"]["description"],
-                    "suggestions": analysis["behavioral_issues"]["suggestions"]
-                })
-                
-            if analysis["interaction_quality"]["is_problematic"]:
-                issues.append({
-                    "type": "interaction",
-                    "severity": analysis["interaction_quality"]["severity"],
-                    "description": analysis["interaction_quality"]["description"],
-                    "suggestions": analysis["interaction_quality"]["suggestions"]
-                })
+            issues.extend(self._behavioral_issues(analysis))
                 
         except Exception as e:
             issues.append({
@@ -197,7 +176,9 @@ class DialogueMonitor:
             
         return issues
         
-    async def _check_ai_response_quality(self, conversation: List[Dict]) -> List[Dict]:
+    async def _check_ai_response_quality(self, conversation: List[Dict], session: Optional[SessionContext] = None) -> List[Dict]:
+        if session is not None and session.unchanged:
+            return session.previous("quality") or []
         issues = []
         
         messages = [
@@ -230,43 +211,16 @@ class DialogueMonitor:
             """}
         ]
         
-        cont = ""
-        for msg in conversation:
-            cont += f"{msg.role}: {msg.content}\n"
+        cont = self.window.transcript("quality", conversation, session)
         messages.append({"role": 'user', "content": cont})
         
         try:
-            response_content = await self.client.generate(
+            analysis = await self.client.generate_json(
                 messages=messages,
-                temperature=0.1,
-                response_format={"type": "json_object"}
+                detector="quality",
+                temperature=0.1
             )
-            
-            import json
-            import re
-            if "```" in response_content:
-                pattern = r"```(?:json)?\n?(.*?)```"
-                match = re.search(pattern, response_content, re.DOTALL)
-                if match:
-                    response_content = match.group(1).strip()
-            
-            analysis = json.loads(response_content)
-            
-            if analysis["response_quality"]["has_issues"]:
-                issues.append({
-                    "type": "quality",
-                    "severity": analysis["response_quality"]["severity"],
-                    "description": analysis["response_quality"]["description"],
-                    "suggestions": analysis["response_quality"]["suggestions"]
-                })
-                
-            if analysis["content_safety"]["has_issues"]:
-                issues.append({
-                    "type": "safety",
-                    "severity": analysis["content_safety"]["severity"],
-                    "description": analysis["content_safety"]["description"],
-                    "suggestions": analysis["content_safety"]["suggestions"]
-                })
+            issues.extend(self._quality_issues(analysis))
                 
         except Exception as e:
             issues.append({
@@ -277,6 +231,84 @@ class DialogueMonitor:
             
         return issues
         
+    def _emotional_issues(self, analysis: Dict) -> List[Dict]:
+        """把情绪检测的JSON结果转换为issue列表"""
+        issues = []
+        if analysis["risk_assessment"]["has_risk"]:
+            issues.append({
+                "type": "risk",
+                "severity": analysis["risk_assessment"]["severity"],
+                "description": analysis["risk_assessment"]["description"],
+                "suggestions": analysis["risk_assessment"]["suggestions"]
+            })
+        return issues
+
+    def _behavioral_issues(self, analysis: Dict) -> List[Dict]:
+        """把行为检测的JSON结果转换为issue列表"""
+        issues = []
+        if analysis["behavioral_issues"]["has_issues"]:
+            issues.append({
+                "type": "behavioral",
+                "severity": analysis["behavioral_issues"]["severity"],
+                "description": analysis["behavioral_issues"]["description"],
+                "suggestions": analysis["behavioral_issues"]["suggestions"]
+            })
+            
+        if analysis["interaction_quality"]["is_problematic"]:
+            issues.append({
+                "type": "interaction",
+                "severity": analysis["interaction_quality"]["severity"],
+                "description": analysis["interaction_quality"]["description"],
+                "suggestions": analysis["interaction_quality"]["suggestions"]
+            })
+        return issues
+
+    def _quality_issues(self, analysis: Dict) -> List[Dict]:
+        """把AI响应质量检测的JSON结果转换为issue列表"""
+        issues = []
+        if analysis["response_quality"]["has_issues"]:
+            issues.append({
+                "type": "quality",
+                "severity": analysis["response_quality"]["severity"],
+                "description": analysis["response_quality"]["description"],
+                "suggestions": analysis["response_quality"]["suggestions"]
+            })
+            
+        if analysis["content_safety"]["has_issues"]:
+            issues.append({
+                "type": "safety",
+                "severity": analysis["content_safety"]["severity"],
+                "description": analysis["content_safety"]["description"],
+                "suggestions": analysis["content_safety"]["suggestions"]
+            })
+        return issues
+
+    def build_result(self, emotional_issues: List[Dict], behavioral_issues: List[Dict], quality_issues: List[Dict]) -> Dict:
+        """合并三个检测器的issue，生成监控结果"""
+        result = {
+            "status": "normal",
+            "anomalies": [],
+            "risk_level": "low",
+            "suggestions": []
+        }
+
+        all_issues = emotional_issues + behavioral_issues + quality_issues
+        # 合并所有建议,但是有的emotional_issues可能是[]，这样写会报错
+        # all_suggestions = emotional_issues["suggestions"] + behavioral_issues["suggestions"] + quality_issues["suggestions"]
+        all_suggestions = []
+        count = 0
+        for issue in all_issues:
+            for suggestion in issue.get("suggestions", []):
+                all_suggestions.append(f"{count}. {suggestion}")
+                count += 1
+
+        if all_issues:
+            result["status"] = "alert"
+            result["anomalies"] = all_issues
+            result["risk_level"] = self._determine_risk_level(all_issues)
+            result["suggestions"] = all_suggestions
+        return result
+
     def _determine_risk_level(self, issues: List[Dict]) -> str:
         """根据所有发现的问题确定整体风险等级"""
         severity_scores = {
@@ -317,8 +349,7 @@ class DialogueMonitor:
         try:
             response_content = await self.client.generate(
                 messages=messages,
-                temperature=0.1,
-                response_format={"type": "json_object"}
+                temperature=0.1
             )
             # print("====> _generate_suggestions API Response:", response_content)
             suggestions = response_content.strip().split("\n")
@@ -0,0 +1,179 @@
+import hashlib
+import json
+import time
+from collections import OrderedDict
+from itertools import count
+from typing import Dict, List, Optional, Set, Tuple
+import numpy as np
+from app.config import settings
+from app.core.pii import AhoCorasick, PIIScanner
+from app.core.triage import CRISIS_LEXICON, NEGATIVE_LEXICON
+
+# 字符shingle滚动哈希的乘数（奇数，uint64运算自然按2^64取模）
+_SHINGLE_BASE = np.uint64(0x100000001B3)
+_MIX_1 = np.uint64(0xFF51AFD7ED558CCD)
+_MIX_2 = np.uint64(0xC4CEB9FE1A85EC53)
+
+
+class NearDuplicateIndex:
+    """
+    近似重复对话索引：对话文本按字符shingle计算MinHash签名，LSH分桶查找候选，
+    按签名估计的Jaccard相似度不低于threshold时复用该对话此前的检测结论。
+    只在同一个namespace（检测器、system prompt、模型、temperature相同）内匹配；
+    条数上限 + TTL淘汰，结论以字符串保存，避免调用方修改索引里的对象。
+    相似度只看字面重合，多出的一句"我想自杀"也只差几个shingle，所以额外比较风险信号：
+    含危机词或敏感信息的对话不复用也不入索引，负面词的命中（含次数）必须与已有条目完全一致。
+    """
+
+    def __init__(
+        self,
+        threshold: float = 0.9,
+        num_perm: int = 64,
+        bands: int = 8,
+        shingle: int = 4,
+        max_entries: int = 20000,
+        ttl: float = 3600,
+        seed: int = 1
+    ):
+        if num_perm % bands:
+            raise ValueError(f"num_perm({num_perm})必须能被bands({bands})整除")
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.shingle = shingle
+        self.max_entries = max_entries
+        self.ttl = ttl
+        # multiply-shift哈希族：h(x) = (a*x + b) >> 32，a为奇数
+        rng = np.random.default_rng(seed)
+        self._a = rng.integers(1, 2 ** 63, size=(num_perm, 1), dtype=np.uint64) | np.uint64(1)
+        self._b = rng.integers(0, 2 ** 63, size=(num_perm, 1), dtype=np.uint64)
+        self._lexicon = AhoCorasick(
+            [(w, "crisis") for w in CRISIS_LEXICON] + [(w, "negative") for w in NEGATIVE_LEXICON]
+        )
+        self._pii = PIIScanner()
+        # id -> (namespace, 签名, 分桶key, 过期时间, 风险信号, 序列化后的结论)
+        self._entries: "OrderedDict[int, tuple]" = OrderedDict()
+        self._buckets: Dict[Tuple[str, int, bytes], Set[int]] = {}
+        self._ids = count()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @classmethod
+    def from_settings(cls) -> "NearDuplicateIndex":
+        return cls(
+            threshold=settings.NEAR_DUP_THRESHOLD,
+            num_perm=settings.NEAR_DUP_NUM_PERM,
+            bands=settings.NEAR_DUP_BANDS,
+            shingle=settings.NEAR_DUP_SHINGLE,
+            max_entries=settings.NEAR_DUP_MAX_ENTRIES,
+            ttl=settings.NEAR_DUP_TTL
+        )
+
+    @staticmethod
+    def namespace(detector: str, messages: List[Dict], model: str, temperature: float) -> str:
+        """除最后一条消息（对话文本）之外的请求内容的哈希"""
+        payload = json.dumps(
+            [detector, [(m["role"], m["content"]) for m in messages[:-1]], messages[-1]["role"], model, temperature],
+            ensure_ascii=False
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def signature(self, text: str) -> np.ndarray:
+        """文本的MinHash签名(uint32, num_perm维)；忽略空白和大小写"""
+        text = "".join(text.lower().split())
+        codes = np.frombuffer(text.encode("utf-32-le"), dtype=np.uint32).astype(np.uint64)
+        k = min(self.shingle, len(codes)) or 1
+        n = max(len(codes) - k + 1, 1)
+        if not len(codes):
+            codes = np.zeros(1, dtype=np.uint64)
+        shingles = np.zeros(n, dtype=np.uint64)
+        for j in range(k):
+            shingles = shingles * _SHINGLE_BASE + codes[j:j + n]
+        # 混合高低位，再去重
+        shingles ^= shingles >> np.uint64(33)
+        shingles *= _MIX_1
+        shingles ^= shingles >> np.uint64(33)
+        shingles *= _MIX_2
+        shingles = np.unique(shingles)
+        hashed = (self._a * shingles + self._b) >> np.uint64(32)
+        return hashed.min(axis=1).astype(np.uint32)
+
+    def risk_signals(self, text: str) -> Optional[str]:
+        """
+        对话文本的风险信号：按次数排列的负面词命中；含危机词或敏感信息时返回None，
+        表示这段对话的结论不能借用也不能借给别的对话
+        """
+        if self._pii.scan_text(text):
+            return None
+        hits = []
+        for _, keyword, category in self._lexicon.search(text):
+            if category == "crisis":
+                return None
+            hits.append(keyword)
+        return ",".join(sorted(hits))
+
+    def lookup(self, namespace: str, signature: np.ndarray, signals: str = "") -> Optional[Tuple[Dict, float]]:
+        """返回 (结论, 估计的相似度)；没有足够相似且风险信号相同的对话时返回None"""
+        candidates = set()
+        for key in self._bucket_keys(namespace, signature):
+            candidates.update(self._buckets.get(key, ()))
+
+        now = time.time()
+        best, best_similarity = None, 0.0
+        for entry_id in candidates:
+            _, other, _, expires_at, other_signals, _ = self._entries[entry_id]
+            if expires_at <= now:
+                self._remove(entry_id)
+                continue
+            if other_signals != signals:
+                continue
+            similarity = float(np.count_nonzero(other == signature)) / self.num_perm
+            if similarity > best_similarity:
+                best, best_similarity = entry_id, similarity
+
+        if best is None or best_similarity < self.threshold:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(best)
+        self.hits += 1
+        return json.loads(self._entries[best][5]), best_similarity
+
+    def add(self, namespace: str, signature: np.ndarray, value: Dict, signals: str = ""):
+        entry_id = next(self._ids)
+        keys = self._bucket_keys(namespace, signature)
+        self._entries[entry_id] = (
+            namespace, signature, keys, time.time() + self.ttl, signals, json.dumps(value, ensure_ascii=False)
+        )
+        for key in keys:
+            self._buckets.setdefault(key, set()).add(entry_id)
+        while len(self._entries) > self.max_entries:
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+
+    def stats(self) -> Dict:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0,
+            "entries": len(self._entries),
+            "buckets": len(self._buckets),
+        }
+
+    def _bucket_keys(self, namespace: str, signature: np.ndarray) -> List[Tuple[str, int, bytes]]:
+        return [
+            (namespace, band, signature[band * self.rows:(band + 1) * self.rows].tobytes())
+            for band in range(self.bands)
+        ]
+
+    def _remove(self, entry_id: int):
+        _, _, keys, _, _, _ = self._entries.pop(entry_id)
+        for key in keys:
+            bucket = self._buckets.get(key)
+            if bucket is not None:
+                bucket.discard(entry_id)
+                if not bucket:
+                    del self._buckets[key]
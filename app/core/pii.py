@@ -0,0 +1,233 @@
+import json
+import re
+from collections import deque
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional, Tuple
+from app.config import settings
+
+
+# 默认的敏感词表，可以通过 PII_LEXICON_PATH 指向一个 {"类别": ["关键词", ...]} 的JSON文件替换
+DEFAULT_LEXICON = {
+    "credential": ["密码", "支付密码", "登录密码", "验证码", "口令", "password", "CVV", "安全码"],
+    "identity": ["身份证号", "身份证号码", "银行卡号", "信用卡号", "护照号", "社保号", "开户行"],
+    "address": ["家庭住址", "详细地址", "门牌号"],
+}
+
+FINDING_NAMES = {
+    "id_card": "身份证号",
+    "bank_card": "银行卡号",
+    "possible_bank_card": "疑似银行卡号",
+    "phone": "手机号",
+    "email": "邮箱",
+    "credential": "密码/验证码相关",
+    "identity": "证件/卡号相关",
+    "address": "住址相关",
+}
+
+_ID_CARD = re.compile(
+    r"(?<![0-9Xx])[1-9]\d{5}(?:18|19|20)\d{2}(?:0[1-9]|1[0-2])(?:0[1-9]|[12]\d|3[01])\d{3}[\dXx](?![0-9Xx])"
+)
+_BANK_CARD = re.compile(r"(?<!\d)\d(?:[ -]?\d){12,18}(?!\d)")
+_PHONE = re.compile(r"(?<!\d)(?:\+?86[- ]?)?1[3-9]\d{9}(?!\d)")
+_EMAIL = re.compile(r"[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Za-z]{2,}")
+
+# 银行卡号前后出现这些词时才认定为银行卡号（可以直接判定）
+_CARD_CONTEXT = ("卡号", "银行卡", "信用卡", "储蓄卡", "借记卡", "银联", "开户行", "card")
+# 订单号、快递单号等同样是长数字串，约1/10能通过Luhn校验
+_NON_CARD_CONTEXT = ("订单", "单号", "运单", "快递", "物流", "流水号", "编号", "工号", "学号", "order", "tracking")
+_CONTEXT_CHARS = 12
+
+_ID_WEIGHTS = (7, 9, 10, 5, 8, 4, 2, 1, 6, 3, 7, 9, 10, 5, 8, 4, 2)
+_ID_CHECK = "10X98765432"
+
+
+def valid_id_card(number: str) -> bool:
+    """18位身份证校验码 (GB 11643)"""
+    total = sum(int(d) * w for d, w in zip(number[:17], _ID_WEIGHTS))
+    return _ID_CHECK[total % 11] == number[17].upper()
+
+
+def valid_luhn(number: str) -> bool:
+    total = 0
+    for i, ch in enumerate(reversed(number)):
+        d = int(ch)
+        if i % 2 == 1:
+            d *= 2
+            if d > 9:
+                d -= 9
+        total += d
+    return total % 10 == 0
+
+
+def valid_iin(number: str) -> bool:
+    """发卡行识别码：银联62、Visa 4、Mastercard 51-55/2221-2720、美国运通34/37、JCB 35、Discover 6011/65"""
+    if number.startswith(("62", "4", "34", "37", "35", "6011", "65")):
+        return True
+    prefix = int(number[:4])
+    return 5100 <= prefix <= 5599 or 2221 <= prefix <= 2720
+
+
+def card_context(text: str, start: int, end: int) -> Optional[bool]:
+    """数字串附近的上下文：True为银行卡相关，False为订单号等，None为无法判断"""
+    before = text[max(start - _CONTEXT_CHARS, 0):start].lower()
+    after = text[end:end + _CONTEXT_CHARS // 2].lower()
+    if any(word in before for word in _NON_CARD_CONTEXT):
+        return False
+    if any(word in before or word in after for word in _CARD_CONTEXT):
+        return True
+    return None
+
+
+def mask(value: str) -> str:
+    """结果里只保留首尾，避免把敏感信息再传出去"""
+    if len(value) <= 4:
+        return "*" * len(value)
+    keep = 3 if len(value) > 8 else 1
+    return value[:keep] + "*" * (len(value) - 2 * keep) + value[-keep:]
+
+
+class AhoCorasick:
+    """多模式关键词匹配自动机，一次扫描找出所有关键词"""
+
+    def __init__(self, keywords: Iterable[Tuple[str, str]]):
+        # 每个节点: goto表, fail指针, 输出(关键词, 类别)
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._out: List[List[Tuple[str, str]]] = [[]]
+        for keyword, category in keywords:
+            self._add(keyword.lower(), category)
+        self._build()
+
+    def _add(self, keyword: str, category: str):
+        node = 0
+        for ch in keyword:
+            nxt = self._goto[node].get(ch)
+            if nxt is None:
+                nxt = len(self._goto)
+                self._goto[node][ch] = nxt
+                self._goto.append({})
+                self._fail.append(0)
+                self._out.append([])
+            node = nxt
+        self._out[node].append((keyword, category))
+
+    def _build(self):
+        queue = deque(self._goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for ch, nxt in self._goto[node].items():
+                queue.append(nxt)
+                fail = self._fail[node]
+                while fail and ch not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[nxt] = self._goto[fail].get(ch, 0)
+                self._out[nxt] = self._out[nxt] + self._out[self._fail[nxt]]
+
+    def search(self, text: str) -> List[Tuple[int, str, str]]:
+        """返回 (结束位置, 关键词, 类别) 列表"""
+        matches = []
+        node = 0
+        for i, ch in enumerate(text.lower()):
+            while node and ch not in self._goto[node]:
+                node = self._fail[node]
+            node = self._goto[node].get(ch, 0)
+            for keyword, category in self._out[node]:
+                matches.append((i, keyword, category))
+        return matches
+
+
+class PIIScanner:
+    """
+    本地敏感信息预检：正则 + 校验位识别身份证号、银行卡号、手机号、邮箱，
+    AC自动机匹配敏感词表。命中决定性类型时可以直接给出 "high" 结论，不必等待LLM。
+    长数字串需要通过Luhn和发卡行前缀校验，且附近有卡号相关的词才认定为bank_card；
+    没有上下文时记为possible_bank_card，只作为提示交给LLM判断。
+    """
+
+    def __init__(self, lexicon: Optional[Dict[str, List[str]]] = None, short_circuit_types: Iterable[str] = ()):
+        lexicon = lexicon if lexicon is not None else DEFAULT_LEXICON
+        self.automaton = AhoCorasick(
+            (keyword, category) for category, keywords in lexicon.items() for keyword in keywords
+        )
+        self.short_circuit_types = set(short_circuit_types)
+
+    @classmethod
+    def from_settings(cls) -> "PIIScanner":
+        lexicon = None
+        if settings.PII_LEXICON_PATH:
+            with open(settings.PII_LEXICON_PATH, encoding="utf-8") as f:
+                lexicon = json.load(f)
+        return cls(lexicon, settings.PII_SHORT_CIRCUIT_TYPES)
+
+    def scan(self, conversation: List, offset: int = 0) -> List[Dict]:
+        findings = []
+        for index, msg in enumerate(conversation, start=offset):
+            findings.extend(self.scan_text(msg.content, msg.role, index))
+        return findings
+
+    def scan_text(self, text: str, role: str = "user", index: int = 0) -> List[Dict]:
+        findings = []
+        id_spans = []
+        for match in _ID_CARD.finditer(text):
+            if valid_id_card(match.group()):
+                id_spans.append(match.span())
+                findings.append(self._finding("id_card", match.group(), role, index))
+        for match in _BANK_CARD.finditer(text):
+            digits = re.sub(r"[ -]", "", match.group())
+            if 13 <= len(digits) <= 19 and valid_luhn(digits) and valid_iin(digits):
+                if any(start <= match.start() < end for start, end in id_spans):
+                    continue
+                if _PHONE.fullmatch(digits):
+                    continue
+                context = card_context(text, match.start(), match.end())
+                if context is False:
+                    continue
+                kind = "bank_card" if context else "possible_bank_card"
+                findings.append(self._finding(kind, digits, role, index))
+        for match in _PHONE.finditer(text):
+            findings.append(self._finding("phone", match.group(), role, index))
+        for match in _EMAIL.finditer(text):
+            findings.append(self._finding("email", match.group(), role, index))
+
+        seen = set()
+        for _, keyword, category in self.automaton.search(text):
+            if (keyword, category) in seen:
+                continue
+            seen.add((keyword, category))
+            findings.append({"type": category, "keyword": keyword, "role": role, "message_index": index})
+        return findings
+
+    def is_decisive(self, findings: List[Dict]) -> bool:
+        return any(f["type"] in self.short_circuit_types for f in findings)
+
+    def to_verdict(self, findings: List[Dict], session_id: str) -> Dict:
+        """把决定性的本地命中转换为与SecurityManager相同格式的结论"""
+        types = sorted({f["type"] for f in findings if f["type"] in self.short_circuit_types})
+        names = "、".join(FINDING_NAMES.get(t, t) for t in types)
+        return {
+            "has_issues": True,
+            "severity": "high",
+            "risk_types": ["敏感个人信息"] + types,
+            "description": f"本地预检在对话中发现敏感个人信息: {names}",
+            "recommendations": [
+                "提醒用户不要在对话中透露身份证号、银行卡号等敏感信息",
+                "对相关对话内容进行脱敏处理"
+            ],
+            "requires_immediate_action": False,
+            "local_findings": findings,
+            "session_id": session_id,
+            "timestamp": datetime.now().isoformat()
+        }
+
+    @staticmethod
+    def to_hint(findings: List[Dict]) -> str:
+        """非决定性命中作为提示附加给LLM"""
+        counts: Dict[str, int] = {}
+        for f in findings:
+            counts[f["type"]] = counts.get(f["type"], 0) + 1
+        parts = [f"{FINDING_NAMES.get(t, t)}({n}处)" for t, n in counts.items()]
+        return "【本地预检提示】对话中可能包含: " + "、".join(parts) + "，请结合上下文判断是否存在敏感信息风险。"
+
+    @staticmethod
+    def _finding(kind: str, value: str, role: str, index: int) -> Dict:
+        return {"type": kind, "value": mask(value), "role": role, "message_index": index}
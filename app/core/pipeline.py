@@ -0,0 +1,237 @@
+import asyncio
+import time
+from contextlib import contextmanager
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+from app.config import settings
+from app.core.fused import FusedAnalyzer
+from app.core.metrics import DETECTOR_ERRORS, DETECTOR_LATENCY, DETECTOR_SKIPPED, SECURITY_FALLBACKS, STAGE_LATENCY
+from app.core.model_client import reused_verdicts
+from app.core.monitor import DialogueMonitor
+from app.core.security import SecurityManager
+from app.core.session_store import SessionContext
+
+
+SEVERITY_RANK = {"low": 1, "medium": 2, "high": 3}
+
+
+@contextmanager
+def _stage(timings: Dict[str, float], name: str):
+    """记录一个阶段的耗时：写入指标，同时记入本次请求的timings"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        STAGE_LATENCY.observe(elapsed, stage=name)
+        timings[name] = round(elapsed, 4)
+
+
+class TimedOut:
+    """检测器超过截止时间时代替结果返回"""
+
+    def __init__(self, deadline: float):
+        self.deadline = deadline
+
+    def skipped_entry(self, detector: str) -> Dict:
+        return {"detector": detector, "reason": "timed_out", "deadline": self.deadline}
+
+
+class EarlyStopPolicy:
+    """
+    提前结束策略：某个检测器给出决定性结论后，取消其余还在进行的检测器。
+    规则格式为 "异常类型:严重程度"，如 "security:high"（严重的安全问题）、
+    "risk:high"（严重的自我伤害风险）、"*:high"（任意严重问题）；达到或超过该严重程度即命中。
+    安全检查只会被它自己的结论提前结束：其它检测器命中规则时，还在进行的安全检查继续运行。
+    """
+
+    def __init__(self, rules: List[str]):
+        self.rules = []
+        for rule in rules:
+            anomaly_type, _, severity = rule.partition(":")
+            self.rules.append((anomaly_type.strip(), SEVERITY_RANK.get(severity.strip(), 3)))
+
+    def decisive(self, detector: str, payload) -> Optional[str]:
+        """返回命中的规则，没有命中时返回None"""
+        if detector == "security":
+            if not payload.get("has_issues"):
+                return None
+            issues = [{"type": "security", "severity": payload.get("severity")}]
+        else:
+            issues = payload
+        for issue in issues:
+            rank = SEVERITY_RANK.get(issue.get("severity"), 0)
+            for anomaly_type, threshold in self.rules:
+                if anomaly_type in ("*", issue.get("type")) and rank >= threshold:
+                    return f"{issue.get('type')}:{issue.get('severity')}"
+        return None
+
+
+class MonitorPipeline:
+    """一次对话监控的完整流程：加载会话状态 -> 运行检测器 -> 保存会话状态"""
+
+    def __init__(
+        self,
+        security_manager: SecurityManager,
+        dialogue_monitor: DialogueMonitor,
+        session_store=None
+    ):
+        self.security_manager = security_manager
+        self.dialogue_monitor = dialogue_monitor
+        self.fused_analyzer = FusedAnalyzer(dialogue_monitor, security_manager)
+        self.session_store = session_store
+        self.early_stop = EarlyStopPolicy(settings.EARLY_STOP_RULES)
+
+    async def run(self, conversation: List[Dict], session_id: str) -> Tuple[Dict, Dict]:
+        """返回 (security_check, monitor_result)"""
+        final = None
+        async for event, payload in self.stream(conversation, session_id):
+            if event == "final":
+                final = payload
+        return final
+
+    async def stream(self, conversation: List[Dict], session_id: str) -> AsyncIterator[Tuple[str, object]]:
+        """
+        每个检测器完成时产出 (检测器名称, 结果)，最后产出 ("final", (security_check, monitor_result))。
+        调用方提前停止迭代时，未完成的检测器会被取消。
+        """
+        timings: Dict[str, float] = {}
+        # 检测器复用近似重复对话的结论时记入这个列表（随ContextVar被下面创建的task继承）
+        reused: List[Dict] = []
+        reused_verdicts.set(reused)
+        with _stage(timings, "session_load"):
+            session = await self.load_session(conversation, session_id)
+
+        if settings.ANALYSIS_MODE == "fused":
+            # 融合模式：四个检测合并为一次LLM请求
+            with _stage(timings, "detectors"):
+                fused = await self._timed("fused", self.fused_analyzer.analyze(
+                    conversation,
+                    session_id,
+                    session
+                ), timings)
+            if isinstance(fused, TimedOut):
+                security_check = self.security_manager.skipped_result(session_id, "timed_out")
+                monitor_result = self.dialogue_monitor.build_result([], [], [])
+                monitor_result["skipped_detectors"] = [
+                    fused.skipped_entry(name) for name in ("security", "emotional", "behavioral", "quality")
+                ]
+                if session is not None:
+                    session.failed = True
+            else:
+                security_check, monitor_result = fused
+            self._record_errors("fused", monitor_result["anomalies"])
+            self._record_errors("security", security_check)
+            self._record_skipped(monitor_result.get("skipped_detectors", []))
+            with _stage(timings, "session_save"):
+                await self.save_session(session)
+            monitor_result["stage_latencies"] = timings
+            monitor_result["reused_verdicts"] = reused
+            yield "final", (security_check, monitor_result)
+            return
+
+        decision = self.dialogue_monitor.triage_decision(conversation, session)
+        skipped = decision is not None and decision["tier"] == "skip"
+        detectors = {
+            "security": self.security_manager.check_dialogue_safety(conversation, session_id, session)
+        }
+        if not skipped:
+            detectors.update(self.dialogue_monitor.detectors(conversation, session))
+
+        detectors_start = time.perf_counter()
+        tasks = {asyncio.ensure_future(self._timed(name, coro, timings)): name for name, coro in detectors.items()}
+        results = {}
+        cancelled = []
+        pending = set(tasks)
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                decided_by = decider = None
+                for task in done:
+                    name = tasks[task]
+                    if isinstance(task.result(), TimedOut):
+                        # 超时的检测器不推送部分结果，在最终结果的skipped_detectors中说明
+                        cancelled.append(task.result().skipped_entry(name))
+                        continue
+                    results[name] = task.result()
+                    self._record_errors(name, results[name])
+                    if decided_by is None:
+                        decided_by = self.early_stop.decisive(name, results[name])
+                        decider = name if decided_by else None
+                    yield name, results[name]
+                if decided_by and pending:
+                    # 最终结论已经不会再变，取消剩余检测器（同时中断其上游HTTP请求）；
+                    # 安全检查只会被它自己的结论提前结束，其它检测器的结论不能代替它
+                    stopped = {task for task in pending if tasks[task] != "security" or decider == "security"}
+                    for task in stopped:
+                        task.cancel()
+                        cancelled.append({"detector": tasks[task], "reason": "cancelled", "decided_by": decided_by})
+                    pending -= stopped
+        finally:
+            for task in pending:
+                task.cancel()
+        timings["detectors"] = round(time.perf_counter() - detectors_start, 4)
+        STAGE_LATENCY.observe(timings["detectors"], stage="detectors")
+
+        if cancelled and session is not None:
+            # 被取消或超时的检测器没有看到新增轮次，不推进会话的已分析前缀
+            session.failed = True
+        if "security" in results:
+            security_check = results.pop("security")
+        else:
+            reason = next((item["reason"] for item in cancelled if item["detector"] == "security"), "cancelled")
+            security_check = self.security_manager.skipped_result(session_id, reason)
+        if skipped:
+            monitor_result = self.dialogue_monitor.skipped_result(decision, session)
+        else:
+            monitor_result = self.dialogue_monitor.finish(results, decision, session)
+        monitor_result["skipped_detectors"] = monitor_result.get("skipped_detectors", []) + cancelled
+        self._record_skipped(monitor_result["skipped_detectors"])
+
+        with _stage(timings, "session_save"):
+            await self.save_session(session)
+        monitor_result["stage_latencies"] = timings
+        monitor_result["reused_verdicts"] = reused
+        yield "final", (security_check, monitor_result)
+
+    @staticmethod
+    async def _timed(name: str, coro, timings: Optional[Dict[str, float]] = None):
+        """运行检测器并记录耗时（同时记入本次请求的timings）；超过该检测器的截止时间时取消并返回TimedOut"""
+        deadline = settings.DETECTOR_DEADLINES.get(name, settings.DETECTOR_DEFAULT_DEADLINE)
+        start = time.perf_counter()
+        try:
+            result = await asyncio.wait_for(coro, deadline) if deadline and deadline > 0 else await coro
+        except asyncio.TimeoutError:
+            result = TimedOut(deadline)
+        elapsed = time.perf_counter() - start
+        DETECTOR_LATENCY.observe(elapsed, detector=name)
+        if timings is not None:
+            timings[f"detector.{name}"] = round(elapsed, 4)
+        return result
+
+    @staticmethod
+    def _record_errors(name: str, payload):
+        if name == "security":
+            if "system_error" in payload.get("risk_types", []):
+                SECURITY_FALLBACKS.inc()
+                DETECTOR_ERRORS.inc(detector=name)
+        elif any(issue.get("type") == "system" for issue in payload):
+            DETECTOR_ERRORS.inc(detector=name)
+
+    @staticmethod
+    def _record_skipped(skipped: List[Dict]):
+        for item in skipped:
+            DETECTOR_SKIPPED.inc(detector=item["detector"], reason=item["reason"])
+
+    async def load_session(self, conversation: List[Dict], session_id: str) -> Optional[SessionContext]:
+        if not settings.INCREMENTAL_ANALYSIS or self.session_store is None:
+            return None
+        # 同一个session重发完整历史时，只分析新增的轮次
+        state = await self.session_store.get(session_id)
+        return SessionContext(session_id, conversation, state)
+
+    async def save_session(self, session: Optional[SessionContext]):
+        if session is None:
+            return
+        next_state = session.next_state()
+        if next_state is not None:
+            await self.session_store.save(next_state)
@@ -0,0 +1,251 @@
+import asyncio
+import random
+import time
+from email.utils import parsedate_to_datetime
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+import openai
+from app.config import settings
+
+
+# 各服务商的默认配额，0表示不限制；可以通过 UPSTREAM_* 配置覆盖
+PROVIDER_LIMITS = {
+    "openai": {"rps": 8.0, "tpm": 200000, "max_inflight": 32},
+    "deepseek": {"rps": 10.0, "tpm": 0, "max_inflight": 32},
+    # 自部署的vLLM没有配额，只需要限制排队深度
+    "local": {"rps": 0.0, "tpm": 0, "max_inflight": 64},
+}
+
+
+def estimate_text_tokens(text: str) -> int:
+    """粗略估计文本的token数：中日韩字符按1个token，其余按4个字符1个token"""
+    cjk = sum(1 for ch in text if "\u2e80" <= ch <= "\u9fff" or "\uf900" <= ch <= "\ufaff")
+    return cjk + (len(text) - cjk) // 4
+
+
+def estimate_tokens(messages: List[Dict]) -> int:
+    """粗略估计prompt的token数，每条消息另加4个token的格式开销"""
+    return sum(estimate_text_tokens(message["content"]) + 4 for message in messages)
+
+
+class TokenBucket:
+    """令牌桶，rate为每秒补充的令牌数，rate<=0时不限制"""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self, amount: float = 1.0):
+        if self.rate <= 0:
+            return
+        amount = min(amount, self.capacity)
+        # 加锁保证先到先得，避免大请求一直被小请求插队
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                await asyncio.sleep((amount - self.tokens) / self.rate)
+
+
+class SharedTokenBucket:
+    """
+    保存在sqlite中的令牌桶，同一台机器上的多个worker进程共享同一份配额；rate<=0时不限制。
+    每次acquire在一个写事务里按经过的时间补充令牌并预扣，不足的部分记为欠额，
+    调用方在事务外等到欠额按rate补齐，各进程按预扣的先后排队。
+    """
+
+    def __init__(self, db_path: str, name: str, rate: float, capacity: float):
+        self.db_path = db_path
+        self.name = name
+        self.rate = rate
+        self.capacity = capacity
+        self._db = None
+        # 同一个连接上的事务不能交叉
+        self._lock = asyncio.Lock()
+
+    async def acquire(self, amount: float = 1.0):
+        if self.rate <= 0:
+            return
+        amount = min(amount, self.capacity)
+        # 调用方被取消时也要让事务执行完，否则连接会停在未提交的事务里
+        wait = await asyncio.shield(self._reserve(amount))
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    async def _reserve(self, amount: float) -> float:
+        """预扣amount个令牌，返回需要等待的时间(秒)"""
+        async with self._lock:
+            db = await self._connect()
+            await db.execute("BEGIN IMMEDIATE")
+            try:
+                async with db.execute("SELECT tokens, updated_at FROM token_buckets WHERE name = ?", (self.name,)) as cursor:
+                    row = await cursor.fetchone()
+                # 多个进程之间用墙上时钟
+                now = time.time()
+                tokens = self.capacity
+                if row is not None:
+                    tokens = min(self.capacity, row[0] + max(now - row[1], 0.0) * self.rate)
+                tokens -= amount
+                await db.execute(
+                    "INSERT OR REPLACE INTO token_buckets (name, tokens, updated_at) VALUES (?, ?, ?)",
+                    (self.name, tokens, now)
+                )
+                await db.commit()
+            except BaseException:
+                await db.rollback()
+                raise
+        return -tokens / self.rate if tokens < 0 else 0.0
+
+    async def close(self):
+        if self._db is not None:
+            await self._db.close()
+            self._db = None
+
+    async def _connect(self):
+        if self._db is None:
+            import aiosqlite
+            # isolation_level=None：由_reserve显式开启写事务
+            self._db = await aiosqlite.connect(self.db_path, isolation_level=None)
+            await self._db.execute("PRAGMA journal_mode=WAL")
+            # 令牌桶的状态丢了也无妨，提交时不必fsync
+            await self._db.execute("PRAGMA synchronous=NORMAL")
+            await self._db.execute(
+                "CREATE TABLE IF NOT EXISTS token_buckets ("
+                "name TEXT PRIMARY KEY, tokens REAL NOT NULL, updated_at REAL NOT NULL)"
+            )
+        return self._db
+
+
+class UpstreamLimiter:
+    """
+    上游准入控制：请求数/秒 和 token数/分钟 两个令牌桶，加上最大在途请求数。
+    遇到429、5xx、连接错误时按带抖动的指数退避重试，优先遵循Retry-After。
+    bucket_path非空时两个令牌桶保存在该sqlite文件中（按name区分），多个进程共享配额；在途请求数仍按进程限制。
+    """
+
+    def __init__(
+        self,
+        rps: float = 0.0,
+        tpm: int = 0,
+        max_inflight: int = 64,
+        max_retries: int = 3,
+        backoff_base: float = 0.5,
+        backoff_max: float = 20.0,
+        bucket_path: str = "",
+        name: str = ""
+    ):
+        if bucket_path:
+            self.requests = SharedTokenBucket(bucket_path, f"{name}:requests", rps, max(rps, 1.0))
+            self.tokens = SharedTokenBucket(bucket_path, f"{name}:tokens", tpm / 60.0, tpm)
+        else:
+            self.requests = TokenBucket(rps, max(rps, 1.0))
+            self.tokens = TokenBucket(tpm / 60.0, tpm)
+        self.max_inflight = max_inflight
+        self.inflight = asyncio.Semaphore(max_inflight)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        # 收到Retry-After后所有请求都暂停到这个时间点
+        self._blocked_until = 0.0
+
+    @classmethod
+    def for_provider(
+        cls,
+        provider: str,
+        max_inflight: Optional[int] = None,
+        max_retries: Optional[int] = None,
+        name: Optional[str] = None
+    ) -> "UpstreamLimiter":
+        """按服务商的默认配额创建；UPSTREAM_* 配置和参数依次覆盖默认值。name为共享令牌桶的名称，默认为服务商"""
+        limits = dict(PROVIDER_LIMITS.get(provider, PROVIDER_LIMITS["local"]))
+        if settings.UPSTREAM_RPS is not None:
+            limits["rps"] = settings.UPSTREAM_RPS
+        if settings.UPSTREAM_TPM is not None:
+            limits["tpm"] = settings.UPSTREAM_TPM
+        if settings.UPSTREAM_MAX_INFLIGHT is not None:
+            limits["max_inflight"] = settings.UPSTREAM_MAX_INFLIGHT
+        if max_inflight is not None:
+            limits["max_inflight"] = max_inflight
+        return cls(
+            rps=limits["rps"],
+            tpm=limits["tpm"],
+            max_inflight=limits["max_inflight"],
+            max_retries=settings.UPSTREAM_MAX_RETRIES if max_retries is None else max_retries,
+            backoff_base=settings.UPSTREAM_BACKOFF_BASE,
+            backoff_max=settings.UPSTREAM_BACKOFF_MAX,
+            bucket_path=settings.RATE_LIMIT_SQLITE_PATH,
+            name=name or provider
+        )
+
+    async def call(self, fn: Callable[[], Awaitable], tokens: int = 0) -> Tuple[object, Dict]:
+        """在准入控制下调用fn，返回 (结果, {"queue_wait", "attempts", "retry_wait", "network"})"""
+        stats = {"queue_wait": 0.0, "attempts": 0, "retry_wait": 0.0, "network": 0.0}
+        while True:
+            wait_start = time.monotonic()
+            blocked = self._blocked_until - time.monotonic()
+            if blocked > 0:
+                await asyncio.sleep(blocked)
+            await self.requests.acquire(1)
+            await self.tokens.acquire(tokens)
+            await self.inflight.acquire()
+            stats["queue_wait"] += time.monotonic() - wait_start
+            stats["attempts"] += 1
+            call_start = time.monotonic()
+            try:
+                result = await fn()
+                stats["network"] = time.monotonic() - call_start
+                return result, stats
+            except Exception as e:
+                if not self._retryable(e) or stats["attempts"] > self.max_retries:
+                    raise
+                delay = self._retry_delay(e, stats["attempts"])
+            finally:
+                self.inflight.release()
+            stats["retry_wait"] += delay
+            await asyncio.sleep(delay)
+
+    async def aclose(self):
+        for bucket in (self.requests, self.tokens):
+            if isinstance(bucket, SharedTokenBucket):
+                await bucket.close()
+
+    @staticmethod
+    def _retryable(error: Exception) -> bool:
+        if isinstance(error, (openai.RateLimitError, openai.APIConnectionError, openai.InternalServerError)):
+            return True
+        return isinstance(error, openai.APIStatusError) and error.status_code in (408, 409, 429, 502, 503, 504)
+
+    def _retry_delay(self, error: Exception, attempt: int) -> float:
+        retry_after = self._retry_after(error)
+        if retry_after is not None:
+            delay = min(retry_after, self.backoff_max)
+            if isinstance(error, openai.RateLimitError):
+                self._blocked_until = max(self._blocked_until, time.monotonic() + delay)
+            return delay
+        # full jitter
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** (attempt - 1)))
+
+    @staticmethod
+    def _retry_after(error: Exception) -> Optional[float]:
+        response = getattr(error, "response", None)
+        if response is None:
+            return None
+        headers = response.headers
+        try:
+            if "retry-after-ms" in headers:
+                return float(headers["retry-after-ms"]) / 1000
+            if "retry-after" in headers:
+                value = headers["retry-after"]
+                try:
+                    return max(float(value), 0.0)
+                except ValueError:
+                    return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+        except (TypeError, ValueError):
+            return None
+        return None
@@ -0,0 +1,481 @@
+import asyncio
+import json
+import logging
+import time
+from typing import Dict, List, Optional, Tuple
+from app.config import settings
+from app.core.metrics import RESULT_QUEUE_SIZE, RESULT_WRITES, STAGE_LATENCY
+
+logger = logging.getLogger(__name__)
+
+_SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS monitoring_results ("
+    "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+    "session_id TEXT NOT NULL, "
+    "created_at REAL NOT NULL, "
+    "endpoint TEXT NOT NULL, "
+    "status TEXT NOT NULL, "
+    "risk_level TEXT NOT NULL, "
+    "suggestions TEXT NOT NULL, "
+    "security_status TEXT, "
+    "triage TEXT, "
+    "skipped_detectors TEXT NOT NULL, "
+    "stage_latencies TEXT NOT NULL, "
+    "total_latency REAL, "
+    "upstream_calls TEXT, "
+    "prev_risk_level TEXT, "
+    "turns INTEGER)",
+    "CREATE TABLE IF NOT EXISTS anomalies ("
+    "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+    "result_id INTEGER NOT NULL REFERENCES monitoring_results(id), "
+    "session_id TEXT NOT NULL, "
+    "created_at REAL NOT NULL, "
+    "type TEXT NOT NULL, "
+    "severity TEXT NOT NULL, "
+    "description TEXT NOT NULL)",
+    # 每个session最新的一条结论，批量查询最新结论时按主键查找
+    "CREATE TABLE IF NOT EXISTS session_latest ("
+    "session_id TEXT PRIMARY KEY, "
+    "result_id INTEGER NOT NULL, "
+    "created_at REAL NOT NULL, "
+    "risk_level TEXT NOT NULL)",
+]
+
+_INDEXES = [
+    # 单个session的时间线
+    "CREATE INDEX IF NOT EXISTS idx_results_session_time ON monitoring_results (session_id, created_at)",
+    # 按时间范围 / 风险等级筛选
+    "CREATE INDEX IF NOT EXISTS idx_results_time ON monitoring_results (created_at)",
+    "CREATE INDEX IF NOT EXISTS idx_results_risk_time ON monitoring_results (risk_level, created_at)",
+    # 风险升级（如low -> high）
+    "CREATE INDEX IF NOT EXISTS idx_results_transition ON monitoring_results (prev_risk_level, risk_level, created_at)",
+    "CREATE INDEX IF NOT EXISTS idx_anomalies_result ON anomalies (result_id, type)",
+    # 按异常类型筛选并翻页：按 (created_at, result_id) 倒序扫描这个索引
+    "DROP INDEX IF EXISTS idx_anomalies_type_time",
+    "CREATE INDEX IF NOT EXISTS idx_anomalies_type_time_result ON anomalies (type, created_at, result_id)",
+]
+
+# 旧版本的表缺少的列
+_ADDED_COLUMNS = {"prev_risk_level": "TEXT", "turns": "INTEGER"}
+
+
+def _dumps(value) -> Optional[str]:
+    return None if value is None else json.dumps(value, ensure_ascii=False, default=str)
+
+
+class ResultWriter:
+    """
+    监控结果的异步落库（write-behind）：请求只把记录放进内存队列，由后台任务按批写入sqlite（WAL，每批一个事务）。
+    队列有上限：满时调用方最多等待put_timeout秒（背压），超时后丢弃该条记录并计数；0为直接丢弃。
+    close时最多等待close_timeout秒写完队列中剩余的记录，后台任务已经退出或超时后丢弃剩余的记录。
+    """
+
+    def __init__(
+        self,
+        db_path: str,
+        max_queue: int = 10000,
+        batch_size: int = 200,
+        flush_interval: float = 0.5,
+        put_timeout: float = 0.5,
+        close_timeout: float = 5.0
+    ):
+        self.db_path = db_path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.put_timeout = put_timeout
+        self.close_timeout = close_timeout
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=max_queue)
+        self._db = None
+        self._task: Optional[asyncio.Task] = None
+        # 后台任务正在写入的一批，close时如果没有写完也计入丢弃
+        self._batch: List[Dict] = []
+        self._closing = False
+        self.dropped = 0
+
+    @classmethod
+    def from_settings(cls) -> "ResultWriter":
+        return cls(
+            settings.RESULT_DB_PATH,
+            max_queue=settings.RESULT_QUEUE_SIZE,
+            batch_size=settings.RESULT_BATCH_SIZE,
+            flush_interval=settings.RESULT_FLUSH_INTERVAL,
+            put_timeout=settings.RESULT_QUEUE_PUT_TIMEOUT,
+            close_timeout=settings.RESULT_CLOSE_TIMEOUT
+        )
+
+    async def start(self):
+        await self._connect()
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def submit(self, record: Dict) -> bool:
+        """放入写队列，不等待落库；队列已满且等待超时时丢弃并返回False"""
+        if self._closing:
+            return self._drop(record)
+        try:
+            self._queue.put_nowait(record)
+        except asyncio.QueueFull:
+            if self.put_timeout <= 0:
+                return self._drop(record)
+            try:
+                await asyncio.wait_for(self._queue.put(record), self.put_timeout)
+            except asyncio.TimeoutError:
+                return self._drop(record)
+        RESULT_QUEUE_SIZE.set(self._queue.qsize())
+        return True
+
+    def _drop(self, record: Dict) -> bool:
+        RESULT_WRITES.inc(outcome="dropped")
+        self.dropped += 1
+        # 持续丢弃时不逐条打日志
+        if self.dropped == 1 or self.dropped % 1000 == 0:
+            logger.warning(
+                "result queue full or closing, dropped result of session %s (%d dropped so far)",
+                record.get("session_id"), self.dropped
+            )
+        return False
+
+    async def _run(self):
+        while True:
+            batch = [await self._queue.get()]
+            # 攒一批：最多batch_size条或等待flush_interval
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            self._batch = batch
+            await self._flush(batch)
+            self._batch = []
+            for _ in batch:
+                self._queue.task_done()
+            RESULT_QUEUE_SIZE.set(self._queue.qsize())
+
+    async def _flush(self, batch: List[Dict]):
+        try:
+            with STAGE_LATENCY.time(stage="result_flush"):
+                await self.write(batch)
+            RESULT_WRITES.inc(len(batch), outcome="written")
+        except Exception:
+            # 写入失败不影响服务，记录日志和计数
+            logger.exception("failed to persist %d monitoring results", len(batch))
+            RESULT_WRITES.inc(len(batch), outcome="failed")
+            await self._db.rollback()
+
+    async def write(self, records: List[Dict]):
+        """在一个事务中写入一批记录"""
+        db = await self._connect()
+        for record in records:
+            # 同一批里同一个session的多条记录按顺序写入，后一条能读到前一条
+            async with db.execute(
+                "SELECT risk_level FROM session_latest WHERE session_id = ?", (record["session_id"],)
+            ) as cursor:
+                previous = await cursor.fetchone()
+            cursor = await db.execute(
+                "INSERT INTO monitoring_results (session_id, created_at, endpoint, status, risk_level, suggestions, "
+                "security_status, triage, skipped_detectors, stage_latencies, total_latency, upstream_calls, "
+                "prev_risk_level, turns) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    record["session_id"],
+                    record["created_at"],
+                    record["endpoint"],
+                    record["status"],
+                    record["risk_level"],
+                    _dumps(record.get("suggestions", [])),
+                    _dumps(record.get("security_status")),
+                    _dumps(record.get("triage")),
+                    _dumps(record.get("skipped_detectors", [])),
+                    _dumps(record.get("stage_latencies", {})),
+                    record.get("total_latency"),
+                    _dumps(record.get("upstream_calls")),
+                    previous[0] if previous else None,
+                    record.get("turns"),
+                )
+            )
+            result_id = cursor.lastrowid
+            await db.execute(
+                "INSERT OR REPLACE INTO session_latest (session_id, result_id, created_at, risk_level) VALUES (?, ?, ?, ?)",
+                (record["session_id"], result_id, record["created_at"], record["risk_level"])
+            )
+            await db.executemany(
+                "INSERT INTO anomalies (result_id, session_id, created_at, type, severity, description) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                [
+                    (result_id, record["session_id"], record["created_at"],
+                     anomaly["type"], anomaly["severity"], anomaly["description"])
+                    for anomaly in record.get("anomalies", [])
+                ]
+            )
+        await db.commit()
+
+    async def close(self):
+        """停止接收新记录，写完队列中剩余的记录后关闭数据库；后台任务已退出或等待超时时丢弃剩余记录"""
+        self._closing = True
+        if self._task is not None:
+            if self._task.done():
+                if not self._task.cancelled() and self._task.exception() is not None:
+                    logger.error("result writer task died", exc_info=self._task.exception())
+            else:
+                try:
+                    await asyncio.wait_for(self._queue.join(), self.close_timeout)
+                except asyncio.TimeoutError:
+                    logger.error("result queue not drained within %.1fs", self.close_timeout)
+                self._task.cancel()
+                try:
+                    await self._task
+                except asyncio.CancelledError:
+                    pass
+            self._task = None
+        remaining = self._batch
+        while not self._queue.empty():
+            remaining.append(self._queue.get_nowait())
+        self._batch = []
+        if remaining:
+            logger.error("dropping %d monitoring results that were not persisted", len(remaining))
+            for record in remaining:
+                self._drop(record)
+        if self._db is not None:
+            await self._db.close()
+            self._db = None
+
+    async def _connect(self):
+        if self._db is None:
+            import aiosqlite
+            self._db = await aiosqlite.connect(self.db_path)
+            await self._db.execute("PRAGMA journal_mode=WAL")
+            # WAL模式下NORMAL只在checkpoint时fsync，批量写入时足够安全
+            await self._db.execute("PRAGMA synchronous=NORMAL")
+            for statement in _SCHEMA:
+                await self._db.execute(statement)
+            await self._migrate(self._db)
+            for statement in _INDEXES:
+                await self._db.execute(statement)
+            await self._db.commit()
+        return self._db
+
+    @staticmethod
+    async def _migrate(db):
+        """给旧版本的表补上新增的列，并根据已有记录生成session_latest"""
+        async with db.execute("PRAGMA table_info(monitoring_results)") as cursor:
+            columns = {row[1] for row in await cursor.fetchall()}
+        missing = [name for name in _ADDED_COLUMNS if name not in columns]
+        for name in missing:
+            await db.execute(f"ALTER TABLE monitoring_results ADD COLUMN {name} {_ADDED_COLUMNS[name]}")
+        if missing:
+            await db.execute(
+                "INSERT OR REPLACE INTO session_latest (session_id, result_id, created_at, risk_level) "
+                "SELECT session_id, id, created_at, risk_level FROM monitoring_results "
+                "WHERE id IN (SELECT max(id) FROM monitoring_results GROUP BY session_id)"
+            )
+
+
+def result_record(
+    endpoint: str,
+    session_id: str,
+    result,
+    stage_latencies: Dict,
+    total_latency: float,
+    upstream_calls: Optional[List[Dict]] = None,
+    turns: Optional[int] = None
+) -> Dict:
+    """把合并后的MonitoringResult整理为一条落库记录"""
+    record = result.model_dump()
+    record.update({
+        "session_id": session_id,
+        "created_at": time.time(),
+        "endpoint": endpoint,
+        "stage_latencies": stage_latencies,
+        "total_latency": round(total_latency, 4),
+        "upstream_calls": upstream_calls,
+        "turns": turns,
+    })
+    return record
+
+
+RISK_LEVELS = ["low", "medium", "high"]
+
+_RESULT_COLUMNS = (
+    "id, session_id, created_at, endpoint, status, risk_level, prev_risk_level, turns, "
+    "suggestions, security_status, triage, skipped_detectors, stage_latencies, total_latency"
+)
+_QUALIFIED_COLUMNS = ", ".join(f"r.{name.strip()}" for name in _RESULT_COLUMNS.split(","))
+_JSON_COLUMNS = ("suggestions", "security_status", "triage", "skipped_detectors", "stage_latencies")
+
+
+def encode_cursor(created_at: float, result_id: int) -> str:
+    return f"{created_at!r}:{result_id}"
+
+
+def decode_cursor(cursor: str) -> Tuple[float, int]:
+    created_at, _, result_id = cursor.partition(":")
+    try:
+        return float(created_at), int(result_id)
+    except ValueError:
+        raise ValueError(f"无效的cursor: {cursor}")
+
+
+class ResultQuery:
+    """
+    已落库监控结果的只读查询（单独的连接，WAL模式下不阻塞写入）。
+    列表查询按 (created_at, id) 倒序，用上一页最后一条的cursor翻页。
+    结果由ResultWriter异步写入，最近RESULT_FLUSH_INTERVAL秒内的结果可能还查不到。
+    """
+
+    # sqlite单条语句的参数个数有上限，IN查询分批
+    CHUNK_SIZE = 500
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self._db = None
+
+    async def _connect(self):
+        if self._db is None:
+            import aiosqlite
+            self._db = await aiosqlite.connect(self.db_path)
+            await self._db.execute("PRAGMA query_only=ON")
+        return self._db
+
+    async def results(
+        self,
+        session_id: Optional[str] = None,
+        risk_level: Optional[str] = None,
+        anomaly_type: Optional[str] = None,
+        since: Optional[float] = None,
+        until: Optional[float] = None,
+        limit: int = 100,
+        cursor: Optional[str] = None
+    ) -> Dict:
+        """按条件筛选监控结果，返回 {"items": [...], "next_cursor": 下一页的cursor或None}"""
+        conditions, params = [], []
+        if session_id is not None:
+            conditions.append("r.session_id = ?")
+            params.append(session_id)
+        if risk_level is not None:
+            conditions.append("r.risk_level = ?")
+            params.append(risk_level)
+        return await self._page(conditions, params, since, until, limit, cursor, anomaly_type)
+
+    async def escalations(
+        self,
+        to_level: str = "high",
+        from_levels: Optional[List[str]] = None,
+        since: Optional[float] = None,
+        until: Optional[float] = None,
+        limit: int = 100,
+        cursor: Optional[str] = None
+    ) -> Dict:
+        """风险等级从from_levels（默认为所有更低的等级）升到to_level的结果，如 low -> high"""
+        if from_levels is None:
+            from_levels = RISK_LEVELS[:RISK_LEVELS.index(to_level)]
+        if not from_levels:
+            return {"items": [], "next_cursor": None}
+        conditions = [
+            f"r.prev_risk_level IN ({', '.join('?' * len(from_levels))})",
+            "r.risk_level = ?",
+        ]
+        return await self._page(conditions, [*from_levels, to_level], since, until, limit, cursor)
+
+    async def latest(self, session_ids: List[str]) -> Dict[str, Dict]:
+        """批量查询每个session最新的一条结论；没有记录的session不在返回值中"""
+        db = await self._connect()
+        found: Dict[str, Dict] = {}
+        unique_ids = list(dict.fromkeys(session_ids))
+        for start in range(0, len(unique_ids), self.CHUNK_SIZE):
+            chunk = unique_ids[start:start + self.CHUNK_SIZE]
+            async with db.execute(
+                f"SELECT {_RESULT_COLUMNS} FROM monitoring_results r "
+                f"WHERE id IN (SELECT result_id FROM session_latest WHERE session_id IN ({', '.join('?' * len(chunk))}))",
+                chunk
+            ) as cursor:
+                rows = await cursor.fetchall()
+            for item in await self._items(db, rows):
+                found[item["session_id"]] = item
+        return found
+
+    async def _page(
+        self,
+        conditions: List[str],
+        params: List,
+        since: Optional[float],
+        until: Optional[float],
+        limit: int,
+        cursor: Optional[str],
+        anomaly_type: Optional[str] = None
+    ) -> Dict:
+        conditions, params = list(conditions), list(params)
+        if anomaly_type is not None:
+            # 从异常表的 (type, created_at, result_id) 索引出发按时间倒序扫描，再按主键取结果行；
+            # 异常记录里的created_at与所属结果相同，时间范围和cursor直接作用在索引列上
+            source = "anomalies a JOIN monitoring_results r ON r.id = a.result_id"
+            created_column, id_column = "a.created_at", "a.result_id"
+            conditions.insert(0, "a.type = ?")
+            params.insert(0, anomaly_type)
+        else:
+            source = "monitoring_results r"
+            created_column, id_column = "r.created_at", "r.id"
+        if since is not None:
+            conditions.append(f"{created_column} >= ?")
+            params.append(since)
+        if until is not None:
+            conditions.append(f"{created_column} < ?")
+            params.append(until)
+        if cursor:
+            created_at, result_id = decode_cursor(cursor)
+            conditions.append(f"({created_column} < ? OR ({created_column} = ? AND {id_column} < ?))")
+            params.extend([created_at, created_at, result_id])
+        where = f"WHERE {' AND '.join(conditions)} " if conditions else ""
+        # 同一条结果可能有多个同类型的异常
+        group = f"GROUP BY {created_column}, {id_column} " if anomaly_type is not None else ""
+
+        db = await self._connect()
+        # 多取一条用来判断是否还有下一页
+        async with db.execute(
+            f"SELECT {_QUALIFIED_COLUMNS} FROM {source} {where}{group}"
+            f"ORDER BY {created_column} DESC, {id_column} DESC LIMIT ?",
+            [*params, limit + 1]
+        ) as result_cursor:
+            rows = await result_cursor.fetchall()
+        items = await self._items(db, rows[:limit])
+        next_cursor = None
+        if len(rows) > limit:
+            last = items[-1]
+            next_cursor = encode_cursor(last["created_at"], last["id"])
+        return {"items": items, "next_cursor": next_cursor}
+
+    async def _items(self, db, rows) -> List[Dict]:
+        """把结果行转换为dict，并一次查出这些结果的异常"""
+        columns = [name.strip() for name in _RESULT_COLUMNS.split(",")]
+        items = []
+        for row in rows:
+            item = dict(zip(columns, row))
+            for name in _JSON_COLUMNS:
+                if item[name] is not None:
+                    item[name] = json.loads(item[name])
+            item["anomalies"] = []
+            items.append(item)
+        if not items:
+            return items
+
+        by_id = {item["id"]: item for item in items}
+        ids = list(by_id)
+        for start in range(0, len(ids), self.CHUNK_SIZE):
+            chunk = ids[start:start + self.CHUNK_SIZE]
+            async with db.execute(
+                f"SELECT result_id, type, severity, description FROM anomalies "
+                f"WHERE result_id IN ({', '.join('?' * len(chunk))}) ORDER BY id",
+                chunk
+            ) as cursor:
+                async for result_id, anomaly_type, severity, description in cursor:
+                    by_id[result_id]["anomalies"].append(
+                        {"type": anomaly_type, "severity": severity, "description": description}
+                    )
+        return items
+
+    async def close(self):
+        if self._db is not None:
+            await self._db.close()
+            self._db = None
@@ -0,0 +1,430 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Awaitable, Callable, Dict, List, Optional, Set, Tuple
+import httpx
+import openai
+from openai import AsyncOpenAI
+from app.config import settings
+from app.core.metrics import CIRCUIT_STATE, ENDPOINT_OUTSTANDING, ENDPOINT_REQUESTS, HEDGED_REQUESTS
+from app.core.rate_limit import UpstreamLimiter
+
+logger = logging.getLogger(__name__)
+
+_CIRCUIT_CODES = {"closed": 0, "half_open": 1, "open": 2}
+
+
+class CircuitBreaker:
+    """
+    单个端点的熔断器：连续失败failure_threshold次后打开，open_seconds内不再分配请求；
+    之后进入半开状态，只放行一个试探请求，成功则关闭，失败则重新打开。
+    """
+
+    def __init__(self, name: str, failure_threshold: int = 3, open_seconds: float = 30.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.open_seconds = open_seconds
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probing = False
+        CIRCUIT_STATE.set(0, endpoint=name)
+
+    def available(self) -> bool:
+        if self.state == "open" and time.monotonic() - self.opened_at >= self.open_seconds:
+            self._set_state("half_open")
+        if self.state == "half_open":
+            return not self._probing
+        return self.state == "closed"
+
+    def begin(self):
+        """请求被分配到该端点；半开状态下占用唯一的试探名额"""
+        if self.state == "half_open":
+            self._probing = True
+
+    def record_success(self):
+        self.failures = 0
+        self._probing = False
+        if self.state != "closed":
+            logger.info("upstream %s recovered", self.name)
+            self._set_state("closed")
+
+    def record_failure(self):
+        self.failures += 1
+        self._probing = False
+        if self.state == "half_open" or (self.state == "closed" and self.failures >= self.failure_threshold):
+            logger.warning("upstream %s circuit opened after %d failures", self.name, self.failures)
+            self.opened_at = time.monotonic()
+            self._set_state("open")
+
+    def release(self):
+        """请求结束但不能说明端点是否健康（如429、请求本身有误）"""
+        self._probing = False
+
+    def probe_succeeded(self):
+        """健康检查通过：打开状态的端点提前进入半开，由下一个真实请求确认"""
+        if self.state == "open":
+            self._set_state("half_open")
+
+    def _set_state(self, state: str):
+        self.state = state
+        CIRCUIT_STATE.set(_CIRCUIT_CODES[state], endpoint=self.name)
+
+
+class Endpoint:
+    """一个OpenAI兼容的上游端点：独立的准入控制、熔断器、在途请求数和EWMA延迟"""
+
+    def __init__(
+        self,
+        name: str,
+        provider: str,
+        client: AsyncOpenAI,
+        model: str,
+        limiter: UpstreamLimiter,
+        weight: float = 1.0,
+        priority: int = 0,
+        breaker: Optional[CircuitBreaker] = None
+    ):
+        self.name = name
+        self.provider = provider
+        self.client = client
+        self.model = model
+        self.limiter = limiter
+        self.weight = max(weight, 1e-6)
+        self.priority = priority
+        self.breaker = breaker or CircuitBreaker(name)
+        self.max_inflight = limiter.max_inflight
+        self.outstanding = 0
+        self.ewma_latency: Optional[float] = None
+
+    @property
+    def saturated(self) -> bool:
+        return self.outstanding >= self.max_inflight
+
+    def observe_latency(self, latency: float, alpha: float):
+        if self.ewma_latency is None:
+            self.ewma_latency = latency
+        else:
+            self.ewma_latency = alpha * latency + (1 - alpha) * self.ewma_latency
+
+    def status(self) -> Dict:
+        return {
+            "name": self.name,
+            "provider": self.provider,
+            "model": self.model,
+            "weight": self.weight,
+            "priority": self.priority,
+            "state": self.breaker.state,
+            "outstanding": self.outstanding,
+            "ewma_latency": round(self.ewma_latency, 3) if self.ewma_latency is not None else None,
+        }
+
+
+def _provider_of(config: Dict) -> str:
+    if config.get("provider"):
+        return config["provider"]
+    base_url = config.get("base_url", "")
+    if not base_url:
+        return "openai"
+    return "deepseek" if "deepseek.com" in base_url else "local"
+
+
+_DEFAULT_BASE_URLS = {"deepseek": "https://api.deepseek.com/v1"}
+
+
+def _default_api_key(provider: str) -> str:
+    return {
+        "openai": settings.OPENAI_API_KEY,
+        "deepseek": settings.DEEPSEEK_API_KEY,
+    }.get(provider, settings.DUMMPY_API_KEY)
+
+
+class HedgePolicy:
+    """
+    对冲请求策略：同一分组（检测器）的请求超过近期延迟的quantile分位数仍未返回时，向另一个端点再发一份。
+    对冲请求数不超过总请求数的budget比例；样本不足min_samples时不对冲。
+    """
+
+    def __init__(self, quantile: float = 0.95, budget: float = 0.05, min_samples: int = 20, window: int = 200):
+        self.quantile = quantile
+        self.budget = budget
+        self.min_samples = min_samples
+        self.window = window
+        self.requests = 0
+        self.hedges = 0
+        self._latencies: Dict[str, deque] = {}
+
+    @classmethod
+    def from_settings(cls) -> "HedgePolicy":
+        return cls(
+            quantile=settings.HEDGE_QUANTILE,
+            budget=settings.HEDGE_BUDGET,
+            min_samples=settings.HEDGE_MIN_SAMPLES,
+            window=settings.HEDGE_WINDOW
+        )
+
+    def observe(self, key: str, latency: float):
+        samples = self._latencies.get(key)
+        if samples is None:
+            samples = self._latencies[key] = deque(maxlen=self.window)
+        samples.append(latency)
+
+    def delay(self, key: str) -> Optional[float]:
+        """发出对冲请求前的等待时间，即该分组近期延迟的分位数"""
+        samples = self._latencies.get(key)
+        if samples is None or len(samples) < self.min_samples:
+            return None
+        ordered = sorted(samples)
+        return ordered[min(int(len(ordered) * self.quantile), len(ordered) - 1)]
+
+    def acquire(self) -> bool:
+        """占用一个对冲名额；超出预算时返回False"""
+        if self.hedges + 1 > self.budget * self.requests:
+            return False
+        self.hedges += 1
+        return True
+
+
+class EndpointRouter:
+    """
+    在多个上游端点之间分配请求：
+    - 只在熔断器关闭/半开、且没有打满在途上限的端点中选择；priority小的优先，高priority的端点只在前面的都不可用时溢出使用
+    - 同一优先级内按 在途请求数/权重 最少选择（strategy=ewma时再乘以EWMA延迟）
+    - 连接错误、超时、5xx、401/403计入熔断器并切换到下一个端点；429只切换不计入；其余4xx直接抛出
+    - 后台定时健康检查，打开状态的端点检查通过后提前进入半开
+    """
+
+    def __init__(
+        self,
+        endpoints: List[Endpoint],
+        strategy: str = "least_outstanding",
+        ewma_alpha: float = 0.3,
+        health_interval: float = 0.0,
+        health_timeout: float = 5.0,
+        hedge: Optional["HedgePolicy"] = None
+    ):
+        if not endpoints:
+            raise ValueError("EndpointRouter至少需要一个端点")
+        self.endpoints = endpoints
+        self.strategy = strategy
+        self.ewma_alpha = ewma_alpha
+        self.health_interval = health_interval
+        self.health_timeout = health_timeout
+        self.hedge = hedge
+        self._health_task: Optional[asyncio.Task] = None
+
+    @classmethod
+    def from_settings(cls, http_client: httpx.AsyncClient) -> "EndpointRouter":
+        """LLM_ENDPOINTS 非空时按列表创建；否则按 BASE_URL/DEEPSEEK_API_KEY/OPENAI_API_KEY 创建单个端点（与以前的行为相同）"""
+        if not settings.LLM_ENDPOINTS:
+            if settings.BASE_URL == "" and settings.DEEPSEEK_API_KEY == "":
+                print("====Using OpenAI API====")
+                config = {"provider": "openai"}
+            elif settings.DEEPSEEK_API_KEY != "":
+                print("====Using DeepSeek API====")
+                config = {"provider": "deepseek"}
+            else:
+                print("====Using Dummy API====")
+                config = {"provider": "local", "base_url": settings.BASE_URL}
+            return cls([cls._build_endpoint(config, http_client, settings.UPSTREAM_MAX_RETRIES)])
+
+        endpoints = [
+            cls._build_endpoint(config, http_client, settings.ROUTER_ENDPOINT_RETRIES)
+            for config in settings.LLM_ENDPOINTS
+        ]
+        print(f"====Routing across {len(endpoints)} endpoints: {', '.join(e.name for e in endpoints)}====")
+        return cls(
+            endpoints,
+            strategy=settings.ROUTER_STRATEGY,
+            ewma_alpha=settings.ROUTER_EWMA_ALPHA,
+            health_interval=settings.ROUTER_HEALTH_INTERVAL,
+            health_timeout=settings.ROUTER_HEALTH_TIMEOUT,
+            hedge=HedgePolicy.from_settings() if settings.HEDGE_ENABLED else None
+        )
+
+    @staticmethod
+    def _build_endpoint(config: Dict, http_client: httpx.AsyncClient, max_retries: int) -> Endpoint:
+        provider = _provider_of(config)
+        name = config.get("name") or provider
+        # 多端点时少量重试后就切换到其它端点，不在一个坏掉的端点上反复退避
+        limiter = UpstreamLimiter.for_provider(provider, config.get("max_inflight"), max_retries, name)
+        client = AsyncOpenAI(
+            base_url=config.get("base_url") or _DEFAULT_BASE_URLS.get(provider),
+            api_key=config.get("api_key") or _default_api_key(provider),
+            http_client=http_client,
+            max_retries=0
+        )
+        return Endpoint(
+            name=name,
+            provider=provider,
+            client=client,
+            model=config.get("model") or settings.MODEL_NAME,
+            limiter=limiter,
+            weight=config.get("weight", 1.0),
+            priority=config.get("priority", 0),
+            breaker=CircuitBreaker(
+                name,
+                failure_threshold=settings.ROUTER_FAILURE_THRESHOLD,
+                open_seconds=settings.ROUTER_OPEN_SECONDS
+            )
+        )
+
+    @property
+    def primary(self) -> Endpoint:
+        return self.endpoints[0]
+
+    def pick(self, exclude: Set[str] = frozenset()) -> Optional[Endpoint]:
+        candidates = [e for e in self.endpoints if e.name not in exclude]
+        if not candidates:
+            return None
+        # 全部熔断时仍然尝试，而不是直接失败
+        healthy = [e for e in candidates if e.breaker.available()] or candidates
+        pool = [e for e in healthy if not e.saturated] or healthy
+        tier = min(e.priority for e in pool)
+        return min((e for e in pool if e.priority == tier), key=self._score)
+
+    def _score(self, endpoint: Endpoint) -> float:
+        load = (endpoint.outstanding + 1) / endpoint.weight
+        if self.strategy == "ewma":
+            # 还没有延迟数据的端点按0处理，优先分配以获得样本
+            return load * (endpoint.ewma_latency or 0.0)
+        return load
+
+    async def call(
+        self,
+        fn: Callable[[Endpoint], Awaitable],
+        tokens: int = 0,
+        key: Optional[str] = None
+    ) -> Tuple[object, Dict, Endpoint]:
+        """
+        选择端点并在其准入控制下调用fn(endpoint)；端点故障时切换到下一个，返回 (结果, 统计, 端点)。
+        key为延迟统计的分组（检测器名称），配置了对冲策略时按该分组的延迟分位数决定何时发出对冲请求。
+        """
+        self._ensure_health_checks()
+        if self.hedge is None or key is None or len(self.endpoints) < 2:
+            return await self._call(fn, tokens, set())
+
+        start = time.monotonic()
+        result = await self._hedged_call(fn, tokens, key)
+        self.hedge.observe(key, time.monotonic() - start)
+        return result
+
+    async def _hedged_call(self, fn: Callable[[Endpoint], Awaitable], tokens: int, key: str):
+        self.hedge.requests += 1
+        delay = self.hedge.delay(key)
+        tried: Set[str] = set()
+        primary = asyncio.ensure_future(self._call(fn, tokens, tried))
+        if delay is None:
+            return await primary
+
+        tasks = {primary: "primary"}
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            if not done and len(tried) < len(self.endpoints) and self.hedge.acquire():
+                # 超过该检测器的延迟分位数仍未返回：向其它端点再发一份，取先成功的结果
+                tasks[asyncio.ensure_future(self._call(fn, tokens, set(tried)))] = "hedge"
+            pending = set(tasks)
+            while True:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                succeeded = [task for task in done if task.exception() is None]
+                if succeeded or not pending:
+                    # 两个请求都失败时抛出后失败的那个的异常
+                    task = succeeded[0] if succeeded else done.pop()
+                    if len(tasks) > 1:
+                        HEDGED_REQUESTS.inc(detector=key, winner=tasks[task])
+                    return task.result()
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def _call(self, fn: Callable[[Endpoint], Awaitable], tokens: int, tried: Set[str]):
+        """tried记录已经选过的端点（调用方可以据此把对冲请求发到其它端点）"""
+        stats = {"queue_wait": 0.0, "attempts": 0, "retry_wait": 0.0, "network": 0.0, "failovers": 0}
+        while True:
+            endpoint = self.pick(tried)
+            tried.add(endpoint.name)
+            endpoint.breaker.begin()
+            endpoint.outstanding += 1
+            ENDPOINT_OUTSTANDING.set(endpoint.outstanding, endpoint=endpoint.name)
+            try:
+                result, call_stats = await endpoint.limiter.call(lambda: fn(endpoint), tokens=tokens)
+            except asyncio.CancelledError:
+                # 被提前结束策略或对冲请求取消，不能说明端点是否健康
+                endpoint.breaker.release()
+                raise
+            except Exception as e:
+                action = self._classify(e)
+                if action == "failure":
+                    endpoint.breaker.record_failure()
+                else:
+                    endpoint.breaker.release()
+                if action == "raise" or len(tried) >= len(self.endpoints):
+                    ENDPOINT_REQUESTS.inc(endpoint=endpoint.name, result="error")
+                    raise
+                ENDPOINT_REQUESTS.inc(endpoint=endpoint.name, result="failover")
+                stats["failovers"] += 1
+                logger.warning("upstream %s failed (%s), failing over", endpoint.name, type(e).__name__)
+                continue
+            finally:
+                endpoint.outstanding -= 1
+                ENDPOINT_OUTSTANDING.set(endpoint.outstanding, endpoint=endpoint.name)
+
+            endpoint.breaker.record_success()
+            endpoint.observe_latency(call_stats["network"], self.ewma_alpha)
+            ENDPOINT_REQUESTS.inc(endpoint=endpoint.name, result="ok")
+            for key in ("queue_wait", "retry_wait"):
+                stats[key] += call_stats[key]
+            stats["attempts"] += call_stats["attempts"]
+            stats["network"] = call_stats["network"]
+            return result, stats, endpoint
+
+    @staticmethod
+    def _classify(error: Exception) -> str:
+        """failure: 端点故障，计入熔断并切换；failover: 只切换；raise: 请求本身的问题，直接抛出"""
+        if isinstance(error, (openai.APIConnectionError, openai.InternalServerError)):
+            return "failure"
+        if isinstance(error, openai.RateLimitError):
+            return "failover"
+        if isinstance(error, openai.APIStatusError):
+            if error.status_code >= 500 or error.status_code in (401, 403, 404, 408):
+                return "failure"
+            if error.status_code == 409:
+                return "failover"
+        return "raise"
+
+    def _ensure_health_checks(self):
+        if self.health_interval > 0 and self._health_task is None:
+            self._health_task = asyncio.get_running_loop().create_task(self._health_loop())
+
+    async def _health_loop(self):
+        while True:
+            await asyncio.sleep(self.health_interval)
+            await asyncio.gather(*[self.check(endpoint) for endpoint in self.endpoints])
+
+    async def check(self, endpoint: Endpoint) -> bool:
+        """健康检查：请求 /models；失败计入熔断器"""
+        try:
+            await asyncio.wait_for(endpoint.client.models.list(), self.health_timeout)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning("health check of upstream %s failed: %s", endpoint.name, e)
+            endpoint.breaker.record_failure()
+            return False
+        endpoint.breaker.probe_succeeded()
+        return True
+
+    def status(self) -> List[Dict]:
+        return [endpoint.status() for endpoint in self.endpoints]
+
+    async def aclose(self):
+        if self._health_task is not None:
+            self._health_task.cancel()
+            try:
+                await self._health_task
+            except asyncio.CancelledError:
+                pass
+            self._health_task = None
+        for endpoint in self.endpoints:
+            await endpoint.limiter.aclose()
@@ -1,26 +1,45 @@
 from datetime import datetime, timedelta
-from typing import Dict, List
+from typing import Dict, List, Optional
 import logging
 from pathlib import Path
-import time
 from fastapi import BackgroundTasks
 from openai import AsyncOpenAI
 from app.config import settings
-from app.core.model_client import OpenAIClient
+from app.core.context_window import ContextWindow
+from app.core.model_client import BaseModelClient, create_model_client
+from app.core.pii import PIIScanner
+from app.core.session_store import SessionContext
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 class SecurityManager:
-    def __init__(self):
-        self.client = OpenAIClient()
+    def __init__(self, client: Optional[BaseModelClient] = None, window: Optional[ContextWindow] = None):
+        # 由应用lifespan传入共享的client，避免每个请求都新建连接池
+        self.client = client or create_model_client()
+        self.window = window or ContextWindow.from_settings()
+        self.scanner = PIIScanner.from_settings() if settings.PII_PRESCREEN_ENABLED else None
         
     async def check_dialogue_safety(
         self, 
         conversation_history: List[Dict],
-        session_id: str
+        session_id: str,
+        session: Optional[SessionContext] = None
     ) -> Dict:
         """检查对话的安全性和合规性"""
+        if session is not None and session.unchanged and session.previous("security"):
+            # 对话没有新增内容，直接复用上次的结论
+            analysis = dict(session.previous("security"))
+            analysis["timestamp"] = datetime.now().isoformat()
+            return analysis
+
+        findings = self.prescreen(conversation_history, session)
+        if findings and self.scanner.is_decisive(findings):
+            # 本地已经能确定是严重的敏感信息泄露，不必等待LLM
+            analysis = self.scanner.to_verdict(findings, session_id)
+            if session is not None:
+                session.record("security", analysis)
+            return analysis
         
         messages = [
             {"role": "system", "content": """
@@ -34,73 +53,95 @@ class SecurityManager:
             请以JSON格式返回分析结果：
             {
                 "has_issues": bool,
+                "requires_immediate_action": bool,
                 "severity": "low|medium|high",
                 "risk_types": [检测到的风险类型],
                 "description": "详细描述",
-                "recommendations": [建议措施],
-                "requires_immediate_action": bool
+                "recommendations": [建议措施]
             }
             """}
         ]
         
-        cont = ""
-        for msg in conversation_history:
-            cont += f"{msg.role}: {msg.content}\n"
+        cont = self.window.transcript("security", conversation_history, session)
+        if findings:
+            cont += "\n" + self.scanner.to_hint(findings)
         messages.append({"role": 'user', "content": cont})
             
         try:
-            start_time = time.time()
-            response_content = await self.client.generate(
+            analysis = await self.client.generate_json(
                 messages=messages,
-                temperature=0.1,
-                response_format={"type": "json_object"}
+                detector="security",
+                temperature=0.1
             )
-            end_time = time.time()
-            
-            start_processing = time.time()
-            import json
-            import re
-            if "```" in response_content:
-                pattern = r"```(?:json)?\n?(.*?)```"
-                match = re.search(pattern, response_content, re.DOTALL)
-                if match:
-                    response_content = match.group(1).strip()
-            
-            analysis = json.loads(response_content)
-            end_processing = time.time()
+            analysis = self.finalize(analysis, session_id)
+            if findings:
+                analysis["local_findings"] = findings
 
-            analysis["session_id"] = session_id
-            analysis["timestamp"] = datetime.now().isoformat()
-            
-            if analysis["requires_immediate_action"]:
-                analysis["recommendations"].extend([
-                    "立即中断当前对话",
-                    "记录相关信息",
-                    "通知相关负责人"
-                ])
-            
-            end_time = time.time()
-            time_metrics = {
-                "total_latency": round(end_time - start_time, 2),
-                "response_latency": round(end_time - start_time, 2),
-                "processing_latency": round(end_processing - start_processing, 2),
-            }
-            print(f"\n\nSecurity性能指标: {time_metrics}\n\n")
-            
+            if session is not None:
+                session.record("security", analysis)
             return analysis
             
         except Exception as e:
-            return {
-                "has_issues": True,
-                "severity": "medium",
-                "risk_types": ["system_error"],
-                "description": f"安全检查过程中出现错误: {str(e)}",
-                "recommendations": [
-                    "建议人工审核对话内容",
-                    "暂时采取保守的安全策略"
-                ],
-                "requires_immediate_action": False,
-                "session_id": session_id,
-                "timestamp": datetime.now().isoformat()
-            }
-            
\ No newline at end of file
+            if session is not None:
+                session.failed = True
+            return self.error_result(e, session_id)
+
+    def prescreen(self, conversation_history: List[Dict], session: Optional[SessionContext] = None) -> List[Dict]:
+        """本地敏感信息预检；增量模式下只扫描新增的轮次"""
+        if self.scanner is None:
+            return []
+        if session is not None and session.incremental:
+            offset = len(conversation_history) - len(session.delta)
+            return self.scanner.scan(session.delta, offset)
+        return self.scanner.scan(conversation_history)
+
+    def finalize(self, analysis: Dict, session_id: str) -> Dict:
+        """补充会话信息；需要立即处理时追加处置建议"""
+        analysis["session_id"] = session_id
+        analysis["timestamp"] = datetime.now().isoformat()
+        
+        if analysis["requires_immediate_action"]:
+            analysis["recommendations"].extend([
+                "立即中断当前对话",
+                "记录相关信息",
+                "通知相关负责人"
+            ])
+        return analysis
+
+    def skipped_result(self, session_id: str, reason: str) -> Dict:
+        """
+        安全检查没有完成时的结论。只有被提前结束策略取消（其它检测器已经给出决定性结论）时是无问题的占位结论；
+        超时等其它原因下结论未知，与检查失败一样按保守结论处理，提示人工审核
+        """
+        if reason != "cancelled":
+            result = self.error_result(TimeoutError(reason), session_id)
+            result["description"] = f"安全检查未完成({reason})，无法确认对话是否安全"
+            result["skipped"] = reason
+            return result
+        return {
+            "has_issues": False,
+            "severity": "low",
+            "risk_types": [],
+            "description": f"安全检查未运行: {reason}",
+            "recommendations": [],
+            "requires_immediate_action": False,
+            "skipped": reason,
+            "session_id": session_id,
+            "timestamp": datetime.now().isoformat()
+        }
+
+    def error_result(self, error: Exception, session_id: str) -> Dict:
+        """安全检查失败时的保守结论"""
+        return {
+            "has_issues": True,
+            "severity": "medium",
+            "risk_types": ["system_error"],
+            "description": f"安全检查过程中出现错误: {str(error)}",
+            "recommendations": [
+                "建议人工审核对话内容",
+                "暂时采取保守的安全策略"
+            ],
+            "requires_immediate_action": False,
+            "session_id": session_id,
+            "timestamp": datetime.now().isoformat()
+        }
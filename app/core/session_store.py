@@ -0,0 +1,190 @@
+import hashlib
+import json
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional
+from app.config import settings
+
+
+def conversation_fingerprint(messages: List) -> str:
+    """对话前缀的指纹，只看role和content（客户端重发时timestamp可能变化）"""
+    h = hashlib.sha1()
+    for msg in messages:
+        h.update(msg.role.encode("utf-8"))
+        h.update(b"\x00")
+        h.update(msg.content.encode("utf-8"))
+        h.update(b"\x01")
+    return h.hexdigest()
+
+
+def roll_summary(summary: str, messages: List, max_chars: int) -> str:
+    """把新增的对话压缩进滚动摘要，超过长度时丢弃最早的内容"""
+    lines = [summary] if summary else []
+    for msg in messages:
+        content = msg.content.replace("\n", " ")
+        if len(content) > 100:
+            content = content[:100] + "…"
+        lines.append(f"{msg.role}: {content}")
+    rolled = "\n".join(lines)
+    if len(rolled) > max_chars:
+        rolled = "…" + rolled[-max_chars:]
+    return rolled
+
+
+class SessionContext:
+    """
+    单次请求的会话上下文。
+    如果客户端重发的对话以上次分析过的前缀开头，各检测器只需要分析新增的部分(delta)，
+    加上此前的摘要和结论；否则退回全量分析。
+    """
+
+    def __init__(self, session_id: str, conversation: List, state: Optional[Dict] = None):
+        self.session_id = session_id
+        self.conversation = conversation
+        self.state = state
+        self.verdicts: Dict = {}
+        self.failed = False
+
+        self.delta = conversation
+        self.incremental = False
+        if state and 0 < state["analyzed_count"] <= len(conversation):
+            prefix = conversation[:state["analyzed_count"]]
+            if conversation_fingerprint(prefix) == state["prefix_hash"]:
+                self.delta = conversation[state["analyzed_count"]:]
+                self.incremental = True
+
+    @property
+    def unchanged(self) -> bool:
+        """对话没有新增内容，可以直接复用上次的结论"""
+        return self.incremental and not self.delta
+
+    def previous(self, detector: str):
+        if not self.state:
+            return None
+        return self.state["verdicts"].get(detector)
+
+    def render(self, detector: str, messages: Optional[List] = None, window=None) -> str:
+        """
+        生成发给检测器的对话文本；增量模式下为 摘要 + 此前结论 + 新增对话。
+        传入window(ContextWindow)时按该检测器的token预算裁剪对话部分。
+        """
+        if not self.incremental:
+            messages = self.conversation if messages is None else messages
+            if window is not None:
+                return window.render(detector, messages)
+            return "".join(f"{msg.role}: {msg.content}\n" for msg in messages)
+
+        previous = json.dumps(self.previous(detector), ensure_ascii=False)
+        header = (
+            f"【此前对话摘要】\n{self.state['summary']}\n\n"
+            f"【此前的分析结论】\n{previous}\n\n"
+        )
+        if window is not None:
+            delta = window.render(detector, self.delta, reserved=window.count_tokens(header))
+        else:
+            delta = "".join(f"{msg.role}: {msg.content}\n" for msg in self.delta)
+        return (
+            f"{header}"
+            f"【新增对话】\n{delta}\n"
+            "请结合此前摘要和结论，对截至目前的整体对话给出最新的分析结果。"
+        )
+
+    def record(self, detector: str, verdict):
+        """记录检测器结论；出现系统错误时不推进已分析前缀，下次重新分析"""
+        if isinstance(verdict, list) and any(issue.get("type") == "system" for issue in verdict):
+            self.failed = True
+        if isinstance(verdict, dict) and "system_error" in verdict.get("risk_types", []):
+            self.failed = True
+        self.verdicts[detector] = verdict
+
+    def next_state(self) -> Optional[Dict]:
+        if self.failed:
+            return None
+        verdicts = dict(self.state["verdicts"]) if self.incremental else {}
+        verdicts.update(self.verdicts)
+        summary = self.state["summary"] if self.incremental else ""
+        return {
+            "session_id": self.session_id,
+            "analyzed_count": len(self.conversation),
+            "prefix_hash": conversation_fingerprint(self.conversation),
+            "summary": roll_summary(summary, self.delta, settings.SESSION_SUMMARY_MAX_CHARS),
+            "verdicts": verdicts,
+            "updated_at": time.time(),
+        }
+
+
+class InMemorySessionStore:
+    """默认的会话状态存储，LRU淘汰 + TTL过期"""
+
+    def __init__(self, max_sessions: int = 10000, ttl: float = 86400):
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self._states: "OrderedDict[str, Dict]" = OrderedDict()
+
+    async def get(self, session_id: str) -> Optional[Dict]:
+        state = self._states.get(session_id)
+        if state is None:
+            return None
+        if time.time() - state["updated_at"] > self.ttl:
+            del self._states[session_id]
+            return None
+        self._states.move_to_end(session_id)
+        return state
+
+    async def save(self, state: Dict):
+        self._states[state["session_id"]] = state
+        self._states.move_to_end(state["session_id"])
+        while len(self._states) > self.max_sessions:
+            self._states.popitem(last=False)
+
+    async def close(self):
+        self._states.clear()
+
+
+class SqliteSessionStore:
+    """基于aiosqlite的会话状态存储，服务重启后仍然保留"""
+
+    def __init__(self, db_path: str, ttl: float = 86400):
+        self.db_path = db_path
+        self.ttl = ttl
+        self._db = None
+
+    async def _connect(self):
+        if self._db is None:
+            import aiosqlite
+            self._db = await aiosqlite.connect(self.db_path)
+            await self._db.execute("PRAGMA journal_mode=WAL")
+            await self._db.execute(
+                "CREATE TABLE IF NOT EXISTS session_state ("
+                "session_id TEXT PRIMARY KEY, state TEXT NOT NULL, updated_at REAL NOT NULL)"
+            )
+            await self._db.commit()
+        return self._db
+
+    async def get(self, session_id: str) -> Optional[Dict]:
+        db = await self._connect()
+        async with db.execute(
+            "SELECT state FROM session_state WHERE session_id = ? AND updated_at >= ?",
+            (session_id, time.time() - self.ttl)
+        ) as cursor:
+            row = await cursor.fetchone()
+        return json.loads(row[0]) if row else None
+
+    async def save(self, state: Dict):
+        db = await self._connect()
+        await db.execute(
+            "INSERT OR REPLACE INTO session_state (session_id, state, updated_at) VALUES (?, ?, ?)",
+            (state["session_id"], json.dumps(state, ensure_ascii=False), state["updated_at"])
+        )
+        await db.commit()
+
+    async def close(self):
+        if self._db is not None:
+            await self._db.close()
+            self._db = None
+
+
+def create_session_store():
+    if settings.SESSION_STORE_BACKEND == "sqlite":
+        return SqliteSessionStore(settings.SESSION_DB_PATH, ttl=settings.SESSION_TTL)
+    return InMemorySessionStore(settings.SESSION_MAX_SESSIONS, ttl=settings.SESSION_TTL)
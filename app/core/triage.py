@@ -0,0 +1,187 @@
+import json
+import sys
+import zlib
+from typing import Dict, List, Optional
+import numpy as np
+from app.config import settings
+from app.core.pii import AhoCorasick
+
+
+# 危机词：命中任意一个都必须走完整的LLM分析
+CRISIS_LEXICON = [
+    "自杀", "想死", "不想活", "活着没有意义", "活着没意思", "活不下去", "结束生命", "结束自己",
+    "轻生", "自残", "自伤", "割腕", "跳楼", "跳河", "上吊", "安眠药", "遗书", "遗言", "解脱",
+    "离开这个世界", "去死", "死了算了", "伤害自己", "kill myself", "suicide",
+]
+
+# 负面情绪/冲突词：命中次数达到阈值时走完整分析
+NEGATIVE_LEXICON = [
+    "压抑", "抑郁", "焦虑", "绝望", "空虚", "难受", "痛苦", "崩溃", "孤独", "无助", "没有出路",
+    "失眠", "害怕", "恐惧", "自卑", "委屈", "烦躁", "愤怒", "生气", "哭", "累", "没用", "讨厌自己",
+    "恨", "废物", "垃圾", "滚", "闭嘴", "骗子", "没用的机器人", "你根本不懂",
+]
+
+
+class LinearNgramScorer:
+    """
+    字符n-gram哈希特征上的逻辑回归打分器，用历史LLM结论训练，纯numpy实现。
+    输出为对话需要完整分析的概率。
+    """
+
+    def __init__(self, dim: int = 2 ** 16, ngram_range=(1, 3), weights: Optional[np.ndarray] = None, bias: float = 0.0):
+        self.dim = dim
+        self.ngram_range = tuple(ngram_range)
+        self.weights = weights if weights is not None else np.zeros(dim, dtype=np.float32)
+        self.bias = bias
+
+    def features(self, text: str) -> np.ndarray:
+        """返回哈希后的n-gram特征下标（可重复，相当于计数）"""
+        lo, hi = self.ngram_range
+        indices = [
+            zlib.crc32(text[i:i + n].encode("utf-8")) % self.dim
+            for n in range(lo, hi + 1)
+            for i in range(len(text) - n + 1)
+        ]
+        return np.asarray(indices, dtype=np.int64)
+
+    def score(self, text: str) -> float:
+        indices = self.features(text)
+        if indices.size == 0:
+            return float(1.0 / (1.0 + np.exp(-self.bias)))
+        # 按n-gram数量归一化，长短文本的分数可比
+        z = self.weights[indices].sum() / np.sqrt(indices.size) + self.bias
+        return float(1.0 / (1.0 + np.exp(-z)))
+
+    def fit(self, texts: List[str], labels: List[int], epochs: int = 10, lr: float = 0.5, l2: float = 1e-4):
+        """SGD训练逻辑回归"""
+        y = np.asarray(labels, dtype=np.float32)
+        feats = [self.features(t) for t in texts]
+        order = np.arange(len(texts))
+        rng = np.random.default_rng(0)
+        for _ in range(epochs):
+            rng.shuffle(order)
+            for i in order:
+                indices = feats[i]
+                norm = np.sqrt(max(indices.size, 1))
+                z = self.weights[indices].sum() / norm + self.bias
+                p = 1.0 / (1.0 + np.exp(-z))
+                grad = p - y[i]
+                np.add.at(self.weights, indices, -lr * (grad / norm + l2 * self.weights[indices]))
+                self.bias -= lr * grad
+        return self
+
+    def save(self, path: str):
+        np.savez_compressed(
+            path, weights=self.weights, bias=self.bias, dim=self.dim, ngram_range=np.asarray(self.ngram_range)
+        )
+
+    @classmethod
+    def load(cls, path: str) -> "LinearNgramScorer":
+        data = np.load(path)
+        return cls(
+            dim=int(data["dim"]),
+            ngram_range=tuple(int(n) for n in data["ngram_range"]),
+            weights=data["weights"].astype(np.float32),
+            bias=float(data["bias"])
+        )
+
+
+class Triage:
+    """
+    第一层本地分诊：判断对话是否需要完整的LLM检测。
+    任何一条规则命中都走完整分析，全部没有命中时才跳过，并把原因记录下来以便审计。
+    跳过时质量/内容安全检测也不会运行，所以AI的回复同样要过危机词和负面词表。
+    """
+
+    def __init__(
+        self,
+        scorer: Optional[LinearNgramScorer] = None,
+        score_threshold: float = 0.3,
+        negative_hits: int = 2,
+        max_user_chars: int = 200,
+        repetition_ratio: float = 0.5
+    ):
+        self.crisis = AhoCorasick((w, "crisis") for w in CRISIS_LEXICON)
+        self.negative = AhoCorasick((w, "negative") for w in NEGATIVE_LEXICON)
+        self.scorer = scorer
+        self.score_threshold = score_threshold
+        self.negative_hits = negative_hits
+        self.max_user_chars = max_user_chars
+        self.repetition_ratio = repetition_ratio
+
+    @classmethod
+    def from_settings(cls) -> "Triage":
+        scorer = LinearNgramScorer.load(settings.TRIAGE_MODEL_PATH) if settings.TRIAGE_MODEL_PATH else None
+        return cls(
+            scorer=scorer,
+            score_threshold=settings.TRIAGE_SCORE_THRESHOLD,
+            negative_hits=settings.TRIAGE_NEGATIVE_HITS,
+            max_user_chars=settings.TRIAGE_MAX_USER_CHARS,
+            repetition_ratio=settings.TRIAGE_REPETITION_RATIO
+        )
+
+    def evaluate(self, conversation: List) -> Dict:
+        """返回 {"tier": "skip"|"full", "reasons": [...], "signals": {...}}"""
+        user_texts = [msg.content for msg in conversation if msg.role == "user"]
+        user_text = "\n".join(user_texts)
+        assistant_text = "\n".join(msg.content for msg in conversation if msg.role != "user")
+
+        crisis = sorted({kw for _, kw, _ in self.crisis.search(user_text)})
+        negative = [kw for _, kw, _ in self.negative.search(user_text)]
+        repeated = len(user_texts) - len(set(t.strip() for t in user_texts))
+        repetition = repeated / len(user_texts) if user_texts else 0.0
+        assistant_keywords = sorted(
+            {kw for _, kw, _ in self.crisis.search(assistant_text)} | {kw for _, kw, _ in self.negative.search(assistant_text)}
+        )
+        signals = {
+            "crisis_keywords": crisis,
+            "negative_hits": len(negative),
+            "assistant_keywords": assistant_keywords,
+            "user_chars": len(user_text),
+            "repetition": round(repetition, 2),
+        }
+
+        reasons = []
+        if crisis:
+            reasons.append("crisis_keywords")
+        if len(negative) >= self.negative_hits:
+            reasons.append("negative_affect")
+        if assistant_keywords:
+            reasons.append("assistant_content")
+        if len(user_text) > self.max_user_chars:
+            reasons.append("long_messages")
+        if len(user_texts) > 1 and repetition >= self.repetition_ratio:
+            reasons.append("repetition")
+        if self.scorer is not None:
+            score = self.scorer.score(user_text)
+            signals["score"] = round(score, 4)
+            if score >= self.score_threshold:
+                reasons.append("scorer")
+
+        return {"tier": "full" if reasons else "skip", "reasons": reasons, "signals": signals}
+
+
+def _label(record: Dict) -> int:
+    """从记录的监控结果中得到标签：有风险或告警为1"""
+    result = record.get("result", record)
+    return int(result.get("risk_level", "low") != "low" or result.get("status") == "alert")
+
+
+if __name__ == "__main__":
+    # 用记录下来的LLM结论训练打分器:
+    # python -m app.core.triage verdicts.jsonl triage_model.npz
+    # 每行: {"conversation_history": [{"role": ..., "content": ...}], "risk_level": ..., "status": ...}
+    texts, labels = [], []
+    with open(sys.argv[1], encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            texts.append("\n".join(
+                m["content"] for m in record["conversation_history"] if m["role"] == "user"
+            ))
+            labels.append(_label(record))
+    scorer = LinearNgramScorer().fit(texts, labels)
+    scorer.save(sys.argv[2])
+    accuracy = np.mean([(scorer.score(t) >= 0.5) == bool(y) for t, y in zip(texts, labels)])
+    print(f"trained on {len(texts)} conversations, train accuracy {accuracy:.3f}")
@@ -1,13 +1,77 @@
+import asyncio
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from app.api.routes import router
 from app.config import settings
+from app.core.cache import VerdictCache
+from app.core.context_window import ContextWindow
+from app.core.metrics import REGISTRY
+from app.core.model_client import create_model_client
+from app.core.monitor import DialogueMonitor
+from app.core.near_duplicate import NearDuplicateIndex
+from app.core.pipeline import MonitorPipeline
+from app.core.result_store import ResultQuery, ResultWriter
+from app.core.security import SecurityManager
+from app.core.session_store import create_session_store
 import uvicorn
 
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # 整个应用共享一个带连接池的LLM client，避免每个请求重新建连/TLS握手
+    cache = None
+    if settings.CACHE_ENABLED:
+        cache = VerdictCache.from_settings()
+    near_duplicates = NearDuplicateIndex.from_settings() if settings.NEAR_DUP_ENABLED else None
+    client = create_model_client(cache, near_duplicates)
+    app.state.verdict_cache = cache
+    app.state.near_duplicates = near_duplicates
+    app.state.llm_client = client
+    app.state.session_store = create_session_store()
+    # 各检测器共享同一个上下文窗口（tokenizer只加载一次，摘要缓存共用）
+    window = ContextWindow.from_settings()
+    app.state.pipeline = MonitorPipeline(
+        SecurityManager(client, window),
+        DialogueMonitor(client, window),
+        app.state.session_store
+    )
+    # 监控结果由后台任务批量落库，请求只负责入队
+    app.state.result_writer = None
+    app.state.result_query = None
+    if settings.RESULT_STORE_ENABLED:
+        app.state.result_writer = ResultWriter.from_settings()
+        await app.state.result_writer.start()
+        app.state.result_query = ResultQuery(settings.RESULT_DB_PATH)
+    # 多个worker时把本进程的指标定期写到共享目录，由/metrics合并
+    metrics_dumper = None
+    if settings.METRICS_MULTIPROC_DIR:
+        metrics_dumper = asyncio.create_task(
+            REGISTRY.dump_periodically(settings.METRICS_MULTIPROC_DIR, settings.METRICS_FLUSH_INTERVAL)
+        )
+    try:
+        yield
+    finally:
+        if app.state.result_writer is not None:
+            await app.state.result_query.close()
+            await app.state.result_writer.close()
+        await app.state.session_store.close()
+        if cache is not None:
+            await cache.close()
+        await client.aclose()
+        if metrics_dumper is not None:
+            metrics_dumper.cancel()
+            try:
+                await metrics_dumper
+            except asyncio.CancelledError:
+                pass
+
+
 app = FastAPI(
     title=settings.APP_NAME,
     version=settings.API_VERSION,
-    description="AI对话监控系统 - 检测并预防对话中的异常情况"
+    description="AI对话监控系统 - 检测并预防对话中的异常情况",
+    lifespan=lifespan
 )
 
 app.add_middleware(
@@ -18,4 +82,4 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-app.include_router(router, prefix="/api/v1")
\ No newline at end of file
+app.include_router(router, prefix="/api/v1")
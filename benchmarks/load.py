@@ -0,0 +1,288 @@
+"""
+/monitor 压测：启动本地模拟上游，在进程内按目标RPS驱动 app.main:app，输出JSON报告：
+吞吐、端到端/各阶段/各检测器的p50/p95/p99、每个请求的上游调用数。
+
+    python -m benchmarks.load --rps 50 --duration 30 --latency lognormal:0.3,0.5 --output bench.json
+    python -m benchmarks.load --rps 50 --duration 30 --baseline bench.json --max-regression 0.2
+
+--env KEY=VALUE 可以覆盖app的配置（如 --env ANALYSIS_MODE=fused）；--upstream 使用已经启动的上游。
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict
+from typing import Dict, List, Optional
+import httpx
+
+
+CONVERSATIONS = [
+    [
+        ("user", "我最近很压抑，感觉活着没有意义"),
+        ("assistant", "我理解你现在的心情，能和我说说最近发生了什么吗？"),
+    ],
+    [
+        ("user", "感到空虚应该怎么办"),
+        ("assistant", "你好，我很愿意为你提供帮助。你能谈谈是什么原因让你觉得空虚吗？"),
+        ("user", "学业和未来"),
+        ("assistant", "你觉得在学业和未来的规划上遇到了什么困扰或挑战了吗？"),
+        ("user", "我觉得我根本没有出路"),
+        ("assistant", "我能感受到你的无助和焦虑。无论面对怎样的困境，都有解决的办法。"),
+    ],
+    [
+        ("user", "今天天气不错，想出去走走"),
+        ("assistant", "听起来很棒！出去散散步对心情很有帮助。"),
+    ],
+    [
+        ("user", "你为什么总是重复同样的话？你根本听不懂我在说什么"),
+        ("assistant", "抱歉让你感到不满，我会认真听你说。"),
+        ("user", "你为什么总是重复同样的话？"),
+        ("assistant", "我理解你的感受，可以再具体说说吗？"),
+    ] * 3,
+]
+
+# 压测默认关闭缓存（每个请求都是新的session），结果落库写到临时目录
+DEFAULT_ENV = {
+    "CACHE_ENABLED": "false",
+    "LLM_ENDPOINTS": "[]",
+    "DEEPSEEK_API_KEY": "",
+}
+
+
+def percentiles(values: List[float]) -> Dict[str, float]:
+    if not values:
+        return {}
+    ordered = sorted(values)
+
+    def rank(q: float) -> float:
+        return ordered[min(int(len(ordered) * q), len(ordered) - 1)]
+
+    return {
+        "count": len(ordered),
+        "mean": round(sum(ordered) / len(ordered), 4),
+        "p50": round(rank(0.50), 4),
+        "p95": round(rank(0.95), 4),
+        "p99": round(rank(0.99), 4),
+        "max": round(ordered[-1], 4),
+    }
+
+
+class RecordCollector:
+    """替换app的ResultWriter，收集每个请求的阶段耗时和上游调用明细"""
+
+    def __init__(self):
+        self.records: List[Dict] = []
+
+    async def submit(self, record: Dict) -> bool:
+        self.records.append(record)
+        return True
+
+    async def close(self):
+        pass
+
+
+def start_upstream(port: int, args) -> subprocess.Popen:
+    command = [
+        sys.executable, "-m", "benchmarks.mock_upstream",
+        "--port", str(port),
+        "--latency", args.latency,
+        "--error-rate", str(args.error_rate),
+        "--rate-limit-rate", str(args.rate_limit_rate),
+        "--anomaly-rate", str(args.anomaly_rate),
+        "--seed", str(args.seed),
+    ]
+    process = subprocess.Popen(command)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            httpx.get(f"http://127.0.0.1:{port}/v1/models", timeout=1.0)
+            return process
+        except httpx.HTTPError:
+            time.sleep(0.2)
+    process.kill()
+    raise RuntimeError("模拟上游启动失败")
+
+
+async def drive(app, rps: float, duration: float, max_inflight: int, seed: int) -> Dict:
+    """开环压测：按泊松到达发送请求（不等待上一个请求完成），最多max_inflight个在途请求"""
+    rng = random.Random(seed)
+    latencies: List[float] = []
+    statuses = Counter()
+    inflight = asyncio.Semaphore(max_inflight)
+    dropped = 0
+
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=300) as client:
+        async def one(index: int):
+            conversation = rng.choice(CONVERSATIONS)
+            body = {
+                "conversation_history": [{"role": role, "content": content} for role, content in conversation],
+                "session_id": f"bench-{seed}-{index}",
+            }
+            start = time.perf_counter()
+            try:
+                response = await client.post("/api/v1/monitor", json=body)
+                statuses[str(response.status_code)] += 1
+            except Exception as e:
+                statuses[type(e).__name__] += 1
+            finally:
+                latencies.append(time.perf_counter() - start)
+                inflight.release()
+
+        tasks = []
+        started = time.perf_counter()
+        next_at = started
+        index = 0
+        while next_at - started < duration:
+            delay = next_at - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            if inflight.locked():
+                # 达到在途上限时不再排队，记为丢弃，避免客户端自身成为瓶颈
+                dropped += 1
+            else:
+                await inflight.acquire()
+                tasks.append(asyncio.create_task(one(index)))
+            index += 1
+            next_at += rng.expovariate(rps)
+        await asyncio.gather(*tasks)
+        elapsed = time.perf_counter() - started
+
+    return {
+        "elapsed": elapsed,
+        "sent": len(tasks),
+        "dropped": dropped,
+        "statuses": dict(statuses),
+        "latencies": latencies,
+    }
+
+
+def summarize(run: Dict, records: List[Dict], upstream_stats: Dict, args) -> Dict:
+    stages = defaultdict(list)
+    detectors = defaultdict(list)
+    upstream_calls = []
+    for record in records:
+        for name, value in record.get("stage_latencies", {}).items():
+            if name.startswith("detector."):
+                detectors[name[len("detector."):]].append(value)
+            else:
+                stages[name].append(value)
+        upstream_calls.append(len(record.get("upstream_calls") or []))
+
+    ok = run["statuses"].get("200", 0)
+    return {
+        "config": {
+            "rps": args.rps,
+            "duration": args.duration,
+            "latency": args.latency,
+            "error_rate": args.error_rate,
+            "rate_limit_rate": args.rate_limit_rate,
+            "env": dict(kv.split("=", 1) for kv in args.env),
+        },
+        "requests": run["sent"],
+        "dropped": run["dropped"],
+        "statuses": run["statuses"],
+        "offered_rps": round(run["sent"] / args.duration, 2),
+        # 包含压测结束后等待在途请求完成的时间
+        "throughput_rps": round(ok / run["elapsed"], 2),
+        "latency": percentiles(run["latencies"]),
+        "stages": {name: percentiles(values) for name, values in sorted(stages.items())},
+        "detectors": {name: percentiles(values) for name, values in sorted(detectors.items())},
+        "upstream_calls_per_request": round(sum(upstream_calls) / len(upstream_calls), 3) if upstream_calls else 0.0,
+        "upstream": upstream_stats,
+    }
+
+
+def compare(report: Dict, baseline: Dict, max_regression: float) -> List[str]:
+    """和基线比较端到端延迟分位数与吞吐，返回超出允许范围的项"""
+    failures = []
+    for key in ("p50", "p95", "p99"):
+        old, new = baseline["latency"].get(key), report["latency"].get(key)
+        if old and new and new > old * (1 + max_regression):
+            failures.append(f"latency.{key}: {old} -> {new}")
+    old, new = baseline.get("throughput_rps"), report.get("throughput_rps")
+    if old and new < old * (1 - max_regression):
+        failures.append(f"throughput_rps: {old} -> {new}")
+    return failures
+
+
+async def run(args) -> Dict:
+    # 配置在导入app之前通过环境变量设置
+    os.environ.update(DEFAULT_ENV)
+    os.environ["BASE_URL"] = args.upstream
+    os.environ["RESULT_DB_PATH"] = os.path.join(tempfile.mkdtemp(), "bench_results.db")
+    for item in args.env:
+        key, _, value = item.partition("=")
+        os.environ[key] = value
+    from app.main import app
+
+    async with app.router.lifespan_context(app):
+        collector = RecordCollector()
+        if app.state.result_writer is not None:
+            await app.state.result_writer.close()
+        app.state.result_writer = collector
+        if args.warmup > 0:
+            await drive(app, args.rps, args.warmup, args.max_inflight, args.seed + 1)
+            collector.records.clear()
+            httpx.post(f"{args.upstream.rsplit('/v1', 1)[0]}/stats/reset")
+        result = await drive(app, args.rps, args.duration, args.max_inflight, args.seed)
+
+    try:
+        upstream_stats = httpx.get(f"{args.upstream.rsplit('/v1', 1)[0]}/stats", timeout=5).json()
+    except httpx.HTTPError:
+        upstream_stats = {}
+    return summarize(result, collector.records, upstream_stats, args)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="/monitor 压测")
+    parser.add_argument("--rps", type=float, default=20.0, help="目标请求速率")
+    parser.add_argument("--duration", type=float, default=30.0, help="压测时长(秒)")
+    parser.add_argument("--warmup", type=float, default=3.0, help="预热时长(秒)，不计入结果")
+    parser.add_argument("--max-inflight", type=int, default=1000, help="客户端最多在途请求数")
+    parser.add_argument("--upstream", default="", help="已启动的上游地址，如 http://127.0.0.1:9911/v1；为空时启动模拟上游")
+    parser.add_argument("--port", type=int, default=9911, help="模拟上游的端口")
+    parser.add_argument("--latency", default="lognormal:0.3,0.5", help="模拟上游的延迟分布")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0)
+    parser.add_argument("--anomaly-rate", type=float, default=0.2)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--env", action="append", default=[], help="覆盖app配置，KEY=VALUE，可重复")
+    parser.add_argument("--output", default="", help="报告写入的文件，为空时输出到stdout")
+    parser.add_argument("--baseline", default="", help="基线报告；超出--max-regression时以非0状态退出")
+    parser.add_argument("--max-regression", type=float, default=0.2)
+    args = parser.parse_args()
+
+    upstream = None
+    if not args.upstream:
+        upstream = start_upstream(args.port, args)
+        args.upstream = f"http://127.0.0.1:{args.port}/v1"
+    try:
+        report = asyncio.run(run(args))
+    finally:
+        if upstream is not None:
+            upstream.terminate()
+            upstream.wait()
+
+    output = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    else:
+        print(output)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            failures = compare(report, json.load(f), args.max_regression)
+        if failures:
+            print("性能回退:\n" + "\n".join(failures), file=sys.stderr)
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
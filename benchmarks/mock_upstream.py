@@ -0,0 +1,152 @@
+"""
+本地的OpenAI兼容上游，用于压测 /monitor 流程本身的开销：
+延迟按配置的分布采样，可以按比例返回5xx和429，按检测器的输出schema生成合法的JSON结论。
+
+    python -m benchmarks.mock_upstream --port 9911 --latency lognormal:0.3,0.5 --error-rate 0.01 --rate-limit-rate 0.02
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+from collections import Counter
+from typing import Callable, Dict, Optional
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+from app.core.json_output import DETECTOR_SCHEMAS
+
+
+def parse_latency(spec: str) -> Callable[[random.Random], float]:
+    """
+    延迟分布(秒)：fixed:0.2 | uniform:0.1,0.5 | exp:0.3(均值) | lognormal:0.3,0.5(中位数,sigma)
+    """
+    kind, _, args = spec.partition(":")
+    values = [float(v) for v in args.split(",") if v]
+    if kind == "fixed":
+        return lambda rng: values[0]
+    if kind == "uniform":
+        return lambda rng: rng.uniform(values[0], values[1])
+    if kind == "exp":
+        return lambda rng: rng.expovariate(1 / values[0])
+    if kind == "lognormal":
+        import math
+        mu = math.log(values[0])
+        return lambda rng: rng.lognormvariate(mu, values[1])
+    raise ValueError(f"不支持的延迟分布: {spec}")
+
+
+def detect_detector(body: Dict) -> Optional[str]:
+    """按请求中的约束解码schema识别检测器；没有schema时按system prompt中出现的字段名匹配"""
+    response_format = body.get("response_format") or {}
+    if response_format.get("type") == "json_schema":
+        return response_format["json_schema"]["name"]
+    guided = body.get("guided_json")
+    for name, schema in DETECTOR_SCHEMAS.items():
+        if guided == schema:
+            return name
+
+    system = next((m["content"] for m in body.get("messages", []) if m["role"] == "system"), "")
+    best, best_score = None, 0
+    for name, schema in DETECTOR_SCHEMAS.items():
+        score = sum(1 for field in schema["properties"] if field in system)
+        # 分数相同时取字段更少的schema（融合检测的schema包含所有字段）
+        if score > best_score or (score == best_score and score and len(schema["properties"]) < len(DETECTOR_SCHEMAS[best]["properties"])):
+            best, best_score = name, score
+    return best
+
+
+def example(schema: Dict, rng: random.Random, anomaly_rate: float):
+    """按schema生成一个合法的实例；布尔字段以anomaly_rate的概率为true"""
+    kind = schema.get("type")
+    if kind == "object":
+        return {name: example(sub, rng, anomaly_rate) for name, sub in schema["properties"].items()}
+    if kind == "array":
+        return [example(schema["items"], rng, anomaly_rate) for _ in range(rng.randint(0, 2))]
+    if kind == "boolean":
+        return rng.random() < anomaly_rate
+    if "enum" in schema:
+        return rng.choice(schema["enum"])
+    return "模拟输出"[:schema.get("maxLength", 20)]
+
+
+def create_app(
+    latency: str = "lognormal:0.3,0.5",
+    error_rate: float = 0.0,
+    rate_limit_rate: float = 0.0,
+    anomaly_rate: float = 0.2,
+    seed: Optional[int] = None
+) -> FastAPI:
+    app = FastAPI()
+    sample_latency = parse_latency(latency)
+    rng = random.Random(seed)
+    stats = Counter()
+
+    @app.post("/v1/chat/completions")
+    async def chat(request: Request):
+        body = await request.json()
+        detector = detect_detector(body) or "text"
+        stats[f"calls.{detector}"] += 1
+        roll = rng.random()
+        if roll < rate_limit_rate:
+            stats["injected.429"] += 1
+            return JSONResponse(
+                {"error": {"message": "rate limited", "type": "rate_limit_error"}},
+                status_code=429,
+                headers={"retry-after-ms": "100"}
+            )
+        await asyncio.sleep(sample_latency(rng))
+        if roll < rate_limit_rate + error_rate:
+            stats["injected.500"] += 1
+            return JSONResponse({"error": {"message": "injected error", "type": "server_error"}}, status_code=500)
+
+        if detector in DETECTOR_SCHEMAS:
+            content = json.dumps(example(DETECTOR_SCHEMAS[detector], rng, anomaly_rate), ensure_ascii=False)
+        else:
+            content = "1. 表达共情\n2. 引导用户具体描述困扰"
+        return {
+            "id": f"mock-{stats['calls.' + detector]}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model", "mock"),
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0},
+        }
+
+    @app.get("/v1/models")
+    async def models():
+        return {"object": "list", "data": [{"id": "mock", "object": "model"}]}
+
+    @app.get("/stats")
+    async def get_stats():
+        return dict(stats)
+
+    @app.post("/stats/reset")
+    async def reset_stats():
+        stats.clear()
+        return {}
+
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="本地模拟的OpenAI兼容上游")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9911)
+    parser.add_argument("--latency", default="lognormal:0.3,0.5", help="fixed:S | uniform:A,B | exp:MEAN | lognormal:MEDIAN,SIGMA")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="返回500的比例")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="返回429的比例")
+    parser.add_argument("--anomaly-rate", type=float, default=0.2, help="结论中布尔字段为true的比例")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    import uvicorn
+    uvicorn.run(
+        create_app(args.latency, args.error_rate, args.rate_limit_rate, args.anomaly_rate, args.seed),
+        host=args.host,
+        port=args.port,
+        log_level="warning"
+    )
+
+
+if __name__ == "__main__":
+    main()
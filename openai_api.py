@@ -3,25 +3,44 @@
 # License: MIT
 # coding=utf-8
 # Implements API for ChatGLM2-6B in OpenAI's format. (https://platform.openai.com/docs/api-reference/chat)
-# Usage: python openai_api.py
+# Usage: python openai_api.py [--model-path THUDM/chatglm2-6b] [--device cuda] [--max-batch-size 8] [--batch-wait-ms 10]
+# CPU:   python openai_api.py --device cpu [--dtype bf16] [--quantize int8] [--threads 16]
 # Visit http://localhost:8000/docs for documents.
 
 
+import argparse
+import asyncio
+import json
 import time
 import torch
 import uvicorn
 from pydantic import BaseModel, Field
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from contextlib import asynccontextmanager
+from contextlib import aclosing, asynccontextmanager
 from typing import Any, Dict, List, Literal, Optional, Union
-from transformers import AutoTokenizer, AutoModel
 from sse_starlette.sse import ServerSentEvent, EventSourceResponse
+from app.core.local_inference import BatchScheduler, HFBatchGenerator, configure_cpu_threads, load_causal_lm
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI): # collects GPU memory
+    # 非流式请求由微批调度器合并成批量生成，模型在单独的线程里运行，不阻塞事件循环
+    global scheduler
+    scheduler = BatchScheduler(
+        HFBatchGenerator(model, tokenizer),
+        max_batch_size=args.max_batch_size,
+        batch_wait_ms=args.batch_wait_ms,
+        max_streams=args.max_streams
+    )
+    if args.warmup_tokens > 0:
+        warmup_seconds = await asyncio.get_running_loop().run_in_executor(
+            None, scheduler.generator.warmup, args.warmup_tokens
+        )
+        print(f"warmup: {args.warmup_tokens} tokens in {warmup_seconds:.2f}s")
+    await scheduler.start()
     yield
+    await scheduler.stop()
     if torch.cuda.is_available():
         torch.cuda.empty_cache()
         torch.cuda.ipc_collect()
@@ -68,6 +87,7 @@ class ChatCompletionRequest(BaseModel):
     temperature: Optional[float] = None
     top_p: Optional[float] = None
     max_length: Optional[int] = None
+    max_tokens: Optional[int] = None
     stream: Optional[bool] = False
 
 
@@ -97,6 +117,20 @@ async def list_models():
     return ModelList(data=[model_card])
 
 
+@app.get("/v1/stats")
+async def stats():
+    """推理后端配置和吞吐统计(tokens/s)"""
+    return {
+        "model": args.model_path,
+        "device": args.device,
+        "dtype": args.dtype,
+        "quantize": args.quantize,
+        "threads": torch.get_num_threads(),
+        "interop_threads": torch.get_num_interop_threads(),
+        **scheduler.summary(),
+    }
+
+
 @app.post("/v1/chat/completions", response_model=ChatCompletionResponse)
 async def create_chat_completion(request: ChatCompletionRequest):
     global model, tokenizer
@@ -116,65 +150,79 @@ async def create_chat_completion(request: ChatCompletionRequest):
                 history.append([prev_messages[i].content, prev_messages[i+1].content])
 
     if request.stream:
-        generate = predict(query, history, request.model)
+        generate = predict(
+            query,
+            history,
+            request.model,
+            request.max_tokens or args.max_new_tokens,
+            request.temperature,
+            request.top_p
+        )
         return EventSourceResponse(generate, media_type="text/event-stream")
 
-    response, _ = model.chat(tokenizer, query, history=history)
+    prompt = scheduler.generator.build_prompt(query, history)
+    response, finish_reason, _ = await scheduler.submit(
+        prompt,
+        max_new_tokens=request.max_tokens or args.max_new_tokens,
+        temperature=request.temperature,
+        top_p=request.top_p
+    )
     choice_data = ChatCompletionResponseChoice(
         index=0,
         message=ChatMessage(role="assistant", content=response),
-        finish_reason="stop"
+        finish_reason=finish_reason
     )
 
     return ChatCompletionResponse(model=request.model, choices=[choice_data], object="chat.completion")
 
 
-async def predict(query: str, history: List[List[str]], model_id: str):
-    global model, tokenizer
+def chunk_templates(model_id: str):
+    """预先生成流式chunk的JSON模板，每个token只需要拼接转义后的文本"""
+    head = '{"model":%s,"object":"chat.completion.chunk","choices":[{"index":0,"delta":' % json.dumps(model_id)
+    first = head + '{"role":"assistant"},"finish_reason":null}]}'
+    content_prefix = head + '{"content":'
+    content_suffix = '},"finish_reason":null}]}'
+    last = head + '{},"finish_reason":"stop"}]}'
+    return first, content_prefix, content_suffix, last
 
-    choice_data = ChatCompletionResponseStreamChoice(
-        index=0,
-        delta=DeltaMessage(role="assistant"),
-        finish_reason=None
-    )
-    chunk = ChatCompletionResponse(model=model_id, choices=[choice_data], object="chat.completion.chunk")
-    yield "{}".format(chunk.json(exclude_unset=True, ensure_ascii=False))
-
-    current_length = 0
 
-    for new_response, _ in model.stream_chat(tokenizer, query, history):
-        if len(new_response) == current_length:
-            continue
+async def predict(query: str, history: List[List[str]], model_id: str, max_new_tokens: int,
+                  temperature: Optional[float] = None, top_p: Optional[float] = None):
+    # 生成在调度器的工作线程里进行；客户端断开时EventSourceResponse会取消或关闭这个生成器，
+    # aclosing保证停在yield处被关闭时也会关闭scheduler.stream，由它通知工作线程停止生成
+    first, content_prefix, content_suffix, last = chunk_templates(model_id)
+    yield first
 
-        new_text = new_response[current_length:]
-        current_length = len(new_response)
-
-        choice_data = ChatCompletionResponseStreamChoice(
-            index=0,
-            delta=DeltaMessage(content=new_text),
-            finish_reason=None
-        )
-        chunk = ChatCompletionResponse(model=model_id, choices=[choice_data], object="chat.completion.chunk")
-        yield "{}".format(chunk.json(exclude_unset=True, ensure_ascii=False))
+    async with aclosing(scheduler.stream(query, history, max_new_tokens, temperature, top_p)) as stream:
+        async for new_text in stream:
+            yield content_prefix + json.dumps(new_text, ensure_ascii=False) + content_suffix
 
-
-    choice_data = ChatCompletionResponseStreamChoice(
-        index=0,
-        delta=DeltaMessage(),
-        finish_reason="stop"
-    )
-    chunk = ChatCompletionResponse(model=model_id, choices=[choice_data], object="chat.completion.chunk")
-    yield "{}".format(chunk.json(exclude_unset=True, ensure_ascii=False))
+    yield last
     yield '[DONE]'
 
 
 
 if __name__ == "__main__":
-    tokenizer = AutoTokenizer.from_pretrained("THUDM/chatglm2-6b", trust_remote_code=True)
-    model = AutoModel.from_pretrained("THUDM/chatglm2-6b", trust_remote_code=True).cuda()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model-path", default="THUDM/chatglm2-6b")
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--dtype", default="auto", choices=["auto", "fp32", "bf16", "fp16"],
+                        help="auto: GPU用fp16，CPU用fp32；支持AVX512-BF16/AMX的CPU可以用bf16")
+    parser.add_argument("--quantize", default="none", choices=["none", "int8"], help="CPU上对Linear层做动态int8量化")
+    parser.add_argument("--threads", type=int, default=0, help="算子内线程数，0为默认(物理核数)")
+    parser.add_argument("--interop-threads", type=int, default=0, help="算子间线程数，0为默认")
+    parser.add_argument("--warmup-tokens", type=int, default=16, help="启动时预热生成的token数，0为不预热")
+    parser.add_argument("--max-batch-size", type=int, default=8, help="每批最多合并的请求数")
+    parser.add_argument("--batch-wait-ms", type=float, default=10.0, help="收集一批请求的时间窗口(毫秒)")
+    parser.add_argument("--max-streams", type=int, default=4, help="同时进行的流式生成数")
+    parser.add_argument("--max-new-tokens", type=int, default=512, help="请求没有指定max_tokens时的生成上限")
+    parser.add_argument("--port", type=int, default=8001)
+    args = parser.parse_args()
+
+    configure_cpu_threads(args.threads, args.interop_threads)
+    model, tokenizer = load_causal_lm(args.model_path, args.device, args.dtype, args.quantize)
     # 多显卡支持，使用下面两行代替上面一行，将num_gpus改为你实际的显卡数量
     # from utils import load_model_on_gpus
-    # model = load_model_on_gpus("THUDM/chatglm2-6b", num_gpus=2)
-    model.eval()
+    # model = load_model_on_gpus(args.model_path, num_gpus=2)
 
-    uvicorn.run(app, host='0.0.0.0', port=8001, workers=1)
\ No newline at end of file
+    uvicorn.run(app, host='0.0.0.0', port=args.port, workers=1)
\ No newline at end of file
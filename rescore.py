@@ -0,0 +1,297 @@
+"""
+离线批量重评：流式读取JSONL对话语料（支持.gz），用当前配置的检测器重新评估，结果逐条追加写入JSONL。
+
+    python rescore.py corpus.jsonl.gz rescored.jsonl --concurrency 32
+
+输入每行一个 DialogueInput：{"session_id": ..., "conversation_history": [{"role": ..., "content": ...}]}，
+输出每行 {"line": 输入行号, "session_id": ..., "result": MonitoringResult} 或 {"line": ..., "error": ...}，
+按完成顺序写入。进度定期写入检查点文件（默认为 输出文件.ckpt），中断后用同样的命令重新运行会从断点继续。
+模型、检测模式等沿用服务的配置（.env / 环境变量）。
+"""
+import argparse
+import asyncio
+import gzip
+import json
+import logging
+import os
+import signal
+import sys
+import time
+from typing import Dict, Optional, Set
+from app.api.routes import DialogueInput, merge_results
+from app.config import settings
+from app.core.cache import VerdictCache
+from app.core.context_window import ContextWindow
+from app.core.model_client import call_limiter, create_model_client
+from app.core.monitor import DialogueMonitor
+from app.core.near_duplicate import NearDuplicateIndex
+from app.core.pipeline import MonitorPipeline
+from app.core.security import SecurityManager
+
+
+class Checkpoint:
+    """
+    记录已完成的连续行号(watermark)，以及不超过它的最后一个已知行尾偏移(offset_line/offset)；
+    watermark之后已写出的行号单独记录在pending中，续跑时跳过，保证输出不重复。
+    """
+
+    def __init__(self, path: str, input_path: str):
+        self.path = path
+        self.input_path = input_path
+        self.watermark = 0
+        self.offset_line = 0
+        self.offset = 0
+        self.output_offset = 0
+        self.pending: Set[int] = set()
+        self.offsets: Dict[int, int] = {}
+
+    def load(self) -> bool:
+        if not os.path.exists(self.path):
+            return False
+        with open(self.path) as f:
+            data = json.load(f)
+        if data["input"] != os.path.abspath(self.input_path):
+            raise SystemExit(f"检查点 {self.path} 属于另一个输入文件: {data['input']}")
+        self.watermark = data["watermark"]
+        self.offset_line = data["offset_line"]
+        self.offset = data["offset"]
+        self.output_offset = data["output_offset"]
+        self.pending = set(data["pending"])
+        return True
+
+    def done(self, line: int, end_offset: Optional[int] = None):
+        """line已写出；end_offset是该行结束处（解压后）的字节偏移"""
+        self.pending.add(line)
+        if end_offset is not None:
+            self.offsets[line] = end_offset
+        self.advance()
+
+    def advance(self):
+        while self.watermark + 1 in self.pending:
+            self.watermark += 1
+            self.pending.discard(self.watermark)
+            if self.watermark in self.offsets:
+                self.offset_line = self.watermark
+                self.offset = self.offsets.pop(self.watermark)
+
+    def save(self, output_offset: int):
+        data = {
+            "input": os.path.abspath(self.input_path),
+            "watermark": self.watermark,
+            "offset_line": self.offset_line,
+            "offset": self.offset,
+            "output_offset": output_offset,
+            "pending": sorted(self.pending),
+            "updated_at": time.time(),
+        }
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(data, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+
+def open_input(path: str):
+    """返回 (解压后的二进制流, 原始文件)；原始文件的位置用于估算进度"""
+    raw = open(path, "rb")
+    if path.endswith(".gz"):
+        return gzip.GzipFile(fileobj=raw, mode="rb"), raw
+    return raw, raw
+
+
+def recover_output(path: str, checkpoint: Checkpoint):
+    """
+    检查点之后可能已经写出了部分行：把它们加入pending避免重复，
+    并截掉崩溃时写了一半的最后一行
+    """
+    if not os.path.exists(path):
+        return
+    with open(path, "r+b") as f:
+        f.seek(checkpoint.output_offset)
+        valid_end = checkpoint.output_offset
+        for raw_line in f:
+            if not raw_line.endswith(b"\n"):
+                break
+            try:
+                line = json.loads(raw_line)["line"]
+            except (ValueError, KeyError):
+                break
+            if line > checkpoint.watermark:
+                checkpoint.pending.add(line)
+            valid_end += len(raw_line)
+        f.truncate(valid_end)
+    # 这些行在输入中的偏移未知，watermark越过它们时偏移停在上一个已知位置，续跑时多读几行再按行号跳过
+    checkpoint.advance()
+
+
+def format_duration(seconds: float) -> str:
+    seconds = int(seconds)
+    return f"{seconds // 3600}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}"
+
+
+class Progress:
+    """按输入文件已读字节数估算完成比例和剩余时间，定期打印到stderr"""
+
+    def __init__(self, raw, interval: float):
+        self.raw = raw
+        self.interval = interval
+        self.total_bytes = os.fstat(raw.fileno()).st_size
+        self.start_bytes = raw.tell()
+        self.started = time.monotonic()
+        self.completed = 0
+        self.errors = 0
+        self.skipped = 0
+
+    def report(self, final: bool = False):
+        elapsed = time.monotonic() - self.started
+        rate = self.completed / elapsed if elapsed > 0 else 0.0
+        position = self.raw.tell()
+        read = position - self.start_bytes
+        message = f"完成 {self.completed} (失败 {self.errors}, 跳过 {self.skipped})  {rate:.1f} 条/秒"
+        if self.total_bytes:
+            message += f"  {position / self.total_bytes:.1%}"
+            if read > 0 and not final:
+                eta = elapsed * (self.total_bytes - position) / read
+                message += f"  剩余 {format_duration(eta)}"
+        message += f"  用时 {format_duration(elapsed)}"
+        print(message, file=sys.stderr, flush=True)
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            self.report()
+
+
+async def rescore(args) -> int:
+    checkpoint = Checkpoint(args.checkpoint or args.output + ".ckpt", args.input)
+    if args.restart:
+        for path in (args.output, checkpoint.path):
+            if os.path.exists(path):
+                os.remove(path)
+    elif checkpoint.load():
+        recover_output(args.output, checkpoint)
+        print(f"从第 {checkpoint.watermark + 1} 行继续（另有 {len(checkpoint.pending)} 行已完成）", file=sys.stderr)
+    elif os.path.exists(args.output) and os.path.getsize(args.output):
+        raise SystemExit(f"{args.output} 已存在但没有检查点；使用 --restart 重新开始")
+
+    cache = None
+    if settings.CACHE_ENABLED:
+        cache = VerdictCache.from_settings()
+    near_duplicates = NearDuplicateIndex.from_settings() if settings.NEAR_DUP_ENABLED else None
+    client = create_model_client(cache, near_duplicates)
+    window = ContextWindow.from_settings()
+    # 语料中每行都是完整对话，不使用会话状态做增量分析
+    pipeline = MonitorPipeline(SecurityManager(client, window), DialogueMonitor(client, window))
+    if args.upstream_concurrency > 0:
+        call_limiter.set(asyncio.Semaphore(args.upstream_concurrency))
+
+    stream, raw = open_input(args.input)
+    stream.seek(checkpoint.offset)
+    line_number = checkpoint.offset_line
+    output = open(args.output, "ab")
+    progress = Progress(raw, args.progress_interval)
+    slots = asyncio.Semaphore(args.concurrency)
+    stopping = asyncio.Event()
+    tasks: Set[asyncio.Task] = set()
+    last_save = time.monotonic()
+
+    def save():
+        output.flush()
+        os.fsync(output.fileno())
+        checkpoint.save(output.tell())
+
+    def write(record: Dict, end_offset: int):
+        nonlocal last_save
+        output.write(json.dumps(record, ensure_ascii=False, default=str).encode() + b"\n")
+        checkpoint.done(record["line"], end_offset)
+        if time.monotonic() - last_save >= args.checkpoint_interval:
+            save()
+            last_save = time.monotonic()
+
+    async def score(line: int, text: bytes, end_offset: int):
+        try:
+            record = {"line": line}
+            try:
+                dialogue = DialogueInput.model_validate_json(text)
+                record["session_id"] = dialogue.session_id
+                start_time = time.perf_counter()
+                security_check, monitor_result = await pipeline.run(
+                    dialogue.conversation_history,
+                    dialogue.session_id
+                )
+                record["result"] = merge_results(security_check, monitor_result).model_dump()
+                record["stage_latencies"] = monitor_result.get("stage_latencies", {})
+                record["latency"] = round(time.perf_counter() - start_time, 4)
+                progress.completed += 1
+            except Exception as e:
+                record["error"] = str(e)
+                progress.errors += 1
+            write(record, end_offset)
+        finally:
+            slots.release()
+
+    def stop():
+        if stopping.is_set():
+            # 第二次中断时不再等待在途的对话
+            for task in tasks:
+                task.cancel()
+        print("收到中断信号，等待在途的对话完成后退出（再次中断立即退出）", file=sys.stderr)
+        stopping.set()
+
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop)
+    reporter = asyncio.create_task(progress.run())
+    try:
+        offset = stream.tell()
+        for text in stream:
+            line_number += 1
+            offset += len(text)
+            if line_number <= checkpoint.watermark or line_number in checkpoint.pending:
+                continue
+            if not text.strip():
+                progress.skipped += 1
+                checkpoint.done(line_number, offset)
+                continue
+            await slots.acquire()
+            if stopping.is_set():
+                break
+            task = asyncio.create_task(score(line_number, text, offset))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+    finally:
+        reporter.cancel()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.remove_signal_handler(sig)
+        save()
+        progress.report(final=True)
+        output.close()
+        stream.close()
+        raw.close()
+        if cache is not None:
+            await cache.close()
+        await client.aclose()
+    return 1 if stopping.is_set() else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="离线批量重评JSONL对话语料")
+    parser.add_argument("input", help="输入的JSONL文件，.gz结尾时按gzip解压")
+    parser.add_argument("output", help="结果JSONL文件（追加写入）")
+    parser.add_argument("--checkpoint", default="", help="检查点文件，默认为 输出文件.ckpt")
+    parser.add_argument("--concurrency", type=int, default=settings.BATCH_MAX_CONCURRENCY, help="同时评估的对话数")
+    parser.add_argument("--upstream-concurrency", type=int, default=0, help="所有对话共享的上游并发上限，0为不限制")
+    parser.add_argument("--checkpoint-interval", type=float, default=5.0, help="检查点写入间隔(秒)")
+    parser.add_argument("--progress-interval", type=float, default=10.0, help="进度打印间隔(秒)")
+    parser.add_argument("--restart", action="store_true", help="忽略已有的检查点和输出，从头开始")
+    args = parser.parse_args()
+    # 每个上游请求一行的httpx日志会淹没进度输出
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    sys.exit(asyncio.run(rescore(args)))
+
+
+if __name__ == "__main__":
+    main()
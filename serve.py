@@ -0,0 +1,78 @@
+"""
+生产环境启动：多个worker进程（uvloop + httptools，没有安装时退回asyncio/h11），不开reload。
+收到SIGTERM/SIGINT时停止接收新连接，等待在途请求完成（最多 SERVE_GRACEFUL_TIMEOUT 秒），
+然后各worker执行lifespan的关闭流程（写完落库队列、关闭连接池）。
+
+    python serve.py --workers 8 --port 8000
+
+多个worker时，没有配置的共享状态放在 SERVE_STATE_DIR 下的sqlite文件中，所有worker共用：
+结论缓存的持久层(CACHE_SQLITE_PATH)、上游令牌桶(RATE_LIMIT_SQLITE_PATH)、会话状态(SESSION_STORE_BACKEND=sqlite)。
+近似重复索引和缓存的内存层仍是每个worker各自一份。
+指标也是每个worker各自一份：各worker每 METRICS_FLUSH_INTERVAL 秒把指标写到 METRICS_MULTIPROC_DIR
+（默认 SERVE_STATE_DIR/metrics，启动时清空），/api/v1/metrics 返回所有worker合并后的值，其他worker的部分最多滞后一个写入间隔。
+"""
+import argparse
+import glob
+import importlib.util
+import os
+import uvicorn
+from app.config import settings
+
+
+def shared_state_env(state_dir: str) -> dict:
+    """多个worker需要共享、但当前没有配置的状态文件；通过环境变量传给worker进程"""
+    env = {}
+    if settings.CACHE_ENABLED and not settings.CACHE_SQLITE_PATH:
+        env["CACHE_SQLITE_PATH"] = os.path.join(state_dir, "verdict_cache.db")
+    if not settings.RATE_LIMIT_SQLITE_PATH:
+        env["RATE_LIMIT_SQLITE_PATH"] = os.path.join(state_dir, "upstream_budget.db")
+    if settings.INCREMENTAL_ANALYSIS and settings.SESSION_STORE_BACKEND == "memory":
+        # 同一会话的请求会落到不同的worker上，内存中的会话状态无法共享
+        env["SESSION_STORE_BACKEND"] = "sqlite"
+        env["SESSION_DB_PATH"] = os.path.join(state_dir, os.path.basename(settings.SESSION_DB_PATH))
+    if not settings.METRICS_MULTIPROC_DIR:
+        # 每个worker的指标只是一部分，/metrics需要合并所有worker写到这个目录的值
+        env["METRICS_MULTIPROC_DIR"] = os.path.join(state_dir, "metrics")
+    return env
+
+
+def reset_metrics_dir(directory: str):
+    """清掉上次运行留下的各worker指标文件，计数器从0开始"""
+    os.makedirs(directory, exist_ok=True)
+    for path in glob.glob(os.path.join(directory, "*.json*")):
+        os.remove(path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="生产环境多进程启动")
+    parser.add_argument("--host", default=settings.SERVE_HOST)
+    parser.add_argument("--port", type=int, default=settings.SERVE_PORT)
+    parser.add_argument("--workers", type=int, default=settings.SERVE_WORKERS, help="worker进程数，0为CPU核数")
+    parser.add_argument("--graceful-timeout", type=float, default=settings.SERVE_GRACEFUL_TIMEOUT, help="等待在途请求完成的最长时间(秒)")
+    parser.add_argument("--state-dir", default=settings.SERVE_STATE_DIR, help="多个worker共享的sqlite文件所在目录")
+    parser.add_argument("--log-level", default="info")
+    args = parser.parse_args()
+
+    workers = args.workers or os.cpu_count() or 1
+    if workers > 1:
+        os.makedirs(args.state_dir, exist_ok=True)
+        env = shared_state_env(args.state_dir)
+        os.environ.update(env)
+        for key, value in env.items():
+            print(f"====Shared {key}={value}====")
+        reset_metrics_dir(env.get("METRICS_MULTIPROC_DIR", settings.METRICS_MULTIPROC_DIR))
+
+    uvicorn.run(
+        "app.main:app",
+        host=args.host,
+        port=args.port,
+        workers=workers,
+        loop="uvloop" if importlib.util.find_spec("uvloop") else "asyncio",
+        http="httptools" if importlib.util.find_spec("httptools") else "h11",
+        timeout_graceful_shutdown=args.graceful_timeout,
+        log_level=args.log_level
+    )
+
+
+if __name__ == "__main__":
+    main()
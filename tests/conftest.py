@@ -0,0 +1,51 @@
+"""
+离线测试：不访问真实模型，上游请求由测试里的 httpx.MockTransport 或 benchmarks.mock_upstream（ASGI进程内调用，不占端口）应答。
+配置在导入app之前通过环境变量固定，避免读到本机的 .env。
+"""
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+os.environ.update({
+    "BASE_URL": "http://mock/v1",
+    "LLM_ENDPOINTS": "[]",
+    "DEEPSEEK_API_KEY": "",
+    "CACHE_SQLITE_PATH": "",
+    "RESULT_STORE_ENABLED": "false",
+    "RATE_LIMIT_SQLITE_PATH": "",
+})
+
+import httpx
+import pytest
+
+
+@pytest.fixture
+def mock_upstream():
+    """返回创建进程内模拟上游的函数；参数同 benchmarks.mock_upstream.create_app，默认延迟很短、结论全部为无风险"""
+    from benchmarks.mock_upstream import create_app
+
+    def factory(latency: str = "fixed:0.01", anomaly_rate: float = 0.0, seed: int = 0, **kwargs):
+        return create_app(latency=latency, anomaly_rate=anomaly_rate, seed=seed, **kwargs)
+    return factory
+
+
+@pytest.fixture
+def model_client():
+    """返回创建OpenAIClient的函数，请求通过ASGITransport发给模拟上游"""
+    from app.core.model_client import OpenAIClient
+
+    def factory(upstream, **kwargs):
+        http_client = httpx.AsyncClient(transport=httpx.ASGITransport(app=upstream))
+        return OpenAIClient(http_client=http_client, **kwargs)
+    return factory
+
+
+@pytest.fixture
+def upstream_stats():
+    """返回读取模拟上游调用计数的协程函数"""
+    async def stats(upstream) -> dict:
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=upstream), base_url="http://mock") as client:
+            return (await client.get("/stats")).json()
+    return stats
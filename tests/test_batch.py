@@ -0,0 +1,127 @@
+import asyncio
+import json
+import httpx
+from fastapi import FastAPI
+from app.api.routes import BatchItemResult, router
+from app.config import settings
+from app.core.model_client import OpenAIClient
+
+SAFE = {"has_issues": False, "severity": "low", "risk_types": [], "description": "无风险"}
+NORMAL = {"status": "normal", "anomalies": [], "risk_level": "low", "suggestions": []}
+
+
+class SlowUpstream:
+    """httpx.MockTransport的异步处理函数：每个请求停留delay秒，记录同时在途的请求数的最大值"""
+
+    def __init__(self, delay: float = 0.02):
+        self.delay = delay
+        self.active = 0
+        self.peak = 0
+
+    async def __call__(self, request: httpx.Request) -> httpx.Response:
+        self.active += 1
+        self.peak = max(self.peak, self.active)
+        try:
+            await asyncio.sleep(self.delay)
+        finally:
+            self.active -= 1
+        return httpx.Response(200, json={
+            "id": "chatcmpl-1",
+            "object": "chat.completion",
+            "created": 0,
+            "model": json.loads(request.content)["model"],
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": "{}"}, "finish_reason": "stop"}],
+        })
+
+
+class StubPipeline:
+    """每条对话请求一次上游；session_id以bad开头的抛出异常，以risky开头的返回高风险的安全结论，
+    delays 按session_id指定额外的耗时，用来控制完成顺序"""
+
+    def __init__(self, client: OpenAIClient, delays: dict = None):
+        self.client = client
+        self.delays = delays or {}
+
+    async def run(self, conversation, session_id):
+        await asyncio.sleep(self.delays.get(session_id, 0))
+        if session_id.startswith("bad"):
+            raise RuntimeError("pipeline exploded")
+        await self.client.generate([{"role": "user", "content": conversation[-1].content}])
+        if session_id.startswith("risky"):
+            return {**SAFE, "has_issues": True, "severity": "high", "description": "诱导自伤"}, dict(NORMAL, anomalies=[])
+        return dict(SAFE), dict(NORMAL, anomalies=[])
+
+
+def items(*session_ids):
+    return [
+        {"session_id": session_id, "conversation_history": [{"role": "user", "content": f"最近睡不好 {session_id}"}]}
+        for session_id in session_ids
+    ]
+
+
+def post(body, upstream: SlowUpstream = None, delays: dict = None, **params) -> httpx.Response:
+    """在进程内挂载路由并发出批量请求；上游由 httpx.MockTransport 应答"""
+    async def run():
+        client = OpenAIClient(http_client=httpx.AsyncClient(transport=httpx.MockTransport(upstream or SlowUpstream())))
+        app = FastAPI()
+        app.include_router(router, prefix="/api/v1")
+        app.state.pipeline = StubPipeline(client, delays)
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as api:
+            response = await api.post("/api/v1/monitor/batch", json=body, params=params, timeout=30)
+        await client.aclose()
+        return response
+    return asyncio.run(run())
+
+
+def test_failed_item_does_not_affect_others():
+    response = post({"items": items("a", "bad", "risky")})
+
+    assert response.status_code == 200
+    results = response.json()["results"]
+    assert [(item["index"], item["session_id"]) for item in results] == [(0, "a"), (1, "bad"), (2, "risky")]
+    assert results[1] == {"index": 1, "session_id": "bad", "result": None, "error": "pipeline exploded"}
+    # 其它条目各自合并自己的安全结论
+    assert results[0]["result"]["status"] == "normal" and results[0]["error"] is None
+    assert results[2]["result"]["status"] == "alert"
+    assert results[2]["result"]["anomalies"][0]["description"] == "诱导自伤"
+
+
+def test_stream_yields_items_in_completion_order():
+    # a最慢、c最快：流式按完成顺序返回，非流式按index排序
+    delays = {"a": 0.2, "bad": 0.1, "c": 0.0}
+    response = post({"items": items("a", "bad", "c")}, delays=delays, stream="true")
+
+    assert response.headers["content-type"].startswith("application/x-ndjson")
+    assert response.text.endswith("\n")
+    parsed = [BatchItemResult.model_validate(json.loads(line)) for line in response.text.splitlines()]
+    assert [item.session_id for item in parsed] == ["c", "bad", "a"]
+    assert [item.index for item in parsed] == [2, 1, 0]
+    assert parsed[1].error == "pipeline exploded" and parsed[1].result is None
+
+    ordered = post({"items": items("a", "bad", "c")}, delays=delays).json()["results"]
+    assert [item["index"] for item in ordered] == [0, 1, 2]
+
+
+def test_too_many_items_is_rejected(monkeypatch):
+    monkeypatch.setattr(settings, "BATCH_MAX_ITEMS", 2)
+    upstream = SlowUpstream()
+    response = post({"items": items("a", "b", "c")}, upstream)
+
+    assert response.status_code == 413
+    assert response.json()["detail"]["items"] == 3
+    assert upstream.peak == 0
+
+
+def test_items_share_one_upstream_concurrency_limit(monkeypatch):
+    monkeypatch.setattr(settings, "BATCH_MAX_CONCURRENCY", 3)
+    upstream = SlowUpstream()
+    response = post({"items": items(*"abcdef"), "max_concurrency": 2}, upstream)
+    assert response.status_code == 200
+    assert all(item["result"] for item in response.json()["results"])
+    assert upstream.peak == 2
+
+    # 请求的max_concurrency不能超过配置的上限
+    upstream = SlowUpstream()
+    post({"items": items(*"abcdef"), "max_concurrency": 50}, upstream)
+    assert upstream.peak == 3
@@ -0,0 +1,256 @@
+import asyncio
+import json
+import sqlite3
+import aiosqlite
+import httpx
+from app.config import settings
+from app.core import cache as cache_module
+from app.core.cache import VerdictCache
+from app.core.model_client import OpenAIClient
+
+VERDICT = {
+    "has_issues": False,
+    "severity": "low",
+    "risk_types": [],
+    "description": "无风险",
+    "recommendations": [],
+    "requires_immediate_action": False,
+}
+MESSAGES = [{"role": "system", "content": "安全审核"}, {"role": "user", "content": "user: 你好\n"}]
+
+
+class Clock:
+    def __init__(self, now: float = 1000.0):
+        self.now = now
+
+    def __call__(self) -> float:
+        return self.now
+
+
+class CountingUpstream:
+    """httpx.MockTransport的处理函数：记录请求数，返回包在```json代码块里的结论"""
+
+    def __init__(self, content: str = None):
+        self.requests = 0
+        self.content = content or "```json\n" + json.dumps(VERDICT, ensure_ascii=False) + "\n```"
+
+    def __call__(self, request: httpx.Request) -> httpx.Response:
+        self.requests += 1
+        content = self.content
+        return httpx.Response(200, json={
+            "id": f"chatcmpl-{self.requests}",
+            "object": "chat.completion",
+            "created": 0,
+            "model": json.loads(request.content)["model"],
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+        })
+
+
+def test_lru_eviction_by_entries():
+    async def run():
+        cache = VerdictCache(max_entries=2)
+        await cache.set("a", {"v": 1})
+        await cache.set("b", {"v": 2})
+        # 访问a之后b成为最久未使用的
+        await cache.get("a")
+        await cache.set("c", {"v": 3})
+        return cache, [await cache.get(key) for key in ("a", "b", "c")]
+
+    cache, values = asyncio.run(run())
+    assert values == [{"v": 1}, None, {"v": 3}]
+    assert cache.stats()["evictions"] == 1
+
+
+def test_eviction_by_bytes():
+    async def run():
+        cache = VerdictCache(max_bytes=60)
+        for key in "abcd":
+            await cache.set(key, {"description": key * 20})
+        return cache
+
+    stats = asyncio.run(run()).stats()
+    assert stats["bytes"] <= 60
+    assert stats["entries"] == 1
+    assert stats["evictions"] == 3
+
+
+def test_ttl_expiry(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(cache_module.time, "time", clock)
+
+    async def run():
+        cache = VerdictCache(ttl=10)
+        await cache.set("a", {"v": 1})
+        clock.now += 9
+        fresh = await cache.get("a")
+        clock.now += 2
+        return cache, fresh, await cache.get("a")
+
+    cache, fresh, expired = asyncio.run(run())
+    assert fresh == {"v": 1}
+    assert expired is None
+    assert cache.stats()["entries"] == 0
+
+
+def test_returned_values_are_copies():
+    async def run():
+        cache = VerdictCache()
+        await cache.set("a", {"risk_types": []})
+        (await cache.get("a"))["risk_types"].append("篡改")
+        return await cache.get("a")
+
+    assert asyncio.run(run()) == {"risk_types": []}
+
+
+def test_sqlite_tier_survives_restart_and_expires(tmp_path, monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(cache_module.time, "time", clock)
+    path = str(tmp_path / "cache.db")
+
+    async def run():
+        first = VerdictCache(ttl=10, sqlite_path=path)
+        await first.set("a", {"v": 1})
+        await first.close()
+
+        second = VerdictCache(ttl=10, sqlite_path=path)
+        restored = await second.get("a")
+        clock.now += 11
+        third = VerdictCache(ttl=10, sqlite_path=path)
+        expired = await third.get("a")
+        await second.close()
+        await third.close()
+        return second, restored, expired
+
+    second, restored, expired = asyncio.run(run())
+    assert restored == {"v": 1}
+    assert second.persistent_hits == 1
+    assert expired is None
+
+
+def test_key_covers_detector_prompt_model_and_temperature():
+    key = VerdictCache.make_key("security", MESSAGES, "m1", 0.3)
+    assert key == VerdictCache.make_key("security", [dict(m) for m in MESSAGES], "m1", 0.3)
+    changed_prompt = [{"role": "system", "content": "安全审核v2"}, MESSAGES[1]]
+    assert len({
+        key,
+        VerdictCache.make_key("emotional", MESSAGES, "m1", 0.3),
+        VerdictCache.make_key("security", changed_prompt, "m1", 0.3),
+        VerdictCache.make_key("security", MESSAGES, "m2", 0.3),
+        VerdictCache.make_key("security", MESSAGES, "m1", 0.7),
+    }) == 5
+
+
+def test_generate_json_hit_skips_upstream():
+    upstream = CountingUpstream()
+    client = OpenAIClient(
+        http_client=httpx.AsyncClient(transport=httpx.MockTransport(upstream)),
+        cache=VerdictCache()
+    )
+
+    async def run():
+        first = await client.generate_json(MESSAGES, detector="security")
+        first["risk_types"].append("调用方修改")
+        second = await client.generate_json(MESSAGES, detector="security")
+        other = await client.generate_json(MESSAGES, detector="security", temperature=0.9)
+        await client.aclose()
+        return second, other
+
+    second, other = asyncio.run(run())
+    # 第二次命中缓存；temperature不同视为另一个请求
+    assert upstream.requests == 2
+    assert second == VERDICT and other == VERDICT
+    assert client.cache.stats()["hits"] == 1
+
+
+def test_truncated_verdict_is_not_cached():
+    # max_tokens截断后保守补全的结论不能被缓存，否则同一段对话之后一直拿到补全的结论
+    upstream = CountingUpstream('{"has_issues": false, "requires_immediate_action": false, "severity": "lo')
+    client = OpenAIClient(
+        http_client=httpx.AsyncClient(transport=httpx.MockTransport(upstream)),
+        cache=VerdictCache()
+    )
+
+    async def run():
+        first = await client.generate_json(MESSAGES, detector="security")
+        second = await client.generate_json(MESSAGES, detector="security")
+        await client.aclose()
+        return first, second
+
+    first, second = asyncio.run(run())
+    assert first["truncated"] is True and second["truncated"] is True
+    assert upstream.requests == 2
+    assert client.cache.stats()["entries"] == 0
+
+
+def test_sqlite_purges_expired_rows_on_set(tmp_path, monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(cache_module.time, "time", clock)
+    path = str(tmp_path / "cache.db")
+
+    async def run():
+        cache = VerdictCache(ttl=10, sqlite_path=path, purge_interval=60)
+        await cache.set("a", {"v": 1})
+        await cache.set("b", {"v": 2})
+        clock.now += 30
+        # 未到purge_interval，过期的行还留在库里
+        await cache.set("c", {"v": 3})
+        before = cache.purged
+        clock.now += 31
+        await cache.set("d", {"v": 4})
+        await cache.close()
+        return cache, before
+
+    cache, before = asyncio.run(run())
+    assert before == 0
+    assert cache.purged == 3
+    with sqlite3.connect(path) as db:
+        assert [row[0] for row in db.execute("SELECT key FROM verdict_cache")] == ["d"]
+
+
+def test_concurrent_first_access_opens_one_connection(tmp_path, monkeypatch):
+    opened = []
+    connect = aiosqlite.connect
+
+    def counting_connect(*args, **kwargs):
+        opened.append(args[0])
+        return connect(*args, **kwargs)
+    monkeypatch.setattr(aiosqlite, "connect", counting_connect)
+
+    async def run():
+        cache = VerdictCache(sqlite_path=str(tmp_path / "cache.db"))
+        await asyncio.gather(*[cache.get(key) for key in "abcde"])
+        await cache.close()
+
+    asyncio.run(run())
+    assert len(opened) == 1
+
+
+def test_verdict_is_keyed_on_the_model_that_answered(monkeypatch):
+    monkeypatch.setattr(settings, "ROUTER_HEALTH_INTERVAL", 0)
+    monkeypatch.setattr(settings, "ROUTER_ENDPOINT_RETRIES", 0)
+    monkeypatch.setattr(settings, "LLM_ENDPOINTS", [
+        {"name": "primary", "provider": "local", "base_url": "http://primary/v1", "model": "big", "priority": 0},
+        {"name": "backup", "provider": "local", "base_url": "http://backup/v1", "model": "small", "priority": 1},
+    ])
+    upstream = CountingUpstream()
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        # 主端点不可用，由backup端点的另一个模型应答
+        if request.url.host == "primary":
+            return httpx.Response(503, json={"error": {"message": "down"}})
+        return upstream(request)
+
+    cache = VerdictCache()
+    client = OpenAIClient(http_client=httpx.AsyncClient(transport=httpx.MockTransport(handler)), cache=cache)
+
+    async def run():
+        await client.generate_json(MESSAGES, detector="security")
+        again = await client.generate_json(MESSAGES, detector="security")
+        await client.aclose()
+        return again
+
+    assert asyncio.run(run()) == VERDICT
+    assert upstream.requests == 1
+    temperature = settings.TEMPERATURE
+    assert asyncio.run(cache.get(VerdictCache.make_key("security", MESSAGES, "small", temperature))) == VERDICT
+    assert asyncio.run(cache.get(VerdictCache.make_key("security", MESSAGES, "big", temperature))) is None
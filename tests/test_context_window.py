@@ -0,0 +1,123 @@
+import random
+from app.api.routes import Message
+from app.core.context_window import ContextWindow
+
+RISKY = "我有时候觉得不想活了"
+
+
+def conversation(turns: int, seed: int = 0, risky_at=(), long_at=()):
+    rng = random.Random(seed)
+    messages = []
+    for i in range(turns):
+        role = "user" if i % 2 == 0 else "assistant"
+        content = "今天聊聊工作和生活里的小事情" * rng.randint(1, 4) + f"（第{i}条）"
+        if i in risky_at:
+            content = RISKY + f"（第{i}条）"
+        if i in long_at:
+            content = content * 40
+        messages.append(Message(role=role, content=content))
+    return messages
+
+
+def test_short_conversation_is_returned_verbatim():
+    messages = conversation(4)
+    window = ContextWindow(default_budget=10000, count_tokens=len)
+    assert window.render("emotional", messages) == "".join(f"{m.role}: {m.content}\n" for m in messages)
+    # 预算<=0表示不限制
+    assert ContextWindow(default_budget=0, count_tokens=len).render("emotional", conversation(200)).count("\n") == 200
+
+
+def test_render_stays_within_budget():
+    # 用字符数计数，预算可以精确核对
+    for seed in range(5):
+        messages = conversation(80, seed, risky_at=(6, 30, 50), long_at=(78, 79))
+        for budget in (150, 300, 600, 1200, 3000):
+            for summary_tokens in (50, 400):
+                window = ContextWindow(default_budget=budget, summary_tokens=summary_tokens, count_tokens=len)
+                for reserved in (0, 100):
+                    text = window.render("behavioral", messages, reserved=reserved)
+                    assert len(text) + reserved <= budget, (seed, budget, summary_tokens, reserved)
+
+
+def test_render_with_estimator_stays_within_budget():
+    window = ContextWindow(default_budget=800, summary_tokens=200)
+    text = window.render("behavioral", conversation(80, risky_at=(6,)))
+    assert window.count_tokens(text) <= 800
+
+
+def test_per_detector_budget():
+    window = ContextWindow(budgets={"behavioral": 300}, default_budget=100000, count_tokens=len)
+    messages = conversation(60)
+    assert len(window.render("behavioral", messages)) <= 300
+    assert "【较早对话摘要】" not in window.render("emotional", messages)
+
+
+def test_risky_user_turns_are_kept_verbatim():
+    messages = conversation(60, risky_at=(2, 10))
+    # 助手引用了风险词，但只有用户的发言需要原样保留
+    messages[5] = Message(role="assistant", content="你说" + RISKY + "，能多说一点吗？")
+    window = ContextWindow(default_budget=600, summary_tokens=150, count_tokens=len)
+    text = window.render("emotional", messages)
+
+    risky_section = text.split("【较早的风险相关用户发言(原文)】\n")[1].split("【最近对话】")[0]
+    assert risky_section.strip("\n").split("\n") == [f"user: {RISKY}（第2条）", f"user: {RISKY}（第10条）"]
+    assert f"assistant: 你说{RISKY}，能多说一点吗？\n" not in text
+    # 较早的普通轮次被压缩进摘要
+    assert "【较早对话摘要】" in text
+    assert text.split("【最近对话】\n")[1].endswith(f"{messages[-1].role}: {messages[-1].content}\n")
+
+
+def test_min_recent_turns_are_truncated_from_the_front():
+    messages = conversation(10, long_at=(8, 9))
+    window = ContextWindow(default_budget=300, summary_tokens=50, min_recent_turns=2, count_tokens=len)
+    recent = window.render("emotional", messages).split("【最近对话】\n")[1]
+
+    lines = recent.strip("\n").split("\n")
+    assert [line.split(": ")[0] for line in lines] == ["user", "assistant"]
+    # 过长的消息保留结尾（最新的内容）
+    assert lines[0].startswith("user: …") and lines[0].endswith("（第8条）")
+    assert lines[1].startswith("assistant: …") and lines[1].endswith("（第9条）")
+
+
+def test_summary_is_cached_by_content():
+    window = ContextWindow(default_budget=500, summary_tokens=200, count_tokens=len)
+    messages = conversation(60)
+    first = window.render("emotional", messages)
+    assert len(window._summaries) == 1
+
+    # 再次渲染同样的较早轮次时直接使用缓存的摘要
+    key = next(iter(window._summaries))
+    window._summaries[key] = "（缓存的摘要）"
+    second = window.render("emotional", messages)
+    assert "（缓存的摘要）" in second
+    assert second.replace("（缓存的摘要）", "") != first.replace("（缓存的摘要）", "")
+
+    # 客户端重发时时间戳不同，内容相同仍然命中
+    resent = [Message(role=m.role, content=m.content, timestamp="2026-01-01T00:00:00") for m in messages]
+    assert "（缓存的摘要）" in window.render("emotional", resent)
+    assert len(window._summaries) == 1
+
+
+def test_summary_cache_is_bounded_lru():
+    window = ContextWindow(cache_size=2, count_tokens=len)
+    a, b, c = (conversation(4, seed) for seed in (1, 2, 3))
+    window.summarize(a, 100)
+    window.summarize(b, 100)
+    window.summarize(a, 100)
+    window.summarize(c, 100)
+    cached = set(window._summaries.values())
+    assert window.summarize(a, 100) in cached
+    assert window.summarize(c, 100) in cached
+    assert len(window._summaries) == 2
+    # 最久未用的b被淘汰
+    assert window.summarize(b, 100) not in cached
+
+
+def test_summary_respects_its_budget():
+    window = ContextWindow(count_tokens=len)
+    messages = conversation(40)
+    for max_tokens in (100, 200, 500):
+        summary = window.summarize(messages, max_tokens)
+        assert len(summary) + summary.count("\n") + 1 <= max_tokens
+        assert summary.endswith(messages[-1].content[:60] + ("…" if len(messages[-1].content) > 60 else ""))
+    assert window.summarize(messages, 200).startswith("…(更早的")
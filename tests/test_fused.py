@@ -0,0 +1,169 @@
+import asyncio
+import json
+from app.api.routes import Message
+from app.config import settings
+from app.core.context_window import ContextWindow
+from app.core.fused import FusedAnalyzer
+from app.core.model_client import BaseModelClient
+from app.core.monitor import DialogueMonitor
+from app.core.security import SecurityManager
+from app.core.session_store import SessionContext
+
+SECURITY_CLEAR = {
+    "has_issues": False, "requires_immediate_action": False, "severity": "low",
+    "risk_types": [], "description": "未发现安全问题", "recommendations": [],
+}
+
+
+def section(flag: str, list_field: str, value: bool, severity: str, name: str) -> dict:
+    return {flag: value, "severity": severity, list_field: [name] if value else [],
+            "description": f"{name}描述", "suggestions": [f"{name}建议"] if value else []}
+
+
+def fused_payload(security=None) -> dict:
+    return {
+        "security": dict(security or SECURITY_CLEAR),
+        "risk_assessment": section("has_risk", "risk_types", True, "high", "自伤风险"),
+        "behavioral_issues": section("has_issues", "patterns", True, "medium", "重复提问"),
+        "interaction_quality": section("is_problematic", "issues", False, "low", "交互"),
+        "response_quality": section("has_issues", "issues", True, "low", "回答空泛"),
+        "content_safety": section("has_issues", "issues", False, "low", "内容安全"),
+    }
+
+
+class FusedClient(BaseModelClient):
+    """对融合检测返回固定的结论，并把各部分拆开分别应答单独的检测器；记录每次请求"""
+
+    model_name = "fused-stub"
+
+    def __init__(self, payload: dict, error: Exception = None):
+        super().__init__()
+        self.payload = payload
+        self.error = error
+        self.calls = []
+
+    async def generate(self, messages, detector=None, **kwargs) -> str:
+        self.calls.append((detector, messages[-1]["content"]))
+        if self.error is not None:
+            raise self.error
+        parts = {
+            "fused": self.payload,
+            "security": self.payload["security"],
+            "emotional": {"risk_assessment": self.payload["risk_assessment"]},
+            "behavioral": {k: self.payload[k] for k in ("behavioral_issues", "interaction_quality")},
+            "quality": {k: self.payload[k] for k in ("response_quality", "content_safety")},
+        }
+        return json.dumps(parts[detector], ensure_ascii=False)
+
+
+CONVERSATION = [
+    Message(role="user", content="我最近总是失眠，反复问你也没用"),
+    Message(role="assistant", content="失眠确实很难受，可以试试规律作息。"),
+]
+
+
+def build(client):
+    window = ContextWindow.from_settings()
+    security = SecurityManager(client, window)
+    monitor = DialogueMonitor(client, window)
+    return FusedAnalyzer(monitor, security), security, monitor
+
+
+def test_fused_payload_is_split_into_detector_results():
+    client = FusedClient(fused_payload())
+    analyzer, _, _ = build(client)
+    security_check, monitor_result = asyncio.run(analyzer.analyze(CONVERSATION, "s1"))
+
+    assert [detector for detector, _ in client.calls] == ["fused"]
+    assert security_check["has_issues"] is False and security_check["session_id"] == "s1"
+    assert "timestamp" in security_check and "local_findings" not in security_check
+    assert [(a["type"], a["severity"]) for a in monitor_result["anomalies"]] == [
+        ("risk", "high"), ("behavioral", "medium"), ("quality", "low")
+    ]
+    assert monitor_result["status"] == "alert" and monitor_result["risk_level"] == "high"
+    assert monitor_result["suggestions"] == ["0. 自伤风险建议", "1. 重复提问建议", "2. 回答空泛建议"]
+
+
+def test_fused_results_match_separate_detectors():
+    payload = fused_payload()
+    fused_security, fused_monitor = asyncio.run(build(FusedClient(payload))[0].analyze(CONVERSATION, "s1"))
+
+    # 同样的结论分别由四个检测器给出时，结果格式和内容一致
+    client = FusedClient(payload)
+    _, security, monitor = build(client)
+
+    async def separate():
+        return await asyncio.gather(
+            security.check_dialogue_safety(CONVERSATION, "s1"),
+            monitor._check_emotional_state(CONVERSATION),
+            monitor._check_behavioral_patterns(CONVERSATION),
+            monitor._check_ai_response_quality(CONVERSATION),
+        )
+
+    security_check, emotional, behavioral, quality = asyncio.run(separate())
+    strip = lambda check: {k: v for k, v in check.items() if k != "timestamp"}
+    assert strip(fused_security) == strip(security_check)
+    assert fused_monitor == monitor.build_result(emotional, behavioral, quality)
+
+
+def test_immediate_action_adds_recommendations():
+    urgent = dict(SECURITY_CLEAR, has_issues=True, requires_immediate_action=True, severity="high",
+                  risk_types=["违法"], recommendations=["核实情况"])
+    security_check, _ = asyncio.run(build(FusedClient(fused_payload(urgent)))[0].analyze(CONVERSATION, "s1"))
+    assert security_check["recommendations"] == ["核实情况", "立即中断当前对话", "记录相关信息", "通知相关负责人"]
+
+
+def test_decisive_pii_overrides_llm_security_verdict(monkeypatch):
+    monkeypatch.setattr(settings, "PII_SHORT_CIRCUIT_TYPES", ["id_card", "bank_card"])
+    conversation = CONVERSATION + [Message(role="user", content="我的身份证号是11010519491231002X，帮我查查")]
+    client = FusedClient(fused_payload())
+    security_check, monitor_result = asyncio.run(build(client)[0].analyze(conversation, "s1"))
+
+    # LLM认为没有安全问题，但本地预检的决定性命中优先
+    assert security_check["has_issues"] is True and security_check["severity"] == "high"
+    assert "id_card" in security_check["risk_types"]
+    assert "id_card" in [f["type"] for f in security_check["local_findings"]]
+    assert "11010519491231002X" not in json.dumps(security_check, ensure_ascii=False)
+    # 其余检测结果仍来自同一次融合请求
+    assert [a["type"] for a in monitor_result["anomalies"]] == ["risk", "behavioral", "quality"]
+    assert len(client.calls) == 1 and "【本地预检提示】" in client.calls[0][1]
+
+
+def test_non_decisive_pii_is_a_hint_and_keeps_llm_verdict():
+    conversation = CONVERSATION + [Message(role="user", content="有事打我电话13812345678")]
+    client = FusedClient(fused_payload())
+    security_check, _ = asyncio.run(build(client)[0].analyze(conversation, "s1"))
+
+    assert security_check["has_issues"] is False
+    assert [f["type"] for f in security_check["local_findings"]] == ["phone"]
+    assert "【本地预检提示】" in client.calls[0][1]
+
+
+def test_fused_failure_is_conservative_and_not_saved():
+    session = SessionContext("s1", CONVERSATION)
+    client = FusedClient(fused_payload(), error=RuntimeError("upstream down"))
+    security_check, monitor_result = asyncio.run(build(client)[0].analyze(CONVERSATION, "s1", session))
+
+    assert "system_error" in security_check["risk_types"] and security_check["has_issues"] is True
+    assert [a["type"] for a in monitor_result["anomalies"]] == ["system"]
+    assert session.next_state() is None
+
+
+def test_session_records_each_detector_and_reuses_unchanged_conversation():
+    client = FusedClient(fused_payload())
+    analyzer, _, _ = build(client)
+    session = SessionContext("s1", CONVERSATION)
+    first_security, first_monitor = asyncio.run(analyzer.analyze(CONVERSATION, "s1", session))
+
+    state = session.next_state()
+    assert set(state["verdicts"]) == {"emotional", "behavioral", "quality", "security", "fused"}
+    assert state["verdicts"]["fused"]["security"]["has_issues"] is False
+
+    # 客户端重发同样的对话时直接复用，不再请求模型
+    security_check, monitor_result = asyncio.run(
+        analyzer.analyze(CONVERSATION, "s1", SessionContext("s1", CONVERSATION, state))
+    )
+    assert len(client.calls) == 1
+    assert monitor_result == first_monitor
+    assert {k: v for k, v in security_check.items() if k != "timestamp"} == \
+        {k: v for k, v in first_security.items() if k != "timestamp"}
@@ -0,0 +1,85 @@
+import json
+import pytest
+from app.config import settings
+from app.core.json_output import DETECTOR_SCHEMAS, JSONOutputParser, output_token_budget, repair_json
+
+SECURITY = {
+    "has_issues": True,
+    "requires_immediate_action": False,
+    "severity": "medium",
+    "risk_types": ["隐私泄露"],
+    "description": "用户提供了身份证号, 需要提醒",
+    "recommendations": ["提醒用户不要透露个人信息"],
+}
+
+
+def test_fenced_output():
+    text = "结论如下：\n```json\n" + json.dumps(SECURITY, ensure_ascii=False) + "\n```"
+    assert repair_json(text) == SECURITY
+
+
+def test_trailing_comma_outside_strings_only():
+    text = '{"description": "列表 [a, b,] 和 {x,}", "risk_types": ["a", "b",],}'
+    assert repair_json(text) == {"description": "列表 [a, b,] 和 {x,}", "risk_types": ["a", "b"]}
+
+
+def test_text_after_object_is_ignored():
+    text = json.dumps(SECURITY, ensure_ascii=False) + "\n以上是我的判断。"
+    assert repair_json(text) == SECURITY
+
+
+def test_truncated_security_keeps_booleans():
+    full = json.dumps(SECURITY, ensure_ascii=False)
+    text = full[:full.index("提醒用户")]
+    result = JSONOutputParser(DETECTOR_SCHEMAS["security"]).parse(text)
+    assert result["has_issues"] is True
+    assert result["requires_immediate_action"] is False
+    assert result["severity"] == "medium"
+    assert result["truncated"] is True
+
+
+def test_truncated_before_booleans_is_conservative():
+    result = JSONOutputParser(DETECTOR_SCHEMAS["security"]).parse('{"has_issues": fal')
+    assert result["has_issues"] is True
+    assert result["requires_immediate_action"] is True
+    assert result["truncated"] is True
+    assert result["description"]
+
+
+def test_truncated_before_severity_assumes_highest():
+    # 安全结论在给出严重程度之前被截断：不能按最低一档处理
+    result = JSONOutputParser(DETECTOR_SCHEMAS["security"]).parse('{"has_issues": true, "requires_immediate_action": false, "sever')
+    assert result["has_issues"] is True
+    assert result["severity"] == "high"
+    assert result["truncated"] is True
+
+    cut_inside = JSONOutputParser(DETECTOR_SCHEMAS["security"]).parse('{"has_issues": false, "requires_immediate_action": false, "severity": "lo')
+    assert cut_inside["severity"] == "high"
+
+    complete = JSONOutputParser(DETECTOR_SCHEMAS["security"]).parse('{"has_issues": false, "requires_immediate_action": false}')
+    assert complete["severity"] == "low"
+    assert "truncated" not in complete
+
+
+def test_missing_boolean_without_truncation_still_fails():
+    text = json.dumps({"severity": "low"})
+    with pytest.raises(ValueError):
+        JSONOutputParser(DETECTOR_SCHEMAS["security"]).parse(text)
+
+
+def test_truncated_fused_defaults_missing_sections():
+    text = '{"security": ' + json.dumps(SECURITY, ensure_ascii=False) + ', "emotional_analysis": {"has_neg'
+    result = JSONOutputParser(DETECTOR_SCHEMAS["fused"]).parse(text)
+    assert result["security"]["has_issues"] is True
+    assert result["security"]["requires_immediate_action"] is False
+    assert result["truncated"] is True
+    for name, schema in DETECTOR_SCHEMAS["fused"]["properties"].items():
+        assert name in result
+        for field, sub_schema in schema.get("properties", {}).items():
+            if sub_schema.get("type") == "boolean" and name != "security":
+                assert result[name][field] is True
+
+
+@pytest.mark.parametrize("detector", sorted(DETECTOR_SCHEMAS))
+def test_output_caps_cover_schema(detector):
+    assert settings.OUTPUT_MAX_TOKENS[detector] >= 1.2 * output_token_budget(DETECTOR_SCHEMAS[detector])
@@ -0,0 +1,323 @@
+import asyncio
+import threading
+import time
+import pytest
+from app.core.local_inference import BatchScheduler, HFBatchGenerator, configure_cpu_threads, load_causal_lm
+from app.core.model_client import LocalModelClient, call_limiter, call_trace, create_model_client
+
+
+class RecordingGenerator:
+    """和HFBatchGenerator接口相同的替身：记录每次批量生成的参数，输出由prompt和token上限拼成"""
+
+    def __init__(self, delay: float = 0.0, fail_on: str = None, chunks=None):
+        self.delay = delay
+        self.fail_on = fail_on
+        self.calls = []
+        self.stream_tokens = 0
+        # 流式生成依次产出chunks；没有给出时每个解码步产出一个"字"，直到max_new_tokens
+        self.chunks = chunks
+        self.stream_stopped = None
+        self.stream_finished = threading.Event()
+
+    def build_prompt(self, query, history=None, system=""):
+        return system + query
+
+    def generate(self, prompts, max_new_tokens=512, temperature=0.0, top_p=1.0):
+        self.calls.append({"prompts": list(prompts), "max_new_tokens": list(max_new_tokens),
+                           "temperature": temperature, "top_p": top_p})
+        time.sleep(self.delay)
+        if self.fail_on in prompts:
+            raise RuntimeError("generation failed")
+        return [(f"{prompt}:{limit}", "length", limit) for prompt, limit in zip(prompts, max_new_tokens)]
+
+    def stream(self, query, history=None, max_new_tokens=512, temperature=0.0, top_p=1.0, stop_event=None):
+        chunks = self.chunks or ["字"] * max_new_tokens
+        try:
+            for chunk in chunks:
+                if stop_event.is_set():
+                    break
+                self.stream_tokens += 1
+                time.sleep(0.005)
+                yield chunk
+        finally:
+            self.stream_stopped = stop_event.is_set()
+            self.stream_finished.set()
+
+
+@pytest.fixture(scope="module")
+def tiny_model_path(tmp_path_factory) -> str:
+    """离线构造一个随机初始化的两层Llama和BPE tokenizer，保存为HF格式"""
+    torch = pytest.importorskip("torch")
+    transformers = pytest.importorskip("transformers")
+    from tokenizers import Tokenizer, decoders, models, pre_tokenizers, trainers
+
+    tokenizer = Tokenizer(models.BPE())
+    tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tokenizer.decoder = decoders.ByteLevel()
+    tokenizer.train_from_iterator(["你好，最近总是失眠", "问：答："], trainers.BpeTrainer(
+        vocab_size=300, special_tokens=["</s>"], initial_alphabet=pre_tokenizers.ByteLevel.alphabet()
+    ))
+    tokenizer = transformers.PreTrainedTokenizerFast(tokenizer_object=tokenizer, eos_token="</s>")
+    torch.manual_seed(0)
+    model = transformers.LlamaForCausalLM(transformers.LlamaConfig(
+        vocab_size=len(tokenizer), hidden_size=32, intermediate_size=64, num_hidden_layers=2,
+        num_attention_heads=2, num_key_value_heads=2, max_position_embeddings=256,
+        bos_token_id=0, eos_token_id=0, pad_token_id=0
+    ))
+    path = str(tmp_path_factory.mktemp("tiny-llama"))
+    tokenizer.save_pretrained(path)
+    model.save_pretrained(path)
+    return path
+
+
+def run_with(scheduler: BatchScheduler, coro):
+    async def run():
+        try:
+            return await coro()
+        finally:
+            await scheduler.stop()
+    return asyncio.run(run())
+
+
+def test_groups_by_sampling_parameters():
+    generator = RecordingGenerator()
+    scheduler = BatchScheduler(generator, max_batch_size=8, batch_wait_ms=50)
+
+    async def submit_all():
+        return await asyncio.gather(
+            scheduler.submit("a", 4),
+            scheduler.submit("b", 5, temperature=0.7, top_p=0.9),
+            scheduler.submit("c", 6),
+            scheduler.submit("d", 7, temperature=0.7, top_p=0.9),
+            scheduler.submit("e", 8, temperature=0.7, top_p=0.5),
+        )
+
+    results = run_with(scheduler, submit_all)
+    # 每个调用方拿到自己那条prompt的结果
+    assert [text for text, _, _ in results] == ["a:4", "b:5", "c:6", "d:7", "e:8"]
+    groups = {(call["temperature"], call["top_p"]): call for call in generator.calls}
+    assert set(groups) == {(0.0, 1.0), (0.7, 0.9), (0.7, 0.5)}
+    assert groups[(0.0, 1.0)]["prompts"] == ["a", "c"]
+    assert groups[(0.0, 1.0)]["max_new_tokens"] == [4, 6]
+    assert groups[(0.7, 0.9)]["prompts"] == ["b", "d"]
+    assert scheduler.stats["requests"] == 5 and scheduler.stats["batches"] == 3
+
+
+def test_max_batch_size_splits_a_burst():
+    generator = RecordingGenerator()
+    scheduler = BatchScheduler(generator, max_batch_size=3, batch_wait_ms=50)
+
+    async def submit_all():
+        return await asyncio.gather(*[scheduler.submit(str(i), 1) for i in range(7)])
+
+    results = run_with(scheduler, submit_all)
+    assert [text for text, _, _ in results] == [f"{i}:1" for i in range(7)]
+    assert [len(call["prompts"]) for call in generator.calls] == [3, 3, 1]
+
+
+def test_batch_wait_window():
+    async def staggered(scheduler: BatchScheduler, gap: float):
+        first = asyncio.ensure_future(scheduler.submit("a", 1))
+        await asyncio.sleep(gap)
+        second = await scheduler.submit("b", 1)
+        return [await first, second]
+
+    # 第二条在窗口内到达：合并为一批
+    generator = RecordingGenerator()
+    scheduler = BatchScheduler(generator, max_batch_size=8, batch_wait_ms=300)
+    run_with(scheduler, lambda: staggered(scheduler, 0.03))
+    assert [call["prompts"] for call in generator.calls] == [["a", "b"]]
+
+    # 第二条在窗口关闭之后到达：单独成批
+    generator = RecordingGenerator()
+    scheduler = BatchScheduler(generator, max_batch_size=8, batch_wait_ms=10)
+    run_with(scheduler, lambda: staggered(scheduler, 0.2))
+    assert [call["prompts"] for call in generator.calls] == [["a"], ["b"]]
+
+
+def test_failed_group_does_not_affect_other_groups():
+    generator = RecordingGenerator(fail_on="bad")
+    scheduler = BatchScheduler(generator, max_batch_size=8, batch_wait_ms=50)
+
+    async def submit_all():
+        return await asyncio.gather(
+            scheduler.submit("bad", 1),
+            scheduler.submit("peer", 1),
+            scheduler.submit("other", 1, temperature=0.5),
+            return_exceptions=True
+        )
+
+    bad, peer, other = run_with(scheduler, submit_all)
+    # 同一批的请求一起失败，其它采样参数的分组照常生成
+    assert isinstance(bad, RuntimeError) and isinstance(peer, RuntimeError)
+    assert other == ("other:1", "length", 1)
+
+
+def test_cancelled_request_is_not_generated():
+    generator = RecordingGenerator()
+    scheduler = BatchScheduler(generator, max_batch_size=8, batch_wait_ms=100)
+
+    async def submit_all():
+        gone = asyncio.ensure_future(scheduler.submit("gone", 1))
+        kept = asyncio.ensure_future(scheduler.submit("kept", 1))
+        await asyncio.sleep(0.02)
+        gone.cancel()
+        return await kept
+
+    assert run_with(scheduler, submit_all)[0] == "kept:1"
+    assert [call["prompts"] for call in generator.calls] == [["kept"]]
+
+
+@pytest.mark.parametrize("batch_size", [1, 4])
+def test_summary_reports_average_batch_size(batch_size):
+    generator = RecordingGenerator()
+    scheduler = BatchScheduler(generator, max_batch_size=batch_size, batch_wait_ms=50)
+
+    async def submit_all():
+        return await asyncio.gather(*[scheduler.submit(str(i), 2) for i in range(4)])
+
+    run_with(scheduler, submit_all)
+    summary = scheduler.summary()
+    assert summary["avg_batch_size"] == batch_size
+    assert summary["generated_tokens"] == 8
+
+
+def test_closing_a_stream_stops_the_worker_thread():
+    generator = RecordingGenerator()
+    scheduler = BatchScheduler(generator)
+
+    async def read_three():
+        received = []
+        stream = scheduler.stream("你好", max_new_tokens=10000)
+        async for text in stream:
+            received.append(text)
+            if len(received) == 3:
+                break
+        # 相当于客户端断开：关闭异步生成器
+        await stream.aclose()
+        return received
+
+    assert run_with(scheduler, read_three) == ["字"] * 3
+    # 工作线程在下一个解码步看到stop_event后退出，没有生成到max_new_tokens
+    assert generator.stream_finished.wait(5)
+    assert generator.stream_stopped is True
+    assert generator.stream_tokens < 100
+    assert scheduler.stats["streams"] == 1
+
+
+def test_stream_errors_reach_the_caller():
+    class BrokenGenerator(RecordingGenerator):
+        def stream(self, *args, **kwargs):
+            yield "半句"
+            raise RuntimeError("CUDA out of memory")
+
+    scheduler = BatchScheduler(BrokenGenerator())
+
+    async def read_all():
+        received = []
+        with pytest.raises(RuntimeError, match="out of memory"):
+            async for text in scheduler.stream("你好"):
+                received.append(text)
+        return received
+
+    assert run_with(scheduler, read_all) == ["半句"]
+
+
+def test_stop_event_ends_model_generation(tiny_model_path):
+    generator = HFBatchGenerator(*load_causal_lm(tiny_model_path))
+    stop_event = threading.Event()
+    stop_event.set()
+    # 停止条件在每个解码步之后检查：已经设置时只生成一步
+    list(generator.stream("你好", max_new_tokens=50, stop_event=stop_event))
+    assert generator.stream_tokens == 1
+
+    generator.stream_tokens = 0
+    list(generator.stream("你好", max_new_tokens=8))
+    assert generator.stream_tokens > 1
+
+
+def test_int8_quantized_model_generates_on_cpu(tiny_model_path):
+    import torch
+
+    model, tokenizer = load_causal_lm(tiny_model_path, device="cpu", dtype="bf16", quantize="int8")
+    linears = [module for module in model.modules() if isinstance(module, torch.nn.Linear)]
+    quantized = [module for module in model.modules() if isinstance(module, torch.ao.nn.quantized.dynamic.Linear)]
+    # 量化前强制使用fp32权重；所有Linear层都被替换为动态int8的版本
+    assert linears == []
+    assert len(quantized) == 2 * 7 + 1
+    assert all(module.weight().dtype == torch.qint8 for module in quantized)
+
+    results = HFBatchGenerator(model, tokenizer).generate(["你好", "最近总是失眠"], [3, 5])
+    assert [count for _, _, count in results] == [3, 5]
+    assert all(reason == "length" for _, reason, _ in results)
+
+
+def test_int8_quantization_is_cpu_only(tiny_model_path):
+    with pytest.raises(ValueError):
+        load_causal_lm(tiny_model_path, device="cuda", quantize="int8")
+
+
+def test_configure_cpu_threads():
+    torch = pytest.importorskip("torch")
+    threads = torch.get_num_threads()
+    try:
+        configure_cpu_threads(1)
+        assert torch.get_num_threads() == 1
+        # 0表示保持默认值
+        configure_cpu_threads(0)
+        assert torch.get_num_threads() == 1
+    finally:
+        torch.set_num_threads(threads)
+
+
+@pytest.fixture
+def local_client(monkeypatch, tiny_model_path):
+    from app.config import settings
+    monkeypatch.setattr(settings, "LLM_BACKEND", "local")
+    monkeypatch.setattr(settings, "LOCAL_MODEL_PATH", tiny_model_path)
+    monkeypatch.setattr(settings, "LOCAL_QUANTIZE", "int8")
+    monkeypatch.setattr(settings, "LOCAL_BATCH_WAIT_MS", 200)
+    return create_model_client()
+
+
+def test_local_client_batches_concurrent_detectors(local_client):
+    messages = {
+        detector: [{"role": "system", "content": f"{detector}检测"}, {"role": "user", "content": "最近总是失眠"}]
+        for detector in ("emotional", "behavioral", "quality")
+    }
+
+    async def run():
+        trace = []
+        call_trace.set(trace)
+        try:
+            texts = await asyncio.gather(*[
+                local_client.generate(detector_messages, detector=detector, max_tokens=4, temperature=0)
+                for detector, detector_messages in messages.items()
+            ])
+        finally:
+            await local_client.aclose()
+        return texts, trace
+
+    assert isinstance(local_client, LocalModelClient)
+    texts, trace = asyncio.run(run())
+    assert len(texts) == 3 and all(isinstance(text, str) for text in texts)
+    # 三个检测器在同一个调度窗口内提交，合并为一次批量生成
+    assert local_client.scheduler.stats["batches"] == 1
+    assert local_client.scheduler.stats["requests"] == 3
+    assert sorted(item["detector"] for item in trace) == ["behavioral", "emotional", "quality"]
+    assert {item["upstream"] for item in trace} == {"inprocess"}
+
+
+def test_local_client_respects_batch_limiter(local_client):
+    async def run():
+        # 批量接口共享的并发上限同样作用于进程内后端：一次只提交一条
+        call_limiter.set(asyncio.Semaphore(1))
+        try:
+            await asyncio.gather(*[
+                local_client.generate([{"role": "user", "content": str(i)}], max_tokens=2) for i in range(3)
+            ])
+        finally:
+            await local_client.aclose()
+
+    asyncio.run(run())
+    assert local_client.scheduler.stats["batches"] == 3
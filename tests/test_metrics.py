@@ -0,0 +1,72 @@
+import json
+import os
+import subprocess
+import sys
+from app.core.metrics import Counter, Gauge, Histogram, Registry
+
+
+def build_registry():
+    registry = Registry()
+    requests = registry.register(Counter("requests_total", "请求数", ["endpoint"]))
+    outstanding = registry.register(Gauge("outstanding", "在途请求数"))
+    circuit = registry.register(Gauge("circuit_state", "熔断状态", multiprocess_mode="max"))
+    latency = registry.register(Histogram("latency_seconds", "耗时", buckets=(0.1, 1.0)))
+    return registry, requests, outstanding, circuit, latency
+
+
+def dead_pid() -> int:
+    process = subprocess.Popen([sys.executable, "-c", "pass"])
+    process.wait()
+    return process.pid
+
+
+def write_worker(directory, pid: int, requests: float, outstanding: float, circuit: float):
+    registry, c, o, s, h = build_registry()
+    c.inc(requests, endpoint="/monitor")
+    o.set(outstanding)
+    s.set(circuit)
+    h.observe(0.5)
+    with open(os.path.join(directory, f"{pid}.json"), "w") as f:
+        json.dump(registry.snapshot(), f)
+
+
+def test_render_multiprocess_merges_workers(tmp_path):
+    registry, requests, outstanding, circuit, latency = build_registry()
+    requests.inc(2, endpoint="/monitor")
+    outstanding.set(1)
+    circuit.set(0)
+    latency.observe(0.05)
+    registry.dump(str(tmp_path))
+    write_worker(str(tmp_path), os.getppid(), requests=3, outstanding=2, circuit=2)
+    write_worker(str(tmp_path), dead_pid(), requests=5, outstanding=7, circuit=1)
+    # 当前进程的值以内存为准，不读落后的文件
+    requests.inc(1, endpoint="/monitor")
+
+    text = registry.render_multiprocess(str(tmp_path))
+    assert 'requests_total{endpoint="/monitor"} 11.0' in text
+    # 已退出的worker的gauge不计入
+    assert "outstanding 3" in text
+    assert "circuit_state 2" in text
+    assert 'latency_seconds_bucket{le="0.1"} 1' in text
+    assert 'latency_seconds_bucket{le="1.0"} 3' in text
+    assert "latency_seconds_count 3" in text
+
+
+def test_dump_is_named_after_pid(tmp_path):
+    registry, requests, *_ = build_registry()
+    requests.inc(endpoint="/batch")
+    registry.dump(str(tmp_path))
+    with open(tmp_path / f"{os.getpid()}.json") as f:
+        assert f.read().count("/batch") == 1
+    assert not list(tmp_path.glob("*.tmp"))
+
+
+def test_render_multiprocess_ignores_unrelated_json(tmp_path):
+    registry, requests, *_ = build_registry()
+    requests.inc(endpoint="/monitor")
+    (tmp_path / "settings.json").write_text("{}")
+    (tmp_path / "12abc.json").write_text("not json")
+    write_worker(str(tmp_path), os.getppid(), requests=2, outstanding=0, circuit=0)
+
+    text = registry.render_multiprocess(str(tmp_path))
+    assert 'requests_total{endpoint="/monitor"} 3.0' in text
@@ -0,0 +1,82 @@
+import asyncio
+import json
+import random
+from app.core.json_output import DETECTOR_SCHEMAS
+from app.core.model_client import BaseModelClient
+from app.core.near_duplicate import NearDuplicateIndex
+from benchmarks.mock_upstream import example
+
+TRANSCRIPT = "\n".join([
+    "user: 你好，我想问一下周末去爬山需要准备些什么东西，天气预报说可能会有点降温",
+    "assistant: 建议带上防风外套、足够的饮用水、简单的食物和急救包，出发前再确认一下天气",
+    "user: 好的谢谢，那登山鞋需要专门买吗，我平时只穿运动鞋，不知道会不会不太安全",
+    "assistant: 如果路线比较平缓，防滑的运动鞋也可以；如果有碎石或陡坡，建议换一双登山鞋",
+    "user: 明白了，我再看看路线，顺便问一下需要提前多久出发才能在天黑前下山比较好",
+    "assistant: 一般建议早上七八点出发，留出充足的休息时间，下午三四点开始下山比较稳妥",
+])
+
+
+class CountingClient(BaseModelClient):
+    model_name = "counting"
+
+    def __init__(self, near_duplicates: NearDuplicateIndex, truncate: bool = False):
+        super().__init__(near_duplicates=near_duplicates)
+        self.truncate = truncate
+        self.calls = 0
+
+    async def generate(self, messages, detector=None, **kwargs) -> str:
+        self.calls += 1
+        text = json.dumps(example(DETECTOR_SCHEMAS[detector], random.Random(0), 0.0), ensure_ascii=False)
+        # truncate时模拟max_tokens截断，只返回前一半
+        return text[:len(text) // 2] if self.truncate else text
+
+
+def ask(client: CountingClient, transcript: str):
+    messages = [{"role": "system", "content": "情绪分析"}, {"role": "user", "content": transcript}]
+    return asyncio.run(client.generate_json(messages, detector="emotional"))
+
+
+def test_similar_benign_transcript_is_reused():
+    client = CountingClient(NearDuplicateIndex())
+    ask(client, TRANSCRIPT)
+    ask(client, TRANSCRIPT.replace("七八点", "七点"))
+    assert client.calls == 1
+
+
+def test_truncated_verdict_is_not_indexed():
+    index = NearDuplicateIndex()
+    client = CountingClient(index, truncate=True)
+    assert ask(client, TRANSCRIPT)["truncated"] is True
+    ask(client, TRANSCRIPT.replace("七八点", "七点"))
+    assert client.calls == 2
+    assert index.stats()["entries"] == 0
+
+
+def test_appended_crisis_line_is_not_reused():
+    index = NearDuplicateIndex()
+    changed = TRANSCRIPT + "\nuser: 其实我想自杀"
+    similarity = float((index.signature(TRANSCRIPT) == index.signature(changed)).mean())
+    assert similarity >= index.threshold
+
+    client = CountingClient(index)
+    ask(client, TRANSCRIPT)
+    ask(client, changed)
+    assert client.calls == 2
+    assert index.stats()["entries"] == 1
+
+
+def test_different_negative_hits_are_not_reused():
+    client = CountingClient(NearDuplicateIndex())
+    ask(client, TRANSCRIPT)
+    ask(client, TRANSCRIPT + "\nuser: 好痛苦")
+    assert client.calls == 2
+
+
+def test_pii_is_never_reused():
+    index = NearDuplicateIndex()
+    with_id = TRANSCRIPT + "\nuser: 我的身份证号是11010519491231002X"
+    assert index.risk_signals(with_id) is None
+    client = CountingClient(index)
+    ask(client, with_id)
+    ask(client, with_id)
+    assert client.calls == 2
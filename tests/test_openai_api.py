@@ -0,0 +1,110 @@
+import argparse
+import asyncio
+import json
+import httpx
+import pytest
+
+pytest.importorskip("torch")
+import openai_api
+from app.core.local_inference import BatchScheduler
+from tests.test_local_inference import RecordingGenerator
+
+
+@pytest.fixture
+def api(monkeypatch):
+    """不经过lifespan（不加载模型），调度器使用替身生成器；返回 (发请求的函数, 生成器)"""
+    generator = RecordingGenerator()
+    monkeypatch.setattr(openai_api, "args", argparse.Namespace(max_new_tokens=32), raising=False)
+
+    def request(bodies, batch_wait_ms: float = 50):
+        scheduler = BatchScheduler(generator, max_batch_size=8, batch_wait_ms=batch_wait_ms)
+        request.scheduler = scheduler
+        monkeypatch.setattr(openai_api, "scheduler", scheduler, raising=False)
+
+        async def run():
+            transport = httpx.ASGITransport(app=openai_api.app)
+            try:
+                async with httpx.AsyncClient(transport=transport, base_url="http://local") as client:
+                    return await asyncio.gather(*[client.post("/v1/chat/completions", json=body) for body in bodies])
+            finally:
+                await scheduler.stop()
+        return asyncio.run(run())
+    return request, generator
+
+
+def body(content: str, **kwargs):
+    return {"model": "chatglm2-6b", "messages": [{"role": "user", "content": content}], **kwargs}
+
+
+def test_concurrent_requests_share_one_batch(api):
+    request, generator = api
+    responses = request([body("甲"), body("乙", max_tokens=5), body("丙")])
+
+    assert [response.status_code for response in responses] == [200, 200, 200]
+    contents = [response.json()["choices"][0]["message"]["content"] for response in responses]
+    # 合并生成后每个请求拿回自己的结果；没有max_tokens时使用--max-new-tokens
+    assert contents == ["甲:32", "乙:5", "丙:32"]
+    assert [call["prompts"] for call in generator.calls] == [["甲", "乙", "丙"]]
+    assert all(response.json()["choices"][0]["finish_reason"] == "length" for response in responses)
+
+
+def test_sampling_parameters_are_batched_separately(api):
+    request, generator = api
+    responses = request([body("甲", temperature=0.8, top_p=0.9), body("乙"), body("丙", temperature=0.8, top_p=0.9)])
+
+    assert [r.json()["choices"][0]["message"]["content"] for r in responses] == ["甲:32", "乙:32", "丙:32"]
+    assert sorted((call["temperature"], call["prompts"]) for call in generator.calls) == [(0.0, ["乙"]), (0.8, ["甲", "丙"])]
+
+
+def test_last_message_must_come_from_user(api):
+    request, generator = api
+    responses = request([{"model": "m", "messages": [{"role": "assistant", "content": "你好"}]}])
+    assert responses[0].status_code == 400
+    assert generator.calls == []
+
+
+def parse_sse(text: str):
+    """返回每个事件的data；SSE的data行不能被内容里的换行打断"""
+    events = []
+    for block in text.replace("\r\n", "\n").strip("\n").split("\n\n"):
+        lines = block.split("\n")
+        assert len(lines) == 1 and lines[0].startswith("data: "), block
+        events.append(lines[0][len("data: "):])
+    return events
+
+
+def test_stream_chunks_are_valid_json(api):
+    request, generator = api
+    generator.chunks = ['他说"你好"', "\n第二行\r\n", "\\", "data: 伪造"]
+    response, = request([body("甲", stream=True)])
+
+    assert response.headers["content-type"].startswith("text/event-stream")
+    events = parse_sse(response.text)
+    assert events[-1] == "[DONE]"
+    chunks = [openai_api.ChatCompletionResponse.model_validate(json.loads(event)) for event in events[:-1]]
+    assert all(chunk.object == "chat.completion.chunk" and chunk.model == "chatglm2-6b" for chunk in chunks)
+    assert chunks[0].choices[0].delta.role == "assistant"
+    assert [chunk.choices[0].delta.content for chunk in chunks[1:-1]] == generator.chunks
+    assert chunks[-1].choices[0].finish_reason == "stop"
+    assert request.scheduler.stats["streams"] == 1
+
+
+def test_closing_predict_stops_generation(api, monkeypatch):
+    request, generator = api
+    scheduler = BatchScheduler(generator)
+    monkeypatch.setattr(openai_api, "scheduler", scheduler, raising=False)
+
+    async def disconnect_after_two_chunks():
+        # 客户端断开时EventSourceResponse关闭predict生成器
+        stream = openai_api.predict("你好", [], "m", max_new_tokens=10000)
+        received = [await stream.__anext__(), await stream.__anext__()]
+        await stream.aclose()
+        await scheduler.stop()
+        return received
+
+    first, content = asyncio.run(disconnect_after_two_chunks())
+    assert json.loads(first)["choices"][0]["delta"] == {"role": "assistant"}
+    assert json.loads(content)["choices"][0]["delta"] == {"content": "字"}
+    assert generator.stream_finished.wait(5)
+    assert generator.stream_stopped is True
+    assert generator.stream_tokens < 100
@@ -0,0 +1,72 @@
+from app.core.pii import PIIScanner, valid_id_card, valid_iin, valid_luhn
+
+
+def scanner():
+    return PIIScanner(short_circuit_types=["id_card", "bank_card"])
+
+
+def types(text):
+    return [f["type"] for f in scanner().scan_text(text)]
+
+
+def test_id_card_checksum():
+    assert valid_id_card("11010519491231002X")
+    assert valid_id_card("11010519491231002x")
+    assert not valid_id_card("110105194912310021")
+
+
+def test_luhn():
+    assert valid_luhn("4111111111111111")
+    assert valid_luhn("6222021234567890128")
+    assert not valid_luhn("4111111111111112")
+
+
+def test_iin():
+    assert valid_iin("6222021234567890128")
+    assert valid_iin("5500000000000004")
+    assert valid_iin("2221000000000009")
+    assert not valid_iin("1234567812345670")
+    assert not valid_iin("9111111111111111")
+
+
+def test_id_card_short_circuits():
+    findings = scanner().scan_text("我的身份证号是11010519491231002X")
+    assert "id_card" in [f["type"] for f in findings]
+    assert scanner().is_decisive(findings)
+    # 校验位不对的18位数字不是身份证号
+    assert "id_card" not in types("编号110105194912310021")
+
+
+def test_bank_card_with_context_short_circuits():
+    findings = scanner().scan_text("我的银行卡号是6222 0212 3456 7890 128")
+    assert "bank_card" in [f["type"] for f in findings]
+    assert scanner().is_decisive(findings)
+    # 结果里的卡号已脱敏
+    assert all("6222021234567890128" not in str(f) for f in findings)
+
+
+def test_order_number_is_not_bank_card():
+    findings = scanner().scan_text("订单号 4111111111111111")
+    assert findings == []
+    assert not scanner().is_decisive(findings)
+    assert types("快递单号：6222021234567890128") == []
+
+
+def test_luhn_valid_number_without_context_is_only_a_hint():
+    findings = scanner().scan_text("4111111111111111")
+    assert [f["type"] for f in findings] == ["possible_bank_card"]
+    assert not scanner().is_decisive(findings)
+
+
+def test_random_long_numbers_rarely_short_circuit():
+    import random
+    rng = random.Random(0)
+    decisive = 0
+    for _ in range(2000):
+        number = "".join(rng.choice("0123456789") for _ in range(16))
+        decisive += scanner().is_decisive(scanner().scan_text(f"数字 {number}"))
+    assert decisive == 0
+
+
+def test_phone_is_not_bank_card():
+    assert types("电话13800138000") == ["phone"]
@@ -0,0 +1,104 @@
+import asyncio
+import json
+import random
+from app.api.routes import Message, merge_results
+from app.config import settings
+from app.core.context_window import ContextWindow
+from app.core.json_output import DETECTOR_SCHEMAS
+from app.core.model_client import BaseModelClient
+from app.core.monitor import DialogueMonitor
+from app.core.pipeline import MonitorPipeline
+from app.core.security import SecurityManager
+from benchmarks.mock_upstream import example
+
+CONVERSATION = [
+    Message(role="user", content="我最近很压抑，感觉活着没有意义"),
+    Message(role="assistant", content="我理解你现在的心情，能和我说说最近发生了什么吗？"),
+]
+
+
+def build_pipeline(client) -> MonitorPipeline:
+    window = ContextWindow.from_settings()
+    return MonitorPipeline(SecurityManager(client, window), DialogueMonitor(client, window))
+
+
+def run_pipeline(client):
+    async def run():
+        try:
+            return await build_pipeline(client).run(CONVERSATION, "s1")
+        finally:
+            await client.aclose()
+    return asyncio.run(run())
+
+
+def test_security_timeout_is_conservative(monkeypatch, mock_upstream, model_client):
+    monkeypatch.setattr(settings, "DETECTOR_DEADLINES", {"security": 0.05})
+    monkeypatch.setattr(settings, "DETECTOR_DEFAULT_DEADLINE", 0)
+    security_check, monitor_result = run_pipeline(model_client(mock_upstream(latency="fixed:0.3")))
+
+    assert security_check["skipped"] == "timed_out"
+    assert security_check["has_issues"] is True
+    assert "system_error" in security_check["risk_types"]
+    assert {"detector": "security", "reason": "timed_out", "deadline": 0.05} in monitor_result["skipped_detectors"]
+    # 其它检测器不受影响
+    assert "detector.emotional" in monitor_result["stage_latencies"]
+    assert merge_results(security_check, monitor_result).risk_level != "low"
+
+
+def test_fused_timeout_is_conservative(monkeypatch, mock_upstream, model_client):
+    monkeypatch.setattr(settings, "ANALYSIS_MODE", "fused")
+    monkeypatch.setattr(settings, "DETECTOR_DEADLINES", {"fused": 0.05})
+    security_check, monitor_result = run_pipeline(model_client(mock_upstream(latency="fixed:0.3")))
+
+    assert security_check["has_issues"] is True
+    assert {item["detector"] for item in monitor_result["skipped_detectors"]} == {"security", "emotional", "behavioral", "quality"}
+
+
+class ScriptedClient(BaseModelClient):
+    """按检测器返回固定结论的客户端，delays控制各检测器的耗时"""
+
+    model_name = "scripted"
+
+    def __init__(self, verdicts: dict, delays: dict):
+        super().__init__()
+        self.verdicts = verdicts
+        self.delays = delays
+        self.calls = []
+
+    async def generate(self, messages, detector=None, **kwargs) -> str:
+        await asyncio.sleep(self.delays.get(detector, 0))
+        self.calls.append(detector)
+        rng = random.Random(0)
+        verdict = self.verdicts.get(detector) or example(DETECTOR_SCHEMAS[detector], rng, 0.0)
+        return json.dumps(verdict, ensure_ascii=False)
+
+
+HIGH_RISK = {"risk_assessment": {
+    "has_risk": True, "severity": "high", "risk_types": ["自杀"], "description": "自杀风险", "suggestions": []
+}}
+SECURITY_HIGH = {
+    "has_issues": True, "severity": "high", "risk_types": ["违法"], "description": "严重安全问题",
+    "recommendations": [], "requires_immediate_action": True
+}
+
+
+def test_early_stop_from_other_detector_keeps_security_running(monkeypatch):
+    monkeypatch.setattr(settings, "EARLY_STOP_RULES", ["risk:high"])
+    client = ScriptedClient({"emotional": HIGH_RISK}, {"emotional": 0.0, "security": 0.2, "behavioral": 1.0, "quality": 1.0})
+    security_check, monitor_result = asyncio.run(build_pipeline(client).run(CONVERSATION, "s1"))
+
+    assert "security" in client.calls
+    assert "skipped" not in security_check
+    skipped = {item["detector"] for item in monitor_result["skipped_detectors"]}
+    assert skipped == {"behavioral", "quality"}
+    assert all(item["decided_by"] == "risk:high" for item in monitor_result["skipped_detectors"])
+
+
+def test_early_stop_from_security_cancels_the_rest(monkeypatch):
+    monkeypatch.setattr(settings, "EARLY_STOP_RULES", ["security:high"])
+    client = ScriptedClient({"security": SECURITY_HIGH}, {"security": 0.0, "emotional": 1.0, "behavioral": 1.0, "quality": 1.0})
+    security_check, monitor_result = asyncio.run(build_pipeline(client).run(CONVERSATION, "s1"))
+
+    assert security_check["severity"] == "high"
+    assert {item["detector"] for item in monitor_result["skipped_detectors"]} == {"emotional", "behavioral", "quality"}
+    assert client.calls == ["security"]
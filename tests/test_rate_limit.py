@@ -0,0 +1,247 @@
+import asyncio
+import sqlite3
+from email.utils import formatdate
+import httpx
+import openai
+import pytest
+from app.core import rate_limit
+from app.core.rate_limit import SharedTokenBucket, UpstreamLimiter
+
+_real_sleep = asyncio.sleep
+
+
+class FakeClock:
+    """替换rate_limit模块里的time；sleep记录等待时间，先让出一次事件循环再推进时钟"""
+
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def monotonic(self) -> float:
+        return self.now
+
+    def time(self) -> float:
+        return self.now
+
+    async def sleep(self, delay: float):
+        self.sleeps.append(round(delay, 3))
+        await _real_sleep(0)
+        self.now += delay
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(rate_limit, "time", clock)
+    monkeypatch.setattr(rate_limit.asyncio, "sleep", clock.sleep)
+    return clock
+
+
+def status_error(cls, status: int, headers=None):
+    request = httpx.Request("POST", "http://upstream/v1/chat/completions")
+    return cls("upstream error", response=httpx.Response(status, headers=headers or {}, request=request), body=None)
+
+
+def rate_limited(**headers):
+    return status_error(openai.RateLimitError, 429, headers)
+
+
+def overloaded(**headers):
+    return status_error(openai.InternalServerError, 503, headers)
+
+
+class Upstream:
+    """依次抛出errors里的异常，之后返回"ok"；记录每次调用时的时钟"""
+
+    def __init__(self, clock: FakeClock, *errors: Exception):
+        self.clock = clock
+        self.errors = list(errors)
+        self.called_at = []
+
+    async def __call__(self):
+        self.called_at.append(self.clock.now)
+        if self.errors:
+            raise self.errors.pop(0)
+        return "ok"
+
+
+def test_retry_after_header_parsing(clock):
+    retry_after = UpstreamLimiter._retry_after
+    assert retry_after(rate_limited(**{"retry-after-ms": "1500"})) == 1.5
+    assert retry_after(rate_limited(**{"retry-after": "3"})) == 3.0
+    assert retry_after(rate_limited(**{"retry-after": "-1"})) == 0.0
+    # HTTP日期按与当前时间的差值计算
+    assert retry_after(rate_limited(**{"retry-after": formatdate(clock.now + 5, usegmt=True)})) == pytest.approx(5)
+    assert retry_after(rate_limited(**{"retry-after": formatdate(clock.now - 5, usegmt=True)})) == 0.0
+    # retry-after-ms优先
+    assert retry_after(rate_limited(**{"retry-after-ms": "200", "retry-after": "9"})) == 0.2
+    assert retry_after(rate_limited(**{"retry-after": "soon"})) is None
+    assert retry_after(rate_limited()) is None
+    assert retry_after(openai.APIConnectionError(request=httpx.Request("POST", "http://upstream"))) is None
+
+
+def test_call_follows_retry_after(clock):
+    limiter = UpstreamLimiter(max_retries=3, backoff_max=20)
+    upstream = Upstream(clock, rate_limited(**{"retry-after": "2"}), overloaded(**{"retry-after-ms": "500"}))
+
+    result, stats = asyncio.run(limiter.call(upstream))
+    assert result == "ok"
+    assert clock.sleeps == [2.0, 0.5]
+    assert upstream.called_at == [1000.0, 1002.0, 1002.5]
+    assert stats["attempts"] == 3
+    assert stats["retry_wait"] == 2.5
+
+
+def test_retry_after_is_capped_by_backoff_max(clock):
+    limiter = UpstreamLimiter(backoff_max=5)
+    asyncio.run(limiter.call(Upstream(clock, rate_limited(**{"retry-after": "120"}))))
+    assert clock.sleeps == [5.0]
+
+
+def test_rate_limit_blocks_every_caller(clock):
+    limiter = UpstreamLimiter(max_retries=3)
+    first_failed = asyncio.Event()
+
+    class FailOnce(Upstream):
+        async def __call__(self):
+            try:
+                return await super().__call__()
+            finally:
+                first_failed.set()
+
+    first = FailOnce(clock, rate_limited(**{"retry-after": "3"}))
+    second = Upstream(clock)
+
+    async def later_caller():
+        # 第一个请求收到429之后才发起
+        await first_failed.wait()
+        return await limiter.call(second)
+
+    async def run():
+        return await asyncio.gather(limiter.call(first), later_caller())
+
+    (_, first_stats), (_, second_stats) = asyncio.run(run())
+    # 后来的请求也等到Retry-After指定的时间点之后才发出，且不计为重试
+    assert clock.sleeps == [3.0, 3.0]
+    assert second.called_at[0] >= 1003.0
+    assert second_stats["attempts"] == 1 and second_stats["retry_wait"] == 0.0
+    assert second_stats["queue_wait"] >= 3.0
+
+
+def test_server_error_retry_after_does_not_block_other_callers(clock):
+    limiter = UpstreamLimiter()
+    asyncio.run(limiter.call(Upstream(clock, overloaded(**{"retry-after": "4"}))))
+    assert limiter._blocked_until == 0.0
+
+
+def test_jittered_exponential_backoff(clock, monkeypatch):
+    bounds = []
+
+    def uniform(low, high):
+        bounds.append((low, high))
+        return high / 2
+
+    monkeypatch.setattr(rate_limit.random, "uniform", uniform)
+    limiter = UpstreamLimiter(max_retries=4, backoff_base=0.5, backoff_max=1.5)
+    connection_error = openai.APIConnectionError(request=httpx.Request("POST", "http://upstream"))
+    upstream = Upstream(clock, overloaded(), connection_error, overloaded(), status_error(openai.APIStatusError, 502))
+
+    _, stats = asyncio.run(limiter.call(upstream))
+    # full jitter：在 [0, min(backoff_max, base * 2^(n-1))] 内取值
+    assert bounds == [(0, 0.5), (0, 1.0), (0, 1.5), (0, 1.5)]
+    assert clock.sleeps == [0.25, 0.5, 0.75, 0.75]
+    assert stats["attempts"] == 5
+    assert stats["retry_wait"] == pytest.approx(2.25)
+
+
+def test_gives_up_after_max_retries(clock):
+    limiter = UpstreamLimiter(max_retries=2, backoff_base=0.1)
+    upstream = Upstream(clock, *[overloaded() for _ in range(5)])
+    with pytest.raises(openai.InternalServerError):
+        asyncio.run(limiter.call(upstream))
+    assert len(upstream.called_at) == 3
+
+
+def test_client_errors_are_not_retried(clock):
+    limiter = UpstreamLimiter(max_retries=3)
+    upstream = Upstream(clock, status_error(openai.BadRequestError, 400))
+    with pytest.raises(openai.BadRequestError):
+        asyncio.run(limiter.call(upstream))
+    assert len(upstream.called_at) == 1
+    assert clock.sleeps == []
+    # 失败的请求也要释放在途名额
+    assert limiter.inflight._value == limiter.max_inflight
+
+
+def bucket_row(db_path: str, name: str):
+    with sqlite3.connect(db_path) as db:
+        return db.execute("SELECT tokens, updated_at FROM token_buckets WHERE name = ?", (name,)).fetchone()
+
+
+def test_shared_bucket_reserves_and_accumulates_debt(clock, tmp_path):
+    db_path = str(tmp_path / "buckets.db")
+    # 两个实例模拟两个worker进程，共享同一个桶
+    first = SharedTokenBucket(db_path, "openai:requests", rate=2.0, capacity=2.0)
+    second = SharedTokenBucket(db_path, "openai:requests", rate=2.0, capacity=2.0)
+
+    async def run():
+        try:
+            waits = [await first._reserve(1), await second._reserve(1), await first._reserve(1), await second._reserve(1)]
+            row_after_burst = bucket_row(db_path, "openai:requests")
+            clock.now += 1.0
+            waits.append(await first._reserve(1))
+            return waits, row_after_burst
+        finally:
+            await first.close()
+            await second.close()
+
+    waits, row = asyncio.run(run())
+    # 容量内直接放行；超出的部分记为欠额，后来者排在前面的欠额之后
+    assert waits == [0.0, 0.0, 0.5, 1.0, 0.5]
+    assert row == (-2.0, 1000.0)
+    assert bucket_row(db_path, "openai:requests") == (-1.0, 1001.0)
+
+
+def test_shared_bucket_refill_is_capped_and_names_are_separate(clock, tmp_path):
+    db_path = str(tmp_path / "buckets.db")
+    requests = SharedTokenBucket(db_path, "openai:requests", rate=1.0, capacity=3.0)
+    tokens = SharedTokenBucket(db_path, "openai:tokens", rate=100.0, capacity=600.0)
+
+    async def run():
+        try:
+            await requests.acquire(3)
+            clock.now += 3600
+            # 空闲很久也只补到容量
+            await requests.acquire(1)
+            # 超过容量的请求按容量预扣，不会永远等下去
+            await tokens.acquire(10000)
+        finally:
+            await requests.close()
+            await tokens.close()
+
+    asyncio.run(run())
+    assert bucket_row(db_path, "openai:requests")[0] == 2.0
+    assert bucket_row(db_path, "openai:tokens")[0] == 0.0
+    assert clock.sleeps == []
+
+
+def test_limiter_waits_out_shared_debt(clock, tmp_path):
+    limiter = UpstreamLimiter(rps=1.0, tpm=0, bucket_path=str(tmp_path / "buckets.db"), name="openai")
+
+    async def run():
+        try:
+            return [(await limiter.call(Upstream(clock)))[1] for _ in range(3)]
+        finally:
+            await limiter.aclose()
+
+    stats = asyncio.run(run())
+    # rps=1，容量1：第二、三个请求各等1秒
+    assert clock.sleeps == [1.0, 1.0]
+    assert [item["queue_wait"] for item in stats] == [0.0, 1.0, 1.0]
+
+
+def test_unlimited_shared_bucket_does_not_touch_sqlite(clock, tmp_path):
+    db_path = tmp_path / "buckets.db"
+    bucket = SharedTokenBucket(str(db_path), "local:requests", rate=0.0, capacity=1.0)
+    asyncio.run(bucket.acquire(5))
+    assert not db_path.exists()
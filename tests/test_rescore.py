@@ -0,0 +1,141 @@
+import argparse
+import asyncio
+import gzip
+import json
+import random
+import re
+import pytest
+import rescore
+from app.config import settings
+from app.core.json_output import DETECTOR_SCHEMAS
+from benchmarks.mock_upstream import example
+from rescore import Checkpoint
+
+DAY = re.compile(r"第(\d+)天")
+
+
+class RecordingClient:
+    """按检测器的schema返回无风险的结论，记录安全检测看到的对话是语料的第几行"""
+
+    def __init__(self):
+        self.scored = []
+        self.closed = False
+
+    async def generate_json(self, messages, detector: str, **kwargs):
+        if detector == "security":
+            self.scored.append(int(DAY.search(messages[-1]["content"]).group(1)))
+        return example(DETECTOR_SCHEMAS[detector], random.Random(0), 0.0)
+
+    async def aclose(self):
+        self.closed = True
+
+
+@pytest.fixture
+def run_rescore(monkeypatch):
+    """返回运行rescore的函数及其最近一次使用的客户端"""
+    monkeypatch.setattr(settings, "CACHE_ENABLED", False)
+    clients = []
+
+    def create(cache=None, near_duplicates=None):
+        clients.append(RecordingClient())
+        return clients[-1]
+    monkeypatch.setattr(rescore, "create_model_client", create)
+
+    def run(input_path, output_path, concurrency: int = 4, restart: bool = False) -> int:
+        args = argparse.Namespace(
+            input=str(input_path), output=str(output_path), checkpoint="", concurrency=concurrency,
+            upstream_concurrency=0, checkpoint_interval=0.0, progress_interval=3600, restart=restart
+        )
+        return asyncio.run(rescore.rescore(args))
+    run.clients = clients
+    return run
+
+
+def write_corpus(path, count: int = 12) -> bytes:
+    """第5行为空行、第7行不是合法的JSON，其余为对话"""
+    lines = []
+    for i in range(1, count + 1):
+        if i == 5:
+            lines.append(b"\n")
+        elif i == 7:
+            lines.append(b'{"session_id": "broken"\n')
+        else:
+            dialogue = {"session_id": f"s{i}", "conversation_history": [{"role": "user", "content": f"第{i}天还是睡不着"}]}
+            lines.append(json.dumps(dialogue, ensure_ascii=False).encode() + b"\n")
+    data = b"".join(lines)
+    with gzip.open(path, "wb") as f:
+        f.write(data)
+    return data
+
+
+def read_output(path):
+    with open(path, "rb") as f:
+        return [json.loads(line) for line in f]
+
+
+def test_full_run(tmp_path, run_rescore):
+    write_corpus(tmp_path / "in.jsonl.gz")
+    assert run_rescore(tmp_path / "in.jsonl.gz", tmp_path / "out.jsonl") == 0
+
+    records = read_output(tmp_path / "out.jsonl")
+    assert sorted(r["line"] for r in records) == [i for i in range(1, 13) if i != 5]
+    assert [r["line"] for r in records if "error" in r] == [7]
+    assert all(r["result"]["status"] == "normal" for r in records if r["line"] != 7)
+    assert sorted(run_rescore.clients[-1].scored) == [i for i in range(1, 13) if i not in (5, 7)]
+    assert run_rescore.clients[-1].closed
+    with open(tmp_path / "out.jsonl.ckpt") as f:
+        checkpoint = json.load(f)
+    assert checkpoint["watermark"] == 12 and checkpoint["pending"] == []
+
+
+def test_resume_after_crash(tmp_path, run_rescore):
+    data = write_corpus(tmp_path / "in.jsonl.gz")
+    run_rescore(tmp_path / "in.jsonl.gz", tmp_path / "reference.jsonl", concurrency=1)
+    reference = read_output(tmp_path / "reference.jsonl")
+    assert [r["line"] for r in reference] == [i for i in range(1, 13) if i != 5]
+
+    # 模拟崩溃：检查点停在第4行；之后又写出了第6、7、8行和半行第9行
+    input_ends, position = {}, 0
+    for number, line in enumerate(data.splitlines(keepends=True), start=1):
+        position += len(line)
+        input_ends[number] = position
+    encoded = [json.dumps(r, ensure_ascii=False).encode() + b"\n" for r in reference]
+    checkpoint = Checkpoint(str(tmp_path / "out.jsonl.ckpt"), str(tmp_path / "in.jsonl.gz"))
+    for number in range(1, 5):
+        checkpoint.done(number, input_ends[number])
+    checkpoint.save(sum(len(line) for line in encoded[:4]))
+    with open(tmp_path / "out.jsonl", "wb") as f:
+        f.write(b"".join(encoded[:7]) + encoded[7][:20])
+
+    assert run_rescore(tmp_path / "in.jsonl.gz", tmp_path / "out.jsonl") == 0
+    records = read_output(tmp_path / "out.jsonl")
+    lines = [r["line"] for r in records]
+    # 第5行(空行)在续跑时才被越过；已写出的行不重复，写了一半的第9行被截掉后重新评估
+    assert sorted(lines) == [i for i in range(1, 13) if i != 5]
+    assert lines[:7] == [1, 2, 3, 4, 6, 7, 8]
+    assert sorted(run_rescore.clients[-1].scored) == [9, 10, 11, 12]
+
+
+def test_refuses_foreign_checkpoint_and_unmanaged_output(tmp_path, run_rescore):
+    write_corpus(tmp_path / "a.jsonl.gz")
+    write_corpus(tmp_path / "b.jsonl.gz")
+    run_rescore(tmp_path / "a.jsonl.gz", tmp_path / "out.jsonl")
+    with pytest.raises(SystemExit):
+        run_rescore(tmp_path / "b.jsonl.gz", tmp_path / "out.jsonl")
+
+    (tmp_path / "other.jsonl").write_text('{"line": 1}\n')
+    with pytest.raises(SystemExit):
+        run_rescore(tmp_path / "a.jsonl.gz", tmp_path / "other.jsonl")
+    # --restart 丢弃已有的输出从头开始
+    assert run_rescore(tmp_path / "a.jsonl.gz", tmp_path / "other.jsonl", restart=True) == 0
+    assert len(read_output(tmp_path / "other.jsonl")) == 11
+
+
+def test_checkpoint_watermark_skips_gaps(tmp_path):
+    checkpoint = Checkpoint(str(tmp_path / "c.ckpt"), str(tmp_path / "in.jsonl"))
+    checkpoint.done(2, 20)
+    checkpoint.done(3, 30)
+    assert checkpoint.watermark == 0 and checkpoint.pending == {2, 3}
+    checkpoint.done(1, 10)
+    assert checkpoint.watermark == 3 and checkpoint.pending == set()
+    assert (checkpoint.offset_line, checkpoint.offset) == (3, 30)
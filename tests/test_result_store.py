@@ -0,0 +1,249 @@
+import asyncio
+import sqlite3
+from datetime import datetime, timezone
+import httpx
+from fastapi import FastAPI
+from app.api.routes import router
+from app.config import settings
+from app.core.result_store import ResultQuery, ResultWriter
+
+
+def record(i: int, anomalies=()):
+    return {
+        "session_id": f"s{i % 3}",
+        "created_at": 1000.0 + i // 2,
+        "endpoint": "/api/v1/monitor",
+        "status": "success",
+        "risk_level": "high" if anomalies else "low",
+        "anomalies": [{"type": t, "severity": "high", "description": t} for t in anomalies],
+    }
+
+
+def test_close_drains_queue(tmp_path):
+    async def run():
+        writer = ResultWriter(str(tmp_path / "results.db"), flush_interval=0.01)
+        await writer.start()
+        for i in range(5):
+            await writer.submit(record(i))
+        await writer.close()
+        return writer
+
+    writer = asyncio.run(run())
+    db = sqlite3.connect(tmp_path / "results.db")
+    assert db.execute("SELECT count(*) FROM monitoring_results").fetchone()[0] == 5
+    assert writer.dropped == 0
+
+
+def test_close_does_not_hang_when_writer_task_died(tmp_path):
+    async def run():
+        writer = ResultWriter(str(tmp_path / "results.db"), flush_interval=0.01)
+        await writer.start()
+
+        async def broken(batch):
+            raise RuntimeError("disk I/O error")
+        writer._flush = broken
+        await writer.submit(record(0))
+        await asyncio.sleep(0.05)
+        for i in range(1, 4):
+            await writer.submit(record(i))
+        await asyncio.wait_for(writer.close(), 2)
+        return writer
+
+    writer = asyncio.run(run())
+    assert writer.dropped == 4
+
+
+def test_close_gives_up_after_timeout(tmp_path):
+    async def run():
+        writer = ResultWriter(str(tmp_path / "results.db"), flush_interval=0.01, close_timeout=0.1)
+        await writer.start()
+
+        async def stuck(batch):
+            await asyncio.sleep(3600)
+        writer._flush = stuck
+        for i in range(4):
+            await writer.submit(record(i))
+        await asyncio.sleep(0.05)
+        await asyncio.wait_for(writer.close(), 2)
+        return writer
+
+    writer = asyncio.run(run())
+    # 正在写入的一批和队列中剩余的都计入丢弃
+    assert writer.dropped == 4
+
+
+def test_anomaly_type_pages_match_and_use_index(tmp_path):
+    path = str(tmp_path / "results.db")
+
+    async def run():
+        writer = ResultWriter(path)
+        records = []
+        for i in range(40):
+            anomalies = ["risk", "risk"] if i % 4 == 1 else ["risk"] if i % 4 == 2 else ["quality"] if i % 4 == 3 else []
+            records.append(record(i, anomalies))
+        await writer.write(records)
+        await writer.close()
+
+        query = ResultQuery(path)
+        ids, cursor = [], None
+        while True:
+            page = await query.results(anomaly_type="risk", limit=3, cursor=cursor)
+            ids += [item["id"] for item in page["items"]]
+            cursor = page["next_cursor"]
+            if cursor is None:
+                break
+        filtered = await query.results(anomaly_type="risk", session_id="s1", since=1005, limit=100)
+        await query.close()
+        return ids, filtered["items"]
+
+    ids, filtered = asyncio.run(run())
+    db = sqlite3.connect(path)
+    expected = [row[0] for row in db.execute(
+        "SELECT id FROM monitoring_results r WHERE EXISTS "
+        "(SELECT 1 FROM anomalies a WHERE a.result_id = r.id AND a.type = 'risk') ORDER BY created_at DESC, id DESC"
+    )]
+    assert ids == expected
+    assert filtered and all(item["session_id"] == "s1" and item["created_at"] >= 1005 for item in filtered)
+
+    plan = " ".join(row[3] for row in db.execute(
+        "EXPLAIN QUERY PLAN SELECT r.id FROM anomalies a JOIN monitoring_results r ON r.id = a.result_id "
+        "WHERE a.type = ? GROUP BY a.created_at, a.result_id ORDER BY a.created_at DESC, a.result_id DESC LIMIT 10",
+        ("risk",)
+    ))
+    assert "idx_anomalies_type_time_result" in plan
+    assert "TEMP B-TREE" not in plan
+
+
+def write_records(path: str, records):
+    async def run():
+        writer = ResultWriter(path)
+        await writer.write(records)
+        await writer.close()
+    asyncio.run(run())
+
+
+def call_api(path: str, requests):
+    """在进程内挂载路由，依次发出 (method, url, kwargs) 请求；path为None时不开启结果落库"""
+    async def run():
+        app = FastAPI()
+        app.include_router(router, prefix="/api/v1")
+        app.state.result_query = ResultQuery(path) if path else None
+        try:
+            async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as api:
+                return [await api.request(method, url, **kwargs) for method, url, kwargs in requests]
+        finally:
+            if app.state.result_query is not None:
+                await app.state.result_query.close()
+    return asyncio.run(run())
+
+
+def follow_pages(path: str, url: str, **params):
+    """沿next_cursor翻完所有页，返回每页的id列表"""
+    pages, cursor = [], None
+    while True:
+        query = dict(params, cursor=cursor) if cursor else params
+        response, = call_api(path, [("GET", url, {"params": query})])
+        assert response.status_code == 200, response.text
+        body = response.json()
+        pages.append([item["id"] for item in body["items"]])
+        cursor = body["next_cursor"]
+        if cursor is None:
+            return pages
+
+
+def iso(timestamp: float) -> str:
+    return datetime.fromtimestamp(timestamp, timezone.utc).isoformat()
+
+
+def test_results_route_cursor_is_continuous(tmp_path):
+    path = str(tmp_path / "results.db")
+    # 每两条结果的created_at相同，翻页必须靠id区分同一时间的结果
+    write_records(path, [record(i, ["risk"] if i % 3 == 0 else []) for i in range(25)])
+
+    pages = follow_pages(path, "/api/v1/results", limit=4)
+    ids = [result_id for page in pages for result_id in page]
+    assert [len(page) for page in pages] == [4, 4, 4, 4, 4, 4, 1]
+    assert ids == list(range(25, 0, -1))
+
+    risky = follow_pages(path, "/api/v1/results", limit=3, anomaly_type="risk")
+    assert [result_id for page in risky for result_id in page] == [i + 1 for i in reversed(range(0, 25, 3))]
+
+    response, = call_api(path, [("GET", "/api/v1/results", {"params": {
+        "session_id": "s1", "risk_level": "low", "since": iso(1004), "until": iso(1010)
+    }})])
+    items = response.json()["items"]
+    assert items and all(item["session_id"] == "s1" and item["risk_level"] == "low" for item in items)
+    assert all(1004 <= item["created_at"] < 1010 for item in items)
+
+
+def test_results_route_rejects_bad_cursor_and_missing_store(tmp_path):
+    path = str(tmp_path / "results.db")
+    write_records(path, [record(0)])
+    bad, = call_api(path, [("GET", "/api/v1/results", {"params": {"cursor": "yesterday"}})])
+    assert bad.status_code == 400
+    disabled, = call_api(None, [("GET", "/api/v1/results", {})])
+    assert disabled.status_code == 503
+
+
+def timeline(session_id: str, levels, start: float = 1000.0):
+    return [
+        {
+            "session_id": session_id,
+            "created_at": start + i,
+            "endpoint": "/api/v1/monitor",
+            "status": "success",
+            "risk_level": level,
+            "anomalies": [],
+        }
+        for i, level in enumerate(levels)
+    ]
+
+
+def test_escalations_follow_prev_risk_level(tmp_path):
+    path = str(tmp_path / "results.db")
+    write_records(path, timeline("a", ["low", "high", "high", "medium", "high"]))
+    # 分两批写入，prev_risk_level仍然接着上一批的最新结论
+    write_records(path, timeline("b", ["medium"], start=1010) + timeline("a", ["low"], start=1011))
+    write_records(path, timeline("b", ["high"], start=1020) + timeline("a", ["high"], start=1021))
+
+    def escalations(**params):
+        pages = follow_pages(path, "/api/v1/results/escalations", limit=1, **params)
+        return [result_id for page in pages for result_id in page]
+
+    db = sqlite3.connect(path)
+    transitions = {row[0]: (row[1], row[2]) for row in db.execute(
+        "SELECT id, prev_risk_level, risk_level FROM monitoring_results"
+    )}
+    assert transitions[1] == (None, "low")
+    assert transitions[3] == ("high", "high")
+
+    # 默认：从任意更低的等级升到high；high -> high不算升级
+    to_high = escalations()
+    assert [transitions[i] for i in to_high] == [("low", "high"), ("medium", "high"), ("medium", "high"), ("low", "high")]
+    assert to_high == [9, 8, 5, 2]
+    assert escalations(from_level="low") == [9, 2]
+    assert escalations(to_level="medium") == [] and escalations(to_level="low") == []
+    assert escalations(since=iso(1010)) == [9, 8]
+
+    responses = call_api(path, [
+        ("GET", "/api/v1/results/escalations", {"params": {"to_level": "critical"}}),
+        ("GET", "/api/v1/results/escalations", {"params": {"from_level": ["low", "bogus"]}}),
+    ])
+    assert [response.status_code for response in responses] == [400, 400]
+
+
+def test_latest_returns_newest_verdict_per_session(tmp_path, monkeypatch):
+    path = str(tmp_path / "results.db")
+    write_records(path, timeline("a", ["low", "high"]) + timeline("b", ["medium"], start=1005))
+    write_records(path, timeline("a", ["medium"], start=1010))
+
+    response, = call_api(path, [("POST", "/api/v1/results/latest", {"json": {"session_ids": ["a", "b", "c", "a"]}})])
+    body = response.json()
+    assert {session_id: item["risk_level"] for session_id, item in body["results"].items()} == {"a": "medium", "b": "medium"}
+    assert body["results"]["a"]["prev_risk_level"] == "high"
+    assert body["results"]["a"]["created_at"] == 1010
+    assert body["missing"] == ["c"]
+
+    monkeypatch.setattr(settings, "RESULT_LATEST_MAX_IDS", 2)
+    too_many, = call_api(path, [("POST", "/api/v1/results/latest", {"json": {"session_ids": ["a", "b", "c"]}})])
+    assert too_many.status_code == 413
@@ -0,0 +1,168 @@
+import asyncio
+import json
+import httpx
+import openai
+import pytest
+from app.config import settings
+from app.core import router as router_module
+from app.core.model_client import OpenAIClient
+from app.core.router import CircuitBreaker, EndpointRouter
+
+MESSAGES = [{"role": "user", "content": "你好"}]
+
+
+class Upstreams:
+    """httpx.MockTransport的处理函数：按Host区分端点，每个端点固定返回200、429或503，并记录对话请求数"""
+
+    def __init__(self, behaviours: dict):
+        self.behaviours = behaviours
+        self.calls = {host: 0 for host in behaviours}
+
+    def __call__(self, request: httpx.Request) -> httpx.Response:
+        host = request.url.host
+        if not request.url.path.endswith("/chat/completions"):
+            return httpx.Response(200, json={"object": "list", "data": []})
+        self.calls[host] += 1
+        status = self.behaviours[host]
+        if status != 200:
+            return httpx.Response(status, json={"error": {"message": f"{host} returned {status}"}})
+        return httpx.Response(200, json={
+            "id": "chatcmpl-1",
+            "object": "chat.completion",
+            "created": 0,
+            "model": json.loads(request.content)["model"],
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": host}, "finish_reason": "stop"}],
+        })
+
+
+@pytest.fixture
+def client_for(monkeypatch):
+    """按 {host: 状态码} 创建多端点的OpenAIClient；字典顺序即priority"""
+    monkeypatch.setattr(settings, "ROUTER_HEALTH_INTERVAL", 0)
+    monkeypatch.setattr(settings, "ROUTER_ENDPOINT_RETRIES", 0)
+    monkeypatch.setattr(settings, "ROUTER_FAILURE_THRESHOLD", 2)
+
+    def factory(upstreams: Upstreams) -> OpenAIClient:
+        monkeypatch.setattr(settings, "LLM_ENDPOINTS", [
+            {"name": host, "provider": "local", "base_url": f"http://{host}/v1", "priority": priority}
+            for priority, host in enumerate(upstreams.behaviours)
+        ])
+        return OpenAIClient(http_client=httpx.AsyncClient(transport=httpx.MockTransport(upstreams)))
+    return factory
+
+
+def generate_many(client: OpenAIClient, count: int):
+    async def run():
+        try:
+            answers = [await client.generate(MESSAGES) for _ in range(count)]
+            return answers, {item["name"]: item["state"] for item in client.router.status()}
+        finally:
+            await client.aclose()
+    return asyncio.run(run())
+
+
+def test_fails_over_and_opens_circuit(client_for):
+    upstreams = Upstreams({"bad": 503, "good": 200})
+    answers, states = generate_many(client_for(upstreams), 4)
+
+    assert answers == ["good"] * 4
+    # 连续失败2次后熔断，之后的请求不再发给bad
+    assert upstreams.calls == {"bad": 2, "good": 4}
+    assert states == {"bad": "open", "good": "closed"}
+
+
+def test_rate_limited_endpoint_fails_over_without_opening(client_for):
+    upstreams = Upstreams({"limited": 429, "good": 200})
+    answers, states = generate_many(client_for(upstreams), 4)
+
+    assert answers == ["good"] * 4
+    # 429不说明端点故障：每次都先试priority更高的端点，熔断器保持关闭
+    assert upstreams.calls == {"limited": 4, "good": 4}
+    assert states["limited"] == "closed"
+
+
+def test_all_endpoints_failing_raises_after_one_try_each(client_for):
+    upstreams = Upstreams({"first": 503, "second": 503})
+    client = client_for(upstreams)
+
+    async def run():
+        try:
+            with pytest.raises(openai.InternalServerError):
+                await client.generate(MESSAGES)
+        finally:
+            await client.aclose()
+
+    asyncio.run(run())
+    assert upstreams.calls == {"first": 1, "second": 1}
+
+
+def test_client_errors_are_not_failed_over():
+    request = httpx.Request("POST", "http://upstream/v1/chat/completions")
+    bad_request = openai.BadRequestError("bad", response=httpx.Response(400, request=request), body=None)
+    unauthorized = openai.AuthenticationError("key", response=httpx.Response(401, request=request), body=None)
+    limited = openai.RateLimitError("slow down", response=httpx.Response(429, request=request), body=None)
+    assert EndpointRouter._classify(bad_request) == "raise"
+    assert EndpointRouter._classify(unauthorized) == "failure"
+    assert EndpointRouter._classify(limited) == "failover"
+    assert EndpointRouter._classify(openai.APIConnectionError(request=request)) == "failure"
+
+
+def test_pick_prefers_low_priority_tier_then_least_outstanding_per_weight(client_for):
+    client = client_for(Upstreams({"a": 200, "b": 200, "spill": 200}))
+    a, b, spill = client.router.endpoints
+    b.priority = a.priority
+    b.weight = 2.0
+    a.outstanding, b.outstanding = 1, 2
+    # a: (1+1)/1=2，b: (2+1)/2=1.5
+    assert client.router.pick() is b
+
+    a.outstanding = a.max_inflight
+    b.outstanding = b.max_inflight
+    # 低priority的端点都打满了才溢出到下一层
+    assert client.router.pick() is spill
+    asyncio.run(client.aclose())
+
+
+class Clock:
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def test_circuit_half_open_allows_single_probe(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(router_module.time, "monotonic", clock)
+    breaker = CircuitBreaker("x", failure_threshold=2, open_seconds=30)
+
+    breaker.record_failure()
+    assert breaker.available()
+    breaker.record_failure()
+    assert breaker.state == "open" and not breaker.available()
+
+    clock.now += 30
+    assert breaker.available() and breaker.state == "half_open"
+    breaker.begin()
+    # 试探请求在途时不再放行其它请求
+    assert not breaker.available()
+    breaker.record_failure()
+    assert breaker.state == "open" and not breaker.available()
+
+    clock.now += 30
+    assert breaker.available()
+    breaker.begin()
+    breaker.record_success()
+    assert breaker.state == "closed" and breaker.available()
+
+
+def test_health_check_moves_open_circuit_to_half_open(client_for):
+    client = client_for(Upstreams({"a": 200}))
+    endpoint = client.router.primary
+    for _ in range(settings.ROUTER_FAILURE_THRESHOLD):
+        endpoint.breaker.record_failure()
+    assert endpoint.breaker.state == "open"
+
+    assert asyncio.run(client.router.check(endpoint))
+    assert endpoint.breaker.state == "half_open" and endpoint.breaker.available()
+    asyncio.run(client.aclose())
@@ -0,0 +1,183 @@
+import asyncio
+import json
+import random
+import sqlite3
+from app.api.routes import Message
+from app.config import settings
+from app.core.context_window import ContextWindow
+from app.core.json_output import DETECTOR_SCHEMAS
+from app.core.model_client import BaseModelClient
+from app.core.monitor import DialogueMonitor
+from app.core.pipeline import MonitorPipeline
+from app.core.security import SecurityManager
+from app.core.session_store import InMemorySessionStore, SessionContext, SqliteSessionStore, conversation_fingerprint
+from benchmarks.mock_upstream import example
+
+FIRST = [
+    Message(role="user", content="最近工作压力很大"),
+    Message(role="assistant", content="能具体说说是哪方面的压力吗？"),
+]
+SECOND = FIRST + [
+    Message(role="user", content="老板每天都在催进度"),
+    Message(role="assistant", content="听起来你一直处在紧绷的状态。"),
+]
+
+
+def state_for(conversation, verdicts=None, summary="user: 最近工作压力很大"):
+    return {
+        "session_id": "s1",
+        "analyzed_count": len(conversation),
+        "prefix_hash": conversation_fingerprint(conversation),
+        "summary": summary,
+        "verdicts": verdicts or {"emotional": []},
+        "updated_at": 0,
+    }
+
+
+def test_matching_prefix_analyzes_only_the_delta():
+    session = SessionContext("s1", SECOND, state_for(FIRST, {"emotional": [{"type": "emotional"}]}))
+
+    assert session.incremental and not session.unchanged
+    assert session.delta == SECOND[2:]
+    text = session.render("emotional")
+    assert "【此前对话摘要】\nuser: 最近工作压力很大" in text
+    assert '[{"type": "emotional"}]' in text
+    assert "老板每天都在催进度" in text
+    # 已分析过的前缀不再重复发送
+    assert "能具体说说是哪方面的压力吗" not in text
+
+
+def test_fingerprint_ignores_timestamps():
+    resent = [Message(role=msg.role, content=msg.content, timestamp="2026-01-01T00:00:00") for msg in FIRST]
+    assert conversation_fingerprint(resent) == conversation_fingerprint(FIRST)
+    assert SessionContext("s1", resent, state_for(FIRST)).unchanged
+
+
+def test_diverged_history_forces_full_analysis():
+    # 客户端编辑了此前的一轮：前缀指纹不一致，退回全量分析
+    edited = [FIRST[0], Message(role="assistant", content="别想太多。")] + SECOND[2:]
+    session = SessionContext("s1", edited, state_for(FIRST))
+
+    assert not session.incremental
+    assert session.delta == edited
+    assert session.render("emotional") == "".join(f"{msg.role}: {msg.content}\n" for msg in edited)
+
+    # 新状态从头开始，不沿用旧的摘要和结论
+    session.record("behavioral", [])
+    state = session.next_state()
+    assert state["verdicts"] == {"behavioral": []}
+    assert state["analyzed_count"] == 4
+    assert state["prefix_hash"] == conversation_fingerprint(edited)
+    assert "最近工作压力很大" in state["summary"] and "别想太多" in state["summary"]
+
+
+def test_shorter_history_forces_full_analysis():
+    session = SessionContext("s1", FIRST[:1], state_for(SECOND))
+    assert not session.incremental
+
+
+def test_system_error_does_not_advance_the_prefix():
+    session = SessionContext("s1", SECOND, state_for(FIRST))
+    session.record("emotional", [{"type": "system", "severity": "low", "description": "超时"}])
+    assert session.next_state() is None
+
+
+def test_incremental_state_merges_verdicts_and_rolls_summary(monkeypatch):
+    monkeypatch.setattr(settings, "SESSION_SUMMARY_MAX_CHARS", 40)
+    old = [{"type": "emotional", "severity": "low", "description": "旧"}]
+    new = [{"type": "emotional", "severity": "medium", "description": "新"}]
+    session = SessionContext("s1", SECOND, state_for(FIRST, {"emotional": old, "quality": old}))
+    session.record("emotional", new)
+    state = session.next_state()
+
+    assert state["verdicts"] == {"emotional": new, "quality": old}
+    assert state["analyzed_count"] == 4
+    assert state["summary"].endswith("assistant: 听起来你一直处在紧绷的状态。")
+    assert len(state["summary"]) <= 41
+
+
+def test_memory_store_evicts_and_expires(monkeypatch):
+    store = InMemorySessionStore(max_sessions=2, ttl=100)
+
+    async def run():
+        for session_id in ("a", "b"):
+            await store.save({"session_id": session_id, "updated_at": 1000})
+        await store.get("a")
+        await store.save({"session_id": "c", "updated_at": 1000})
+        return [await store.get(session_id) is not None for session_id in ("a", "b", "c")]
+
+    monkeypatch.setattr("app.core.session_store.time.time", lambda: 1050)
+    # 最近访问过的a保留，最久未用的b被淘汰
+    assert asyncio.run(run()) == [True, False, True]
+    monkeypatch.setattr("app.core.session_store.time.time", lambda: 1200)
+    assert asyncio.run(store.get("a")) is None
+
+
+def test_sqlite_store_persists_across_instances(tmp_path, monkeypatch):
+    db_path = str(tmp_path / "sessions.db")
+    session = SessionContext("s1", FIRST)
+    session.record("emotional", [{"type": "emotional", "severity": "medium", "description": "压力"}])
+    state = session.next_state()
+
+    async def save():
+        store = SqliteSessionStore(db_path, ttl=100)
+        try:
+            await store.save(state)
+        finally:
+            await store.close()
+
+    async def load(session_id):
+        # 新实例模拟服务重启
+        store = SqliteSessionStore(db_path, ttl=100)
+        try:
+            return await store.get(session_id)
+        finally:
+            await store.close()
+
+    asyncio.run(save())
+    assert asyncio.run(load("s1")) == state
+    assert asyncio.run(load("other")) is None
+    assert SessionContext("s1", SECOND, asyncio.run(load("s1"))).incremental
+    with sqlite3.connect(db_path) as db:
+        assert db.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+
+    monkeypatch.setattr("app.core.session_store.time.time", lambda: state["updated_at"] + 101)
+    assert asyncio.run(load("s1")) is None
+
+
+class PromptRecordingClient(BaseModelClient):
+    """记录每个检测器收到的对话文本，返回schema的示例结论"""
+
+    model_name = "recording"
+
+    def __init__(self):
+        super().__init__()
+        self.prompts = {}
+
+    async def generate(self, messages, detector=None, **kwargs) -> str:
+        self.prompts[detector] = messages[-1]["content"]
+        return json.dumps(example(DETECTOR_SCHEMAS[detector], random.Random(0), 0.0), ensure_ascii=False)
+
+
+def test_pipeline_reuses_the_session_between_requests(monkeypatch):
+    monkeypatch.setattr(settings, "INCREMENTAL_ANALYSIS", True)
+    monkeypatch.setattr(settings, "ANALYSIS_MODE", "split")
+    client = PromptRecordingClient()
+    window = ContextWindow.from_settings()
+    store = InMemorySessionStore()
+    pipeline = MonitorPipeline(SecurityManager(client, window), DialogueMonitor(client, window), session_store=store)
+
+    asyncio.run(pipeline.run(FIRST, "s1"))
+    assert "【此前对话摘要】" not in client.prompts["emotional"]
+
+    asyncio.run(pipeline.run(SECOND, "s1"))
+    assert "【此前对话摘要】" in client.prompts["emotional"]
+    # 已分析的前缀只以摘要形式出现，新增对话部分只有后两轮
+    delta = client.prompts["emotional"].split("【新增对话】")[1]
+    assert "老板每天都在催进度" in delta and "能具体说说是哪方面的压力吗" not in delta
+
+    edited = [Message(role="user", content="我换了个话题")] + SECOND[1:]
+    asyncio.run(pipeline.run(edited, "s1"))
+    assert "【此前对话摘要】" not in client.prompts["emotional"]
+    assert "我换了个话题" in client.prompts["emotional"]
+    assert asyncio.run(store.get("s1"))["prefix_hash"] == conversation_fingerprint(edited)
@@ -0,0 +1,143 @@
+import asyncio
+import json
+import httpx
+from fastapi import FastAPI
+from app.api.routes import DialogueInput, MonitoringResult, router
+from app.core.monitor import DialogueMonitor
+from app.core.pipeline import MonitorPipeline
+from app.core.security import SecurityManager
+
+BODY = {"session_id": "s1", "conversation_history": [{"role": "user", "content": "最近总是失眠"}]}
+# description里的换行不能破坏SSE的 data: 行
+QUALITY_DESCRIPTION = "第一行\n第二行\r\n\ndata: 伪造"
+VERDICTS = {
+    "security": {"has_issues": False, "severity": "low", "risk_types": [], "description": "无风险",
+                 "recommendations": [], "requires_immediate_action": False},
+    "emotional": {"risk_assessment": {"has_risk": False, "severity": "low", "description": "", "suggestions": []}},
+    "behavioral": {
+        "behavioral_issues": {"has_issues": False, "severity": "low", "patterns": [], "description": "", "suggestions": []},
+        "interaction_quality": {"is_problematic": False, "severity": "low", "issues": [], "description": "", "suggestions": []},
+    },
+    "quality": {
+        "response_quality": {"has_issues": True, "severity": "medium", "issues": ["回复敷衍"],
+                             "description": QUALITY_DESCRIPTION, "suggestions": ["多共情"]},
+        "content_safety": {"has_issues": False, "severity": "low", "issues": [], "description": "", "suggestions": []},
+    },
+}
+DELAYS = {"security": 0.0, "emotional": 0.05, "behavioral": 0.1, "quality": 0.15}
+
+
+class ScriptedClient:
+    """按检测器名称返回固定结论，delays控制各检测器的完成顺序；记录被取消的检测器"""
+
+    def __init__(self, delays: dict):
+        self.delays = delays
+        self.cancelled = []
+
+    async def generate_json(self, messages, detector: str, **kwargs):
+        try:
+            await asyncio.sleep(self.delays[detector])
+        except asyncio.CancelledError:
+            self.cancelled.append(detector)
+            raise
+        return json.loads(json.dumps(VERDICTS[detector]))
+
+
+class BrokenPipeline(MonitorPipeline):
+    """产出一个检测器结果后抛出异常"""
+
+    async def stream(self, conversation, session_id):
+        async for event, payload in super().stream(conversation, session_id):
+            yield event, payload
+            raise RuntimeError("stream broke")
+
+
+def build(cls=MonitorPipeline, delays=DELAYS) -> MonitorPipeline:
+    client = ScriptedClient(delays)
+    return cls(SecurityManager(client), DialogueMonitor(client))
+
+
+def request(pipeline: MonitorPipeline, fmt: str):
+    async def run():
+        app = FastAPI()
+        app.include_router(router, prefix="/api/v1")
+        app.state.pipeline = pipeline
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as api:
+            response = await api.post("/api/v1/monitor/stream", json=BODY, params={"format": fmt})
+        assert response.status_code == 200
+        return response.headers["content-type"], response.text
+    return asyncio.run(run())
+
+
+def parse_sse(text: str):
+    events = []
+    for block in text.replace("\r\n", "\n").strip("\n").split("\n\n"):
+        lines = block.split("\n")
+        assert len(lines) == 2, block
+        assert lines[0].startswith("event: ") and lines[1].startswith("data: ")
+        events.append((lines[0][len("event: "):], json.loads(lines[1][len("data: "):])))
+    return events
+
+
+def parse_ndjson(text: str):
+    events = []
+    for line in text.splitlines():
+        record = json.loads(line)
+        assert set(record) == {"event", "data"}
+        events.append((record["event"], record["data"]))
+    return events
+
+
+def check_events(events):
+    # 按完成顺序推送，最后一条是合并结果
+    assert [name for name, _ in events] == ["security", "emotional", "behavioral", "quality", "result"]
+    for name, data in events[:-1]:
+        assert data["detector"] == name
+    assert events[0][1]["security_status"]["description"] == "无风险"
+    assert events[1][1] == {"detector": "emotional", "risk_level": "low", "anomalies": []}
+    quality = events[3][1]
+    assert quality["risk_level"] == "medium"
+    assert [anomaly["description"] for anomaly in quality["anomalies"]] == [QUALITY_DESCRIPTION]
+
+    result = MonitoringResult.model_validate(events[-1][1])
+    assert result.status == "alert" and result.risk_level == "medium"
+    assert [anomaly.description for anomaly in result.anomalies] == [QUALITY_DESCRIPTION]
+
+
+def test_sse_framing():
+    content_type, text = request(build(), "sse")
+    assert content_type.startswith("text/event-stream")
+    check_events(parse_sse(text))
+
+
+def test_ndjson_framing():
+    content_type, text = request(build(), "ndjson")
+    assert content_type.startswith("application/x-ndjson")
+    assert text.endswith("\n")
+    check_events(parse_ndjson(text))
+
+
+def test_error_event_ends_the_stream():
+    for fmt, parse in (("sse", parse_sse), ("ndjson", parse_ndjson)):
+        _, text = request(build(BrokenPipeline), fmt)
+        events = parse(text)
+        assert [name for name, _ in events] == ["security", "error"]
+        assert events[-1][1]["session_id"] == "s1"
+        assert events[-1][1]["error"] == "stream broke"
+
+
+def test_closing_the_stream_cancels_pending_detectors():
+    pipeline = build(delays={"security": 0.0, "emotional": 5, "behavioral": 5, "quality": 5})
+
+    async def run():
+        dialogue = DialogueInput(**BODY)
+        stream = pipeline.stream(dialogue.conversation_history, dialogue.session_id)
+        first = await stream.__anext__()
+        await stream.aclose()
+        # 让被取消的任务执行到CancelledError
+        await asyncio.sleep(0)
+        return first
+
+    event, payload = asyncio.run(run())
+    assert event == "security" and payload["severity"] == "low"
+    assert sorted(pipeline.security_manager.client.cancelled) == ["behavioral", "emotional", "quality"]
@@ -0,0 +1,48 @@
+import asyncio
+from app.api.routes import Message
+from app.core.context_window import ContextWindow
+from app.core.monitor import DialogueMonitor
+from app.core.pipeline import MonitorPipeline
+from app.core.security import SecurityManager
+from app.core.triage import Triage
+
+
+def conversation(*turns):
+    return [Message(role=role, content=content) for role, content in turns]
+
+
+def test_benign_chat_is_skipped():
+    decision = Triage().evaluate(conversation(("user", "你好"), ("assistant", "你好！今天想聊些什么？")))
+    assert decision["tier"] == "skip"
+
+
+def test_crisis_keyword_from_user_needs_full_analysis():
+    decision = Triage().evaluate(conversation(("user", "我不想活了")))
+    assert decision["tier"] == "full"
+    assert "crisis_keywords" in decision["reasons"]
+
+
+def test_harmful_assistant_reply_needs_full_analysis():
+    decision = Triage().evaluate(conversation(("user", "你好"), ("assistant", "你去死吧，自杀算了")))
+    assert decision["tier"] == "full"
+    assert "assistant_content" in decision["reasons"]
+    assert "自杀" in decision["signals"]["assistant_keywords"]
+
+
+def test_quality_detector_runs_for_harmful_assistant_reply(mock_upstream, model_client, upstream_stats):
+    upstream = mock_upstream()
+
+    async def run():
+        client = model_client(upstream)
+        window = ContextWindow.from_settings()
+        monitor = DialogueMonitor(client, window)
+        monitor.triage = Triage()
+        pipeline = MonitorPipeline(SecurityManager(client, window), monitor)
+        _, result = await pipeline.run(conversation(("user", "你好"), ("assistant", "你去死吧，自杀算了")), "s1")
+        await client.aclose()
+        return result, await upstream_stats(upstream)
+
+    result, stats = asyncio.run(run())
+    assert result["triage"]["tier"] == "full"
+    assert stats.get("calls.quality") == 1
+    assert not any(item["reason"] == "triage" for item in result.get("skipped_detectors", []))